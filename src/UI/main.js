@@ -7,8 +7,8 @@ $(function() {
 	var geocoder = null;
 	var bar = null;
 
-	var cancellationToken = null;
-	var requests = [];
+	var currentJob = null;
+	var jobEvents = null;
 
 	var sources = {
 
@@ -543,6 +543,7 @@ $(function() {
 
 		$("#download-button").click(startDownloading)
 		$("#stop-button").click(stopDownloading)
+		$("#pause-button").click(togglePause)
 
 		var timestamp = Date.now().toString();
 		//$("#output-directory-box").val(timestamp)
@@ -568,150 +569,119 @@ $(function() {
 			return;
 		}
 
-		cancellationToken = false;
-		requests = [];
-
 		$("#main-sidebar").hide();
 		$("#download-sidebar").show();
 		$(".tile-strip").html("");
 		$("#stop-button").html("STOP");
+		$("#pause-button").html("PAUSE").show();
 		removeGrid();
 		clearLogs();
 		M.Toast.dismissAll();
 
 		var timestamp = Date.now().toString();
 
-		var allTiles = getAllGridTiles();
-		updateProgress(0, allTiles.length);
-
-		var numThreads = parseInt($("#parallel-threads-box").val());
-		var outputDirectory = $("#output-directory-box").val();
-		var outputFile = $("#output-file-box").val();
-		var outputType = $("#output-type").val();
-		var outputScale = $("#output-scale").val();
-		var source = $("#source-box").val()
+		updateProgress(0, 0);
 
-		var bounds = getBounds();
-		var boundsArray = [bounds.getSouthWest().lng, bounds.getSouthWest().lat, bounds.getNorthEast().lng, bounds.getNorthEast().lat]
-		var centerArray = [bounds.getCenter().lng, bounds.getCenter().lat, getMaxZoom()]
-
-		var data = new FormData();
-		data.append('minZoom', getMinZoom())
-		data.append('maxZoom', getMaxZoom())
-		data.append('outputDirectory', outputDirectory)
-		data.append('outputFile', outputFile)
-		data.append('outputType', outputType)
-		data.append('outputScale', outputScale)
-		data.append('source', source)
-		data.append('timestamp', timestamp)
-		data.append('bounds', boundsArray.join(","))
-		data.append('center', centerArray.join(","))
-
-		var request = await $.ajax({
-			url: "/start-download",
-			async: true,
-			timeout: 300 * 1000,
-			type: "post",
-			contentType: false,
-			processData: false,
-			data: data,
-			dataType: 'json',
-		})
-
-		let i = 0;
-		var iterator = async.eachLimit(allTiles, numThreads, function(item, done) {
-
-			if(cancellationToken) {
-				return;
-			}
+		// The server enumerates and downloads the tiles, the page only follows the job's progress
+		var job = {
+			source: $("#source-box").val(),
+			geometry: draw.getAll(),
+			minZoom: getMinZoom(),
+			maxZoom: getMaxZoom(),
+			threads: parseInt($("#parallel-threads-box").val()),
+			outputDirectory: $("#output-directory-box").val(),
+			outputFile: $("#output-file-box").val(),
+			outputType: $("#output-type").val(),
+			outputScale: parseInt($("#output-scale").val()),
+			timestamp: timestamp,
+		};
 
-			var boxLayer = previewRect(item);
-
-			var url = "/download-tile";
-
-			var data = new FormData();
-			data.append('x', item.x)
-			data.append('y', item.y)
-			data.append('z', item.z)
-			data.append('quad', generateQuadKey(item.x, item.y, item.z))
-			data.append('outputDirectory', outputDirectory)
-			data.append('outputFile', outputFile)
-			data.append('outputType', outputType)
-			data.append('outputScale', outputScale)
-			data.append('timestamp', timestamp)
-			data.append('source', source)
-			data.append('bounds', boundsArray.join(","))
-			data.append('center', centerArray.join(","))
-
-			var request = $.ajax({
-				"url": url,
+		try {
+			var response = await $.ajax({
+				url: "/jobs",
 				async: true,
 				timeout: 300 * 1000,
 				type: "post",
-			    contentType: false,
-			    processData: false,
-				data: data,
+				contentType: "application/json",
+				processData: false,
+				data: JSON.stringify(job),
 				dataType: 'json',
-			}).done(function(data) {
-
-				if(cancellationToken) {
-					return;
-				}
-
-				if(data.code == 200) {
-					showTinyTile(data.image)
-					//logItem(item.x, item.y, item.z, data.message);
-				} else {
-					logItem(item.x, item.y, item.z, data.code + " Error downloading tile");
-				}
+			});
+		} catch(e) {
+			logItemRaw("Could not start the download job");
+			return;
+		}
 
-			}).fail(function(data, textStatus, errorThrown) {
+		currentJob = response.id;
+		followJob(currentJob);
+	}
 
-				if(cancellationToken) {
-					return;
-				}
+	function followJob(jobId) {
 
-				logItem(item.x, item.y, item.z, "Error while relaying tile");
-				//allTiles.push(item);
+		var events = new EventSource("/jobs/" + jobId + "/events");
+		jobEvents = events;
 
-			}).always(function(data) {
-				i++;
+		events.addEventListener("progress", function(e) {
+			var progress = JSON.parse(e.data);
+			updateProgress(progress.done + progress.skipped, progress.total || 0);
+			$("#progress-subtitle").append(" <span>at</span> " + progress.rate.toLocaleString() + " <span>tiles/s</span>");
 
-				removeLayer(boxLayer);
-				updateProgress(i, allTiles.length);
+			if(progress.state == "finished" || progress.state == "cancelled" || progress.state == "failed") {
+				events.close();
+				jobEvents = null;
 
-				done();
+				if(progress.state == "failed") {
+					logItemRaw("Download failed: " + progress.error);
+				} else {
+					logItemRaw("All requests are done");
+				}
 
-				if(cancellationToken) {
-					return;
+				if(progress.skipped > 0) {
+					logItemRaw(progress.skipped.toLocaleString() + " tiles were already downloaded");
 				}
-			});
 
-			requests.push(request);
+				$("#pause-button").hide();
+				$("#stop-button").html("FINISH");
+			}
+		});
 
-		}, async function(err) {
+		events.addEventListener("tile", function(e) {
+			var tile = JSON.parse(e.data);
 
-			var request = await $.ajax({
-				url: "/end-download",
-				async: true,
-				timeout: 300 * 1000,
-				type: "post",
-				contentType: false,
-				processData: false,
-				data: data,
-				dataType: 'json',
-			})
+			if(tile.status == "failed" || tile.status == "deferred") {
+				logItem(tile.x, tile.y, tile.z, tile.message);
+			}
+		});
+
+		events.addEventListener("state", function(e) {
+			var state = JSON.parse(e.data).state;
+			$("#pause-button").html(state == "paused" ? "RESUME" : "PAUSE");
+		});
+	}
 
-			updateProgress(allTiles.length, allTiles.length);
-			logItemRaw("All requests are done");
+	function postJobAction(action) {
+		if(currentJob == null) {
+			return;
+		}
 
-			$("#stop-button").html("FINISH");
+		return $.ajax({
+			url: "/jobs/" + currentJob + "/" + action,
+			async: true,
+			type: "post",
+			dataType: 'json',
 		});
+	}
 
+	function togglePause() {
+		if($("#pause-button").html() == "RESUME") {
+			postJobAction("resume");
+		} else {
+			postJobAction("pause");
+		}
 	}
 
 	function updateProgress(value, total) {
-		var progress = value / total;
+		var progress = total > 0 ? value / total : 0;
 
 		bar.animate(progress);
 		bar.setText(Math.round(progress * 100) + '<span>%</span>');
@@ -737,16 +707,13 @@ $(function() {
 	}
 
 	function stopDownloading() {
-		cancellationToken = true;
-
-		for(var i =0 ; i < requests.length; i++) {
-			var request = requests[i];
-			try {
-				request.abort();
-			} catch(e) {
-
-			}
+		// Stopping the page's view of a running job cancels the job itself
+		if(jobEvents != null) {
+			jobEvents.close();
+			jobEvents = null;
+			postJobAction("cancel");
 		}
+		currentJob = null;
 
 		$("#main-sidebar").show();
 		$("#download-sidebar").hide();
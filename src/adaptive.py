@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import deque
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller for the number of tiles in flight.
+
+    Every finished HTTP attempt is recorded with its status and latency. Once
+    per window of samples the limit grows by one while the window stayed
+    healthy, and is cut multiplicatively after HTTP 429/503, timeouts, or
+    when the window's p95 latency rises well above the best p95 seen so far.
+    A cut happens once per burst: the answers to requests already in flight
+    when the limit was cut are not taken as new throttling signals.
+    A Retry-After header pauses new work until the provider allows it.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=64, window=20,
+                 decrease=0.5, latencyFactor=2.0):
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.window = max(1, int(window))
+        self.decrease = decrease
+        self.latencyFactor = latencyFactor
+
+        self.latencies = deque(maxlen=self.window)
+        self.samples = 0
+        self.throttled = None  # reason of the first throttling signal in the window
+        self.cooldown = 0  # samples still answering requests sent before the last cut
+        self.baselineP95 = None
+        self.pausedUntil = 0.0
+        self.changes = deque()
+        self.lock = threading.Lock()
+
+    def current(self):
+        return int(self.limit)
+
+    def pauseRemaining(self):
+        return max(0.0, self.pausedUntil - time.monotonic())
+
+    def drainChanges(self):
+        """Return and forget the (old, new, reason) limit changes since the last call"""
+        with self.lock:
+            changes = list(self.changes)
+            self.changes.clear()
+        return changes
+
+    def record(self, url, status, latency, retryAfter=None):
+        """Feed one HTTP attempt; status is None for timeouts and connection errors"""
+        with self.lock:
+            cooling = self.cooldown > 0
+            if cooling:
+                self.cooldown -= 1
+
+            if status is None:
+                self.throttled = self.throttled or "timeout or connection error"
+            elif status in (429, 503):
+                reason = f"HTTP {status}"
+                if retryAfter:
+                    reason += f", Retry-After {retryAfter:.0f}s"
+                self.throttled = self.throttled or reason
+            elif status < 500:
+                self.latencies.append(latency)
+
+            if retryAfter:
+                self.pausedUntil = max(self.pausedUntil, time.monotonic() + retryAfter)
+
+            self.samples += 1
+            if self.throttled is not None and cooling:
+                # Same burst as the last cut, the lower limit has not been tried yet
+                self.throttled = None
+            elif self.throttled is not None:
+                # React to throttling right away, waiting for a full window would pile on more requests
+                self._adjust(self.limit * self.decrease, self.throttled)
+            elif self.samples >= self.window:
+                self._evaluate()
+
+    def _evaluate(self):
+        if len(self.latencies) < self.window // 2:
+            self._reset()
+            return
+
+        ordered = sorted(self.latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+        if self.baselineP95 is None or p95 < self.baselineP95:
+            self.baselineP95 = p95
+
+        if p95 > self.baselineP95 * self.latencyFactor:
+            self._adjust(self.limit * self.decrease,
+                         f"p95 latency {p95 * 1000:.0f}ms above {self.baselineP95 * 1000:.0f}ms baseline")
+        else:
+            self._adjust(self.limit + 1, f"healthy, p95 latency {p95 * 1000:.0f}ms")
+
+    def _adjust(self, limit, reason):
+        old = self.current()
+        self.limit = float(min(max(limit, self.minimum), self.maximum))
+        if self.current() != old:
+            self.changes.append((old, self.current(), reason))
+        if self.current() < old:
+            # Up to old requests were in flight and will still answer at the old rate
+            self.cooldown = old
+        self._reset()
+
+    def _reset(self):
+        self.samples = 0
+        self.throttled = None
+        self.latencies.clear()
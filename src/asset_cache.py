@@ -0,0 +1,136 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+from collections import namedtuple
+
+# Brotli is optional, without it assets are served gzip compressed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger('tile-server')
+
+# Types worth compressing, woff/woff2 fonts and images are compressed already
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml",
+                      "font/ttf", "font/otf", "application/vnd.ms-fontobject")
+
+# A UI file as loaded from disk: its body per content encoding ("identity", "gzip", "br")
+# and the matching ETag per encoding, so caches never mix up the representations
+Asset = namedtuple("Asset", ["path", "mtime", "size", "contentType", "cacheControl", "bodies", "etags"])
+
+
+class AssetCache:
+    """
+    In-memory cache of the web UI's static files.
+
+    Files are loaded on first request, compressed once with gzip (and brotli
+    when installed) and kept until their modification time or size changes
+    on disk, so editing the UI never needs a restart. HTML pages are always
+    revalidated, everything else may be reused for maxAge seconds; either
+    way the ETag lets browsers revalidate with a 304 instead of a download.
+    """
+
+    def __init__(self, root, maxAge=3600):
+        self.root = os.path.realpath(root)
+        self.maxAge = maxAge
+        self.assets = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, path):
+        """Absolute file path of a URL path, or None when it points outside the UI directory"""
+        file = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, file]) != self.root:
+            return None
+        return file
+
+    def get(self, path):
+        """Return the Asset of a URL path relative to the UI directory, or None when there is no such file"""
+        file = self.resolve(path)
+        if file is None:
+            return None
+
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+        if not os.path.isfile(file):
+            return None
+
+        asset = self.assets.get(file)
+        if asset is not None and asset.mtime == stat.st_mtime_ns and asset.size == stat.st_size:
+            return asset
+
+        with self.lock:
+            asset = self.assets.get(file)
+            if asset is None or asset.mtime != stat.st_mtime_ns or asset.size != stat.st_size:
+                asset = self.load(file, stat)
+                self.assets[file] = asset
+        return asset
+
+    def preload(self):
+        """Load and compress every file of the UI directory up front"""
+        count = 0
+        for directory, names, files in os.walk(self.root):
+            for name in files:
+                if self.get(os.path.relpath(os.path.join(directory, name), self.root)) is not None:
+                    count += 1
+        logger.info(f"Cached {count} UI assets from {self.root}")
+
+    def load(self, file, stat):
+        with open(file, "rb") as f:
+            content = f.read()
+
+        contentType = mimetypes.guess_type(file)[0] or "application/octet-stream"
+        if contentType.startswith("text/") or contentType == "application/javascript":
+            contentType += "; charset=utf-8"
+
+        if contentType.startswith("text/html"):
+            cacheControl = "no-cache"
+        else:
+            cacheControl = f"public, max-age={self.maxAge}"
+
+        bodies = {"identity": content}
+        if content and contentType.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(compressed) < len(content) * 0.9:
+                bodies["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(content)
+                if len(compressed) < len(content) * 0.9:
+                    bodies["br"] = compressed
+
+        digest = hashlib.sha1(content).hexdigest()[0:16]
+        etags = {encoding: f'"{digest}"' if encoding == "identity" else f'"{digest}-{encoding}"'
+                 for encoding in bodies}
+
+        return Asset(file, stat.st_mtime_ns, stat.st_size, contentType, cacheControl, bodies, etags)
+
+    @staticmethod
+    def encoding(asset, acceptEncoding):
+        """The best encoding of the asset the client accepts: br, gzip or identity"""
+        accepted = set()
+        for part in (acceptEncoding or "").split(","):
+            token, _, params = part.strip().partition(";")
+            params = params.replace(" ", "")
+            if token and params not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                accepted.add(token.lower())
+
+        for encoding in ("br", "gzip"):
+            if encoding in asset.bodies and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    @staticmethod
+    def notModified(asset, ifNoneMatch):
+        """Whether an If-None-Match header names any representation of the asset"""
+        if not ifNoneMatch:
+            return False
+        tags = [tag.strip() for tag in ifNoneMatch.split(",")]
+        if "*" in tags:
+            return True
+        tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+        return any(etag in tags for etag in asset.etags.values())
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+import asyncio
+import logging
+import random
+import time
+
+from utils import Utils
+from retry_queue import AttemptResult
+from tile_encoding import transcode_tile
+from blank_tiles import is_blank
+
+logger = logging.getLogger("tile-downloader")
+
+
+class DummyLock:
+    def acquire(self): pass
+    def release(self): pass
+
+
+async def fetch_tile(session, semaphore, url, x, y, z, max_retries=3, timeout=30, retry_delay=1):
+    """
+    Non-blocking counterpart of Utils.fetchTile. Follows the same retry and
+    backoff rules and result codes, and waits between attempts without
+    holding a thread. While the host's circuit is open the tile waits for
+    it without using up attempts, and once the circuit kept opening for
+    more than max_retries times it gives up with CIRCUIT_OPEN.
+
+    Returns (code, data, attempts made). A tile that runs out of attempts
+    keeps the code of its last attempt, 0 for timeouts, for the journal
+    """
+    import aiohttp
+
+    url = Utils.qualifyURL(url, x, y, z)
+    attempts = 0
+
+    while attempts < max_retries:
+        code = 0
+        retry_after = None
+        try:
+            logger.info(f"Downloading tile from {url} (attempt {attempts+1}/{max_retries})")
+
+            # Wait for the host's token bucket without holding a request slot
+            if Utils.rateLimiter is not None:
+                delay = Utils.rateLimiter.reserve(url)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            # Wait for the host's circuit to close again instead of burning attempts on it
+            if Utils.circuitBreaker is not None:
+                allowed, retry_in = Utils.circuitBreaker.allow(url)
+                if not allowed:
+                    if Utils.circuitBreaker.trips(url) > max_retries:
+                        logger.warning(f"Tile host circuit is open, giving up tile x={x}, y={y}, z={z} for this run")
+                        return Utils.CIRCUIT_OPEN, None, attempts
+                    logger.info(f"Tile host circuit is open, deferring tile x={x}, y={y}, z={z}")
+                    await asyncio.sleep(retry_in * random.uniform(1, 1.5))
+                    continue
+
+            async with semaphore:
+                started = time.monotonic()
+                observed = False
+                try:
+                    async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                        observed = True
+                        retry_after = Utils.parseRetryAfter(response.headers.get("Retry-After"))
+                        Utils.observeResponse(url, response.status, started, retry_after)
+                        code = response.status
+                        response.raise_for_status()  # Raise exception for 4XX/5XX responses
+                        data = await response.read()
+                except BaseException:
+                    # Any request that got no answer counts as a failure, which also frees a half-open probe
+                    if not observed:
+                        Utils.observeResponse(url, None, started)
+                    raise
+
+            # Verify we got actual content
+            if len(data) > 0:
+                return code, data, attempts + 1
+
+            logger.warning(f"Received empty response for tile at x={x}, y={y}, z={z}")
+            code = 204
+
+        except asyncio.TimeoutError:
+            logger.warning(f"Timeout while downloading tile at x={x}, y={y}, z={z}")
+            code = 0
+
+        except aiohttp.ClientResponseError as e:
+            if e.status == 404:
+                logger.warning(f"Tile not found (404): x={x}, y={y}, z={z}")
+            else:
+                logger.warning(f"HTTP error {e.status} for tile at x={x}, y={y}, z={z}")
+
+        except aiohttp.ClientError as e:
+            logger.warning(f"Error downloading tile: {str(e)}")
+            code = 0
+
+        except Exception as e:
+            logger.error(f"Unexpected error while downloading tile: {str(e)}")
+            code = 0
+
+        # A missing tile will stay missing
+        if not Utils.isRetryable(code):
+            return code, None, attempts + 1
+
+        # Increment attempts and apply exponential backoff
+        attempts += 1
+        if attempts < max_retries:
+            sleep_time = retry_delay * (2 ** (attempts - 1))
+            if retry_after is not None:
+                sleep_time = max(sleep_time, retry_after)  # The server knows better when to come back
+            logger.info(f"Retrying in {sleep_time} seconds...")
+            await asyncio.sleep(sleep_time)
+
+    logger.error(f"Failed to download tile after {max_retries} attempts: x={x}, y={y}, z={z}")
+    return code, None, attempts
+
+
+async def run_image_work(fn, *args):
+    """Run decoding, merging or encoding off the event loop, in the image stage when there is one"""
+    loop = asyncio.get_running_loop()
+    if Utils.imageStage is None:
+        return await loop.run_in_executor(None, fn, *args)
+
+    # Submitting waits while the image stage is full, so it happens on a worker thread
+    staged = await loop.run_in_executor(None, Utils.imageStage.submit, fn, *args)
+    return await asyncio.wrap_future(staged)
+
+
+async def fetch_tile_scaled(session, semaphore, url, x, y, z, outputScale=1, max_retries=3, timeout=30, retry_delay=1,
+                            tile_format=None, tile_quality=80):
+    """Non-blocking counterpart of Utils.downloadTileData, returns (code, data, attempts made)"""
+    if outputScale == 1:
+        code, data, attempts = await fetch_tile(session, semaphore, url, x, y, z, max_retries, timeout, retry_delay)
+        if code != 200 or not tile_format or tile_format == "original":
+            return code, data, attempts
+        return (*await run_image_work(transcode_tile, data, tile_format, tile_quality), attempts)
+
+    elif outputScale == 2:
+        results = await asyncio.gather(*[
+            fetch_tile(session, semaphore, url, childX, childY, childZ, max_retries, timeout, retry_delay)
+            for childX, childY, childZ in Utils.getChildTiles(x, y, z)
+        ])
+        attempts = max(attempts for code, data, attempts in results)
+
+        # A child given up on while its host's circuit was open defers the whole tile
+        if any(code == Utils.CIRCUIT_OPEN for code, data, attempts in results):
+            return Utils.CIRCUIT_OPEN, None, attempts
+
+        # Nothing to merge, report the child failure most worth retrying
+        failed = [code for code, data, attempts in results if code != 200]
+        if len(failed) == len(results):
+            retryable = [code for code in failed if Utils.isRetryable(code)]
+            return (retryable or failed)[0], None, attempts
+
+        childData = [data if code == 200 else None for code, data, attempts in results]
+        return (*await run_image_work(Utils.mergeChildTiles, childData, tile_format, tile_quality), attempts)
+
+    else:
+        logger.error(f"Unsupported output scale: {outputScale}")
+        return 400, None, 0  # Bad request
+
+
+async def download_tile(session, semaphore, args, get_tile_path, get_writer):
+    """Async counterpart of downloader.download_tile, returning the final AttemptResult"""
+    (x, y, z, url, output_dir, output_file, output_type, output_scale, verbose, max_retries, timeout, retry_delay,
+     check_existing, tile_format, tile_quality, blank_tiles) = args
+
+    loop = asyncio.get_running_loop()
+
+    result_code = None
+    attempts = None
+
+    def result(status, message):
+        return AttemptResult(message, False, None, status == "deferred", (x, y, z), status, result_code, attempts)
+
+    try:
+        file_path = get_tile_path(output_dir, output_file, x, y, z)
+
+        writer = get_writer(output_type)
+        if check_existing and await loop.run_in_executor(None, writer.exists, file_path, x, y, z):
+            return result("exists", f"Tile {x},{y},{z} already exists")
+
+        result_code, data, attempts = await fetch_tile_scaled(session, semaphore, url, x, y, z, output_scale,
+                                                    max_retries, timeout, retry_delay, tile_format, tile_quality)
+
+        if result_code == Utils.CIRCUIT_OPEN:
+            return result("deferred", f"Deferred tile {x},{y},{z}: tile host is failing, giving up for this run")
+
+        if result_code == 200 and data and blank_tiles != "keep" and await loop.run_in_executor(None, is_blank, data):
+            if blank_tiles == "reference":
+                await loop.run_in_executor(None, writer.addBlankTile, DummyLock(), file_path, data, x, y, z, output_scale)
+            return result("blank", f"Blank tile {x},{y},{z}" if verbose else None)
+
+        if result_code == 200 and data:
+            # Writers may touch the disk, so they run on a worker thread to never block the event loop
+            await loop.run_in_executor(None, writer.addTileData, DummyLock(), file_path, data, x, y, z, output_scale)
+
+            if verbose:
+                return result("downloaded", f"Downloaded tile {x},{y},{z}")
+            else:
+                return result("downloaded", None)
+        elif result_code == 200:
+            return result("failed", f"Error downloading tile {x},{y},{z}: Empty file downloaded")
+        else:
+            return result("failed", f"Failed to download tile {x},{y},{z} (code: {result_code}, attempts: {attempts})")
+
+    except (OSError, IOError) as e:
+        return result("failed", f"File error for tile {x},{y},{z}: {str(e)}")
+    except Exception as e:
+        return result("failed", f"Unexpected error for tile {x},{y},{z}: {str(e)}")
+
+
+async def download_all(download_args, concurrency, get_tile_path, get_writer, on_result, pool_size=None):
+    import aiohttp
+
+    # Bounds the number of HTTP requests in flight, including 2x child fetches
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=pool_size or concurrency, keepalive_timeout=60)
+
+    tiles = iter(download_args)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def worker():
+            for args in tiles:
+                on_result(await download_tile(session, semaphore, args, get_tile_path, get_writer))
+
+        # A fixed set of workers pulls from one iterator, so memory does not grow with the job size
+        await asyncio.gather(*[worker() for i in range(concurrency)])
+
+
+def run(download_args, concurrency, get_tile_path, get_writer, on_result, pool_size=None):
+    """Download every tile in download_args on an asyncio event loop"""
+    try:
+        import aiohttp
+    except ImportError:
+        raise RuntimeError("The async engine requires aiohttp, install it with: pip install aiohttp")
+
+    asyncio.run(download_all(download_args, concurrency, get_tile_path, get_writer, on_result, pool_size))
@@ -0,0 +1,70 @@
+import hashlib
+import io
+import threading
+
+from PIL import Image
+
+# What happens to a blank tile: stored like any other, not stored at all, or stored
+# as a reference to one shared copy of it
+BLANK_TILE_MODES = ("keep", "skip", "reference")
+
+# A single color tile compresses to a few kilobytes in any format, even 512px JPEGs
+# at high quality, so larger tiles are never decoded
+MAX_BLANK_SIZE = 8192
+
+# Verdicts of tiles checked before, by digest: providers send the same bytes for
+# every ocean or out-of-coverage tile, so those are only decoded once
+_verdicts = {}
+_verdictsLock = threading.Lock()
+_maxVerdicts = 4096
+
+
+def uniform_color(image):
+    """The RGBA color of an image made of one color, fully transparent images count as (0, 0, 0, 0), else None"""
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA")
+
+    extrema = image.getextrema()
+    if image.mode == "L":
+        extrema = (extrema,)
+
+    bands = image.getbands()
+    if "A" in bands and extrema[bands.index("A")] == (0, 0):
+        return (0, 0, 0, 0)
+
+    if any(low != high for low, high in extrema):
+        return None
+
+    color = [low for low, high in extrema]
+    if image.mode in ("L", "LA"):
+        color = [color[0]] * 3 + color[1:]
+    if len(color) == 3:
+        color.append(255)
+    return tuple(color)
+
+
+def is_blank(data):
+    """
+    Whether tile bytes are a fully transparent or single color image. Tiles
+    too large to be one are rejected by size, known bytes by their digest,
+    and only the rest is decoded
+    """
+    if not data or len(data) > MAX_BLANK_SIZE:
+        return False
+
+    digest = hashlib.md5(data).digest()
+    verdict = _verdicts.get(digest)
+    if verdict is not None:
+        return verdict
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            verdict = uniform_color(image) is not None
+    except Exception:
+        verdict = False
+
+    with _verdictsLock:
+        if len(_verdicts) >= _maxVerdicts:
+            _verdicts.clear()
+        _verdicts[digest] = verdict
+    return verdict
@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class Circuit:
+    """
+    Breaker state of one tile host.
+
+    Closed, it tracks the outcome of the last window requests and opens once
+    at least half of a window was seen and failureRatio of it failed. Open,
+    it rejects requests until openTime has passed, then lets probes trial
+    requests through (half-open). A successful probe closes it again, a
+    failed one reopens it for twice as long, up to maxOpenTime.
+    """
+
+    def __init__(self, failureRatio=0.5, window=20, openTime=30, maxOpenTime=300, probes=1):
+        self.failureRatio = failureRatio
+        self.window = max(1, int(window))
+        self.openTime = openTime
+        self.maxOpenTime = maxOpenTime
+        self.probes = max(1, int(probes))
+
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=self.window)
+        self.openUntil = 0.0
+        self.trips = 0  # Times opened since the host last recovered
+        self.probing = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Return (allowed, seconds until requests may be tried again)"""
+        with self.lock:
+            if self.state == OPEN:
+                remaining = self.openUntil - time.monotonic()
+                if remaining > 0:
+                    return False, remaining
+                self.state = HALF_OPEN
+                self.probing = 0
+
+            if self.state == HALF_OPEN:
+                if self.probing >= self.probes:
+                    return False, self.openTime / 10  # Check back once the probes had a chance to answer
+                self.probing += 1
+
+            return True, 0.0
+
+    def retryIn(self):
+        """Seconds until allow() may let a request through, without taking a probe"""
+        with self.lock:
+            if self.state == OPEN:
+                return max(0.0, self.openUntil - time.monotonic())
+            if self.state == HALF_OPEN and self.probing >= self.probes:
+                return self.openTime / 10
+            return 0.0
+
+    def record(self, success):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                if success:
+                    self.state = CLOSED
+                    self.trips = 0
+                    self.outcomes.clear()
+                else:
+                    self._open()
+                return
+
+            if self.state == OPEN:
+                return  # Answers to requests sent before the circuit opened
+
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) * 2 >= self.window and failures >= self.failureRatio * len(self.outcomes):
+                self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.openUntil = time.monotonic() + min(self.maxOpenTime, self.openTime * (2 ** self.trips))
+        self.trips += 1
+        self.outcomes.clear()
+
+
+class CircuitBreaker:
+    """One circuit per tile host, shared by every worker"""
+
+    def __init__(self, failureRatio=0.5, window=20, openTime=30, maxOpenTime=300, probes=1):
+        self.options = dict(failureRatio=failureRatio, window=window, openTime=openTime,
+                            maxOpenTime=maxOpenTime, probes=probes)
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def circuit(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            circuit = self.circuits.get(host)
+            if circuit is None:
+                circuit = self.circuits[host] = Circuit(**self.options)
+        return circuit
+
+    def allow(self, url):
+        return self.circuit(url).allow()
+
+    def record(self, url, success):
+        self.circuit(url).record(success)
+
+    def trips(self, url):
+        return self.circuit(url).trips
+
+    def retryIn(self, url):
+        return self.circuit(url).retryIn()
+
+    def openHosts(self):
+        with self.lock:
+            return [host for host, circuit in self.circuits.items() if circuit.state != CLOSED]
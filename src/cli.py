@@ -6,16 +6,25 @@ import sys
 import json
 import time
 import logging
-import math
+import itertools
 from urllib.parse import urlparse
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import logging.handlers
 
 from utils import Utils
-from file_writer import FileWriter
+from adaptive import AdaptiveConcurrency
+from retry_queue import RetryQueue
+from image_stage import StageStats
+from tile_encoding import TILE_FORMATS, metadata_format, output_file_for_format
+from blank_tiles import BLANK_TILE_MODES
 from mbtiles_writer import MbtilesWriter
-from repo_writer import RepoWriter
+from file_writer import FileWriter
+from tile_index import TileIndex
+from job_journal import JobJournal
+from pyramid import build_pyramid
+from downloader import (get_writer_by_type, count_tiles, geojson_polygon, geojson_bounds, count_polygon_tiles,
+                        calculate_tiles, static_output_file, get_tile_path, download_tile, run_bounded)
 
 # Configure logging
 def setup_logging(verbose=False, log_file=None):
@@ -81,170 +90,6 @@ def load_geojson(filename):
     except FileNotFoundError:
         raise argparse.ArgumentTypeError(f"GeoJSON file not found: {filename}")
 
-def get_writer_by_type(output_type):
-    """Return the appropriate writer class based on output type"""
-    if output_type == "mbtiles":
-        return MbtilesWriter
-    elif output_type == "repo":
-        return RepoWriter
-    else:  # default to directory
-        return FileWriter
-
-def calculate_tiles(min_lon, min_lat, max_lon, max_lat, min_zoom, max_zoom, geojson=None):
-    """Calculate tiles within bounds for all zoom levels"""
-    import shapely.geometry
-    from shapely.prepared import prep
-
-    all_tiles = []
-
-    # If we have a GeoJSON, create a shapely geometry from it
-    polygon = None
-    if geojson:
-        if geojson.get('type') == 'FeatureCollection':
-            features = geojson.get('features', [])
-            if not features:
-                raise ValueError("Empty FeatureCollection in GeoJSON")
-            # Use the first feature that's a polygon
-            for feature in features:
-                geom = feature.get('geometry', {})
-                if geom.get('type') in ('Polygon', 'MultiPolygon'):
-                    polygon = shapely.geometry.shape(geom)
-                    break
-            if polygon is None:
-                raise ValueError("No polygon/multipolygon found in GeoJSON features")
-        else:
-            geom = geojson.get('geometry', {})
-            if geom.get('type') in ('Polygon', 'MultiPolygon'):
-                polygon = shapely.geometry.shape(geom)
-            else:
-                raise ValueError("GeoJSON feature must have Polygon or MultiPolygon geometry")
-
-        # Create a prepared polygon for faster operations
-        prepared_polygon = prep(polygon)
-
-    # Helper functions to calculate tile coordinates
-    def lon_to_x(lon, zoom):
-        return int((lon + 180) / 360 * (2 ** zoom))
-
-    def lat_to_y(lat, zoom):
-        return int((1 - math.log(math.tan(math.radians(lat)) + 1 / math.cos(math.radians(lat))) / math.pi) / 2 * (2 ** zoom))
-
-    def x_to_lon(x, zoom):
-        return x / (2 ** zoom) * 360 - 180
-
-    def y_to_lat(y, zoom):
-        n = math.pi - 2 * math.pi * y / (2 ** zoom)
-        return math.degrees(math.atan(math.sinh(n)))
-
-    # Calculate tiles for each zoom level
-    for zoom in range(min_zoom, max_zoom + 1):
-        # Calculate tile boundaries
-        min_x = lon_to_x(min_lon, zoom)
-        max_x = lon_to_x(max_lon, zoom)
-        min_y = lat_to_y(max_lat, zoom)  # Note: y is inverted
-        max_y = lat_to_y(min_lat, zoom)
-
-        # Loop through all tiles in the bounding box
-        for y in range(min_y, max_y + 1):
-            for x in range(min_x, max_x + 1):
-                # If we have a polygon, check if the tile intersects it
-                if polygon:
-                    # Calculate the tile's bounding box
-                    tile_min_lon = x_to_lon(x, zoom)
-                    tile_max_lon = x_to_lon(x + 1, zoom)
-                    tile_min_lat = y_to_lat(y + 1, zoom)
-                    tile_max_lat = y_to_lat(y, zoom)
-
-                    # Create a polygon representing the tile
-                    tile_polygon = shapely.geometry.box(tile_min_lon, tile_min_lat, tile_max_lon, tile_max_lat)
-
-                    # Only add the tile if it intersects with our polygon
-                    if prepared_polygon.intersects(tile_polygon):
-                        all_tiles.append((x, y, zoom))
-                else:
-                    # Without a polygon, include all tiles in the bounding box
-                    all_tiles.append((x, y, zoom))
-
-    return all_tiles
-
-def download_tile(args):
-    """Download a single tile"""
-    x, y, z, url, output_dir, output_file, output_type, output_scale, verbose, max_retries, timeout, retry_delay = args
-
-    # Create a dummy lock for thread safety
-    class DummyLock:
-        def acquire(self): pass
-        def release(self): pass
-
-    dummy_lock = DummyLock()
-
-    try:
-        # Create the actual file path - prepend "output" to match server.py
-        file_path = os.path.join("output", output_dir, output_file)
-
-        # Replace template parameters
-        file_path = file_path.replace("{x}", str(x))
-        file_path = file_path.replace("{y}", str(y))
-        file_path = file_path.replace("{z}", str(z))
-        file_path = file_path.replace("{quad}", Utils.tileXYToQuadKey(x, y, z) if hasattr(Utils, 'tileXYToQuadKey') else "")
-
-        # Check if file already exists
-        writer = get_writer_by_type(output_type)
-        if writer.exists(file_path, x, y, z):
-            return f"Tile {x},{y},{z} already exists"
-
-        # Make sure temp directory exists before creating temp file
-        temp_dir = os.path.join("temp")
-        os.makedirs(temp_dir, exist_ok=True)
-
-        # Create a temporary file name
-        temp_file = os.path.join(temp_dir, Utils.randomString() + ".png")
-
-        # Download the tile with improved retry mechanism
-        result_code = Utils.downloadFileScaled(
-            url,
-            temp_file,
-            x, y, z,
-            output_scale,
-            max_retries=max_retries,
-            timeout=timeout,
-            retry_delay=retry_delay
-        )
-
-        # Check if download was successful AND file exists
-        if result_code == 200 and os.path.exists(temp_file) and os.path.getsize(temp_file) > 0:
-            # Add the tile to the output
-            writer.addTile(dummy_lock, file_path, temp_file, x, y, z, output_scale)
-
-            # Clean up the temp file
-            try:
-                os.remove(temp_file)
-            except (OSError, IOError) as e:
-                logger.warning(f"Failed to remove temp file {temp_file}: {str(e)}")
-                # Continue even if we couldn't delete the temp file
-
-            # Don't return verbose message when in quiet mode
-            if verbose:
-                return f"Downloaded tile {x},{y},{z}"
-            else:
-                return None
-        else:
-            # The file should exist if result_code is 200, so this is an error condition
-            if result_code == 200 and not os.path.exists(temp_file):
-                return f"Error downloading tile {x},{y},{z}: Temp file not created despite successful code"
-            elif result_code == 200 and os.path.getsize(temp_file) == 0:
-                return f"Error downloading tile {x},{y},{z}: Empty file downloaded"
-            else:
-                # Always return errors regardless of verbosity
-                return f"Failed to download tile {x},{y},{z} (code: {result_code})"
-
-    except (OSError, IOError) as e:
-        # Handle file system errors
-        return f"File error for tile {x},{y},{z}: {str(e)}"
-    except Exception as e:
-        # Catch any other errors to prevent the entire process from crashing
-        return f"Unexpected error for tile {x},{y},{z}: {str(e)}"
-
 def run_server(port=8080):
     """Run the web server"""
     from server import run
@@ -262,17 +107,29 @@ def main():
 
     # Download command
     download_parser = subparsers.add_parser('download', help='Download tiles directly')
-    download_parser.add_argument('--url', required=True, help='Tile URL template with {x}, {y}, {z}, or {quad} placeholders')
-    download_parser.add_argument('--output-dir', required=True, help='Output directory')
-    download_parser.add_argument('--min-zoom', type=int, required=True, help='Minimum zoom level')
-    download_parser.add_argument('--max-zoom', type=int, required=True, help='Maximum zoom level')
+    download_parser.add_argument('--url', help='Tile URL template with {x}, {y}, {z}, or {quad} placeholders')
+    download_parser.add_argument('--output-dir', help='Output directory')
+    download_parser.add_argument('--min-zoom', type=int, help='Minimum zoom level')
+    download_parser.add_argument('--max-zoom', type=int, help='Maximum zoom level')
     download_parser.add_argument('--threads', type=int, default=4, help='Number of parallel download threads')
+    download_parser.add_argument('--engine', choices=['thread', 'async'], default='thread',
+                      help='Download engine: a thread pool, or an asyncio event loop (requires aiohttp)')
+    download_parser.add_argument('--concurrency', type=int, default=256,
+                      help='Maximum requests in flight with --engine async (default: 256)')
     download_parser.add_argument('--output-type', choices=['directory', 'mbtiles', 'repo'], default='directory',
                       help='Output type (directory, mbtiles, or repo)')
     download_parser.add_argument('--output-file', default="{z}/{x}/{y}.png",
                       help='Output file pattern (for directory type) or filename (for mbtiles/repo)')
     download_parser.add_argument('--output-scale', type=int, choices=[1, 2], default=1,
                       help='Output scale (1x or 2x)')
+    download_parser.add_argument('--tile-format', choices=TILE_FORMATS, default='original',
+                      help='Store tiles as received (original), or convert them to optimized png, '
+                           'png8 with a 256 color palette, jpeg or webp (default: original)')
+    download_parser.add_argument('--tile-quality', type=int, default=80,
+                      help='Quality of jpeg and webp tiles, 1 to 100 (default: 80)')
+    download_parser.add_argument('--blank-tiles', choices=BLANK_TILE_MODES, default='keep',
+                      help='Fully transparent or single color tiles: keep them, skip them, or store them as '
+                           'references to one shared copy (default: keep)')
 
     # Add verbosity and log file options
     download_parser.add_argument('--verbose', '-v', action='store_true',
@@ -290,17 +147,79 @@ def main():
 
     # Add new CLI options
     download_parser.add_argument('--rate-limit-delay', type=float, default=0,
-                      help='Add delay between downloads in seconds (default: 0, try 0.1-0.5 for rate limited servers)')
-
-    # Either bounds or geojson must be specified
-    group = download_parser.add_mutually_exclusive_group(required=True)
+                      help='Minimum delay between requests to a tile host in seconds (default: 0, try 0.1-0.5 for rate limited servers)')
+    download_parser.add_argument('--rate-limit', type=float, default=0,
+                      help='Maximum requests per second to each tile host, across all threads and retries (default: 0, unlimited)')
+    download_parser.add_argument('--rate-limit-burst', type=int, default=1,
+                      help='Requests allowed in a burst above --rate-limit (default: 1)')
+
+    download_parser.add_argument('--breaker-failure-ratio', type=float, default=0.5,
+                      help='Stop requesting a tile host once this share of its recent requests failed, deferring its tiles (default: 0.5, 0 disables)')
+    download_parser.add_argument('--breaker-window', type=int, default=20,
+                      help='Recent requests per host the failure ratio is computed over (default: 20)')
+    download_parser.add_argument('--breaker-open-time', type=float, default=30,
+                      help='Seconds before a failing host is probed again, doubled after each failed probe up to 300 (default: 30)')
+
+    download_parser.add_argument('--adaptive', action='store_true',
+                      help='Adjust the number of tiles in flight to the server\'s latency and 429/503/timeout responses, starting at --threads')
+    download_parser.add_argument('--max-threads', type=int, default=64,
+                      help='Upper bound for --adaptive concurrency (default: 64)')
+
+    download_parser.add_argument('--pool-size', type=int, default=None,
+                      help='Keep-alive HTTP connections per tile host (default: same as --threads, x4 for --output-scale 2)')
+    download_parser.add_argument('--pool-hosts', type=int, default=10,
+                      help='Tile hosts whose connection pools are kept alive at once (default: 10)')
+    download_parser.add_argument('--composite-processes', type=int, default=None,
+                      help='Processes merging 2x tiles apart from the download threads '
+                           '(default: one per CPU with --output-scale 2, 0 merges in the download threads)')
+    download_parser.add_argument('--composite-queue', type=int, default=None,
+                      help='2x tiles waiting for or being merged before downloads wait for the merge processes '
+                           '(default: 4 per process)')
+
+    # MBTiles/repo write batching
+    download_parser.add_argument('--write-batch-size', type=int, default=None,
+                      help='Tiles committed per SQLite transaction for mbtiles/repo output (default: 500)')
+    download_parser.add_argument('--write-flush-interval', type=float, default=None,
+                      help='Maximum seconds a tile waits before its batch is committed (default: 1.0)')
+    download_parser.add_argument('--sqlite-synchronous', choices=['OFF', 'NORMAL', 'FULL'], default=None,
+                      help='SQLite synchronous mode for mbtiles/repo output (default: NORMAL)')
+    download_parser.add_argument('--sqlite-page-size', type=int, default=None,
+                      help='SQLite page size in bytes for new mbtiles/repo files (default: 4096)')
+    download_parser.add_argument('--pyramid', action='store_true',
+                      help='Download only --max-zoom and build every lower zoom from it locally, '
+                           'instead of fetching about a third more tiles from the server')
+    download_parser.add_argument('--pyramid-processes', type=int, default=None,
+                      help='Processes building the lower zooms with --pyramid (default: one per CPU)')
+    download_parser.add_argument('--dedupe', action='store_true',
+                      help='Store each distinct tile once, for areas full of identical tiles: mbtiles files use '
+                           'map/images tables, directories hardlink tiles to content-addressed blobs')
+
+    # Either bounds or geojson must be specified, unless the area comes from a journal
+    group = download_parser.add_mutually_exclusive_group()
     group.add_argument('--bounds', type=parse_bounds,
                       help='Bounding box as min_lon,min_lat,max_lon,max_lat')
     group.add_argument('--geojson', type=load_geojson,
                       help='GeoJSON file containing a polygon area to download')
 
+    # Every download keeps a journal in its output directory, which these continue from
+    journal_group = download_parser.add_mutually_exclusive_group()
+    journal_group.add_argument('--resume', metavar='OUTPUT_DIR',
+                      help='Continue the interrupted download of OUTPUT_DIR where its journal stopped, '
+                           'with the URL, area, zooms and output it was started with')
+    journal_group.add_argument('--retry-failed', metavar='OUTPUT_DIR',
+                      help='Download again only the tiles recorded as failed in the journal of OUTPUT_DIR')
+
     args = parser.parse_args()
 
+    if args.command == 'download' and not (args.resume or args.retry_failed):
+        missing = [option for option, value in (('--url', args.url), ('--output-dir', args.output_dir),
+                                                ('--min-zoom', args.min_zoom), ('--max-zoom', args.max_zoom))
+                   if value is None]
+        if missing:
+            download_parser.error(f"the following arguments are required: {', '.join(missing)}")
+        if args.bounds is None and args.geojson is None:
+            download_parser.error("one of the arguments --bounds --geojson is required")
+
     if args.command == 'server':
         run_server(args.port)
 
@@ -309,6 +228,12 @@ def main():
             # Setup logging based on verbosity
             logger = setup_logging(args.verbose, args.log_file)
 
+            # Resuming or retrying takes what to download from the journal of the earlier run
+            journal = None
+            if args.resume or args.retry_failed:
+                journal = JobJournal.load(args.resume or args.retry_failed)
+                journal.apply(args)
+
             # Create necessary directories - include the 'output' directory
             os.makedirs("temp", exist_ok=True)
             os.makedirs("output", exist_ok=True)  # Create base output directory
@@ -321,129 +246,309 @@ def main():
 
             dummy_lock = DummyLock()
 
+            MbtilesWriter.configure(
+                batchSize=args.write_batch_size,
+                flushInterval=args.write_flush_interval,
+                synchronous=args.sqlite_synchronous,
+                pageSize=args.sqlite_page_size,
+                dedupe=args.dedupe or None
+            )
+            FileWriter.configure(dedupe=args.dedupe or None)
+
+            # Adaptive concurrency may grow up to --max-threads downloads
+            adaptive = None
+            max_threads = args.threads
+            if args.adaptive and args.engine == 'thread':
+                max_threads = max(args.threads, args.max_threads)
+                adaptive = AdaptiveConcurrency(args.threads, maximum=max_threads)
+                Utils.responseObserver = adaptive.record
+            elif args.adaptive:
+                print("Warning: --adaptive only applies to the thread engine, use --concurrency with --engine async.")
+
+            # One pooled keep-alive connection per request in flight, 2x tiles fetch four children at once
+            Utils.configureSession(args.pool_size or max_threads * (4 if args.output_scale == 2 else 1), args.pool_hosts)
+            composite_processes = args.composite_processes
+            if composite_processes is None:
+                converting = args.output_scale == 2 or args.tile_format != 'original'
+                composite_processes = (os.cpu_count() or 1) if converting else 0
+            Utils.configureImageStage(composite_processes, args.composite_queue)
+
+            # A delay between requests is a rate limit of one request per delay
+            rate_limit = args.rate_limit
+            if not rate_limit and args.rate_limit_delay > 0:
+                rate_limit = 1 / args.rate_limit_delay
+            Utils.configureRateLimit(rate_limit, args.rate_limit_burst)
+            Utils.configureCircuitBreaker(args.breaker_failure_ratio, args.breaker_window, args.breaker_open_time)
+
             start_time = time.time()
-            print(f"Calculating tiles for zoom levels {args.min_zoom} to {args.max_zoom}...")
+
+            # A pyramid only downloads the highest zoom, the others are built from it afterwards
+            download_min_zoom = args.max_zoom if args.pyramid else args.min_zoom
+            print(f"Calculating tiles for zoom levels {download_min_zoom} to {args.max_zoom}...")
 
             # Calculate tiles based on bounds or geojson
             if args.bounds:
                 min_lon, min_lat, max_lon, max_lat = args.bounds
                 tiles = calculate_tiles(min_lon, min_lat, max_lon, max_lat,
-                                    args.min_zoom, args.max_zoom, None)
+                                    download_min_zoom, args.max_zoom, None)
+                total_tiles = count_tiles(min_lon, min_lat, max_lon, max_lat, download_min_zoom, args.max_zoom)
             else:
                 # Get bounds from geojson for metadata
-                from shapely.geometry import shape
-
-                if args.geojson.get('type') == 'FeatureCollection':
-                    # Use first feature with a geometry
-                    for feature in args.geojson.get('features', []):
-                        if feature.get('geometry'):
-                            geom = shape(feature['geometry'])
-                            min_lon, min_lat, max_lon, max_lat = geom.bounds
-                            break
-                else:
-                    geom = shape(args.geojson.get('geometry', {}))
-                    min_lon, min_lat, max_lon, max_lat = geom.bounds
+                min_lon, min_lat, max_lon, max_lat = geojson_bounds(args.geojson)
 
                 tiles = calculate_tiles(min_lon, min_lat, max_lon, max_lat,
-                                        args.min_zoom, args.max_zoom, args.geojson)
+                                        download_min_zoom, args.max_zoom, args.geojson)
+                total_tiles = count_polygon_tiles(geojson_polygon(args.geojson), min_lon, min_lat, max_lon, max_lat,
+                                                  download_min_zoom, args.max_zoom)
+
+            # Tiles handed out again before the enumeration continues: unfinished ones when resuming,
+            # the ledger's failed ones when retrying
+            requeued = []
+            completed = 0
+            if args.retry_failed:
+                requeued = list(journal.failedTiles())
+                journal.startRetrying()
+                tiles = iter(())
+                total_tiles = len(requeued)
+                print(f"Retrying {total_tiles} failed tiles of {args.output_dir}")
+            elif args.resume:
+                requeued = journal.requeued()
+                tiles = itertools.islice(tiles, journal.enumerated, None)
+                completed = journal.enumerated - len(requeued)
+                print(f"Resuming {args.output_dir}: {completed} of {total_tiles} tiles done, "
+                      f"{len(requeued)} unfinished tiles requeued")
+            else:
+                print(f"Found {total_tiles} tiles to download")
 
-            print(f"Found {len(tiles)} tiles to download")
+            # Initialize metadata, the database of mbtiles and repo outputs or metadata.json of directories
+            output_file = args.output_file
+            writer = get_writer_by_type(args.output_type)
+            center_lon = (min_lon + max_lon) / 2
+            center_lat = (min_lat + max_lat) / 2
+            center_zoom = (args.min_zoom + args.max_zoom) // 2
 
-            # Initialize metadata if using mbtiles or repo
             if args.output_type in ('mbtiles', 'repo'):
-                writer = get_writer_by_type(args.output_type)
-                center_lon = (min_lon + max_lon) / 2
-                center_lat = (min_lat + max_lat) / 2
-                center_zoom = (args.min_zoom + args.max_zoom) // 2
-
-                output_file = args.output_file
-                if "{x}" in output_file or "{y}" in output_file or "{z}" in output_file:
-                    if args.output_type == 'mbtiles':
-                        output_file = "tiles.mbtiles"
-                    else:
-                        output_file = "tiles.repo"
+                output_file = static_output_file(args.output_type, args.output_file)
+                if output_file != args.output_file:
                     print(f"Warning: Output file contains placeholders but {args.output_type} requires a static filename. Using {output_file}.")
+            else:
+                output_file = output_file_for_format(args.output_type, args.output_file, args.tile_format)
+                if output_file != args.output_file:
+                    print(f"Warning: Tiles are stored as {args.tile_format}, using {output_file} as the output file pattern.")
+
+            # Fix path to include 'output' directory prefix
+            output_path = os.path.join("output", args.output_dir)
+            full_path = os.path.join(output_path, output_file)
+
+            # Use dummy_lock instead of None
+            writer.addMetadata(dummy_lock, output_path, full_path, output_file,
+                            "Tile Downloader CLI", metadata_format(args.tile_format),
+                            [min_lon, min_lat, max_lon, max_lat],
+                            [center_lon, center_lat, center_zoom],
+                            args.min_zoom, args.max_zoom,
+                            "mercator", 256 * args.output_scale, args.blank_tiles)
+
+            # Load every tile that is already stored once, instead of probing storage per tile. A journal
+            # already knows what this download stored, so storage is only scanned again for tiles that
+            # were there before it started
+            writer = get_writer_by_type(args.output_type)
+            if journal is not None and (args.retry_failed or journal.existingTiles == 0):
+                existing = TileIndex()
+            else:
+                existing = writer.existingTiles(os.path.join("output", args.output_dir, output_file),
+                                                args.min_zoom, args.max_zoom)
+                if existing is not None and len(existing) > 0:
+                    print(f"{len(existing)} tiles already downloaded will be skipped")
+
+            if journal is None:
+                journal = JobJournal.create(args, None if existing is None else len(existing))
+
+            if args.engine == 'async':
+                print(f"Starting download with up to {args.concurrency} requests in flight...")
+            elif adaptive is not None:
+                print(f"Starting download with {args.threads} threads, adapting between 1 and {max_threads}...")
+            else:
+                print(f"Starting download with {args.threads} threads...")
+
+            # Use tqdm with better handling of external writes
+            progress_bar = tqdm(
+                total=total_tiles,
+                initial=completed,
+                dynamic_ncols=True,  # Adapt to terminal size changes
+                smoothing=0.1,       # Smoother progress updates
+                unit='tile',         # Show progress in 'tiles'
+                miniters=1,          # Update at least every iteration
+                position=0,          # Keep at position 0 (bottom)
+                leave=True           # Leave progress bar after completion
+            )
+
+            processed = 0
+            skipped = 0
+            deferred = 0
+            blank = 0
+
+            def report(result):
+                nonlocal processed, deferred, blank
+                processed += 1
+                progress_bar.update(1)
+                journal.record(result)
+
+                if result.deferred:
+                    deferred += 1
+                elif result.status == "blank":
+                    blank += 1
+
+                if adaptive is not None:
+                    for old, new, reason in adaptive.drainChanges():
+                        progress_bar.write(f"Concurrency {old} -> {new}: {reason}")
+                        progress_bar.set_postfix(concurrency=new, refresh=False)
+
+                message = result.message
+                if message:  # Only output if there's something to say
+                    if args.verbose:
+                        progress_bar.write(message)
+                    elif result.status in ("failed", "deferred"):  # Always show errors
+                        progress_bar.write(message)
+
+            def pending_downloads():
+                """Stream download arguments for every tile that is not stored yet"""
+                nonlocal skipped
+                for x, y, z in requeued:
+                    journal.issue((x, y, z), enumerated=False)
+                    yield (x, y, z, args.url, args.output_dir, output_file, args.output_type, args.output_scale,
+                           args.verbose, args.max_retries, args.timeout, args.retry_delay, False,
+                           args.tile_format, args.tile_quality, args.blank_tiles)
+
+                for x, y, z in tiles:
+                    if existing is not None and (x, y, z) in existing:
+                        skipped += 1
+                        progress_bar.update(1)
+                        journal.skip()
+                        continue
+
+                    journal.issue((x, y, z))
+                    yield (x, y, z, args.url, args.output_dir, output_file, args.output_type, args.output_scale,
+                           args.verbose, args.max_retries, args.timeout, args.retry_delay, existing is None,
+                           args.tile_format, args.tile_quality, args.blank_tiles)
+
+            download_args = pending_downloads()
+
+            # A checkpoint may only count tiles the writer has committed
+            if args.output_type in ('mbtiles', 'repo'):
+                journal.beforeSave = lambda: writer.flush(os.path.join("output", args.output_dir, output_file))
+
+            # How busy the download threads were, next to the image stage's processes
+            network_stage = StageStats(max_threads)
+
+            finished = False
+            try:
+                if args.engine == 'async':
+                    import async_engine
 
-                # Fix path to include 'output' directory prefix
-                output_path = os.path.join("output", args.output_dir)
-                full_path = os.path.join(output_path, output_file)
-
-                # Use dummy_lock instead of None
-                writer.addMetadata(dummy_lock, output_path, full_path, output_file,
-                                "Tile Downloader CLI", "png",
-                                [min_lon, min_lat, max_lon, max_lat],
-                                [center_lon, center_lat, center_zoom],
-                                args.min_zoom, args.max_zoom,
-                                "mercator", 256 * args.output_scale)
-
-            # Download tiles in parallel with rate limiting if specified
-            download_args = [
-                (x, y, z, args.url, args.output_dir, args.output_file, args.output_type, args.output_scale,
-                args.verbose, args.max_retries, args.timeout, args.retry_delay)
-                for x, y, z in tiles
-            ]
-
-            print(f"Starting download with {args.threads} threads...")
-            with ThreadPoolExecutor(max_workers=args.threads) as executor:
-                # Use tqdm with better handling of external writes
-                progress_bar = tqdm(
-                    total=len(download_args),
-                    dynamic_ncols=True,  # Adapt to terminal size changes
-                    smoothing=0.1,       # Smoother progress updates
-                    unit='tile',         # Show progress in 'tiles'
-                    miniters=1,          # Update at least every iteration
-                    position=0,          # Keep at position 0 (bottom)
-                    leave=True           # Leave progress bar after completion
-                )
-
-                try:
-                    # Implement rate limiting between downloads if specified
-                    if args.rate_limit_delay > 0:
-                        for i, result in enumerate(executor.map(download_tile, download_args)):
-                            progress_bar.update(1)
-                            if result:  # Only output if there's something to say
-                                if args.verbose:
-                                    progress_bar.write(result)
-                                elif "Failed" in result or "Error" in result:  # Always show errors
-                                    progress_bar.write(result)
-
-                            # Add delay between tile downloads to avoid rate limiting
-                            if i < len(download_args) - 1:  # Don't delay after the last download
-                                time.sleep(args.rate_limit_delay)
-                    else:
-                        # Process without delay
-                        for result in executor.map(download_tile, download_args):
-                            progress_bar.update(1)
-                            if result:  # Only output if there's something to say
-                                if args.verbose:
-                                    progress_bar.write(result)
-                                elif "Failed" in result or "Error" in result:  # Always show errors
-                                    progress_bar.write(result)
-                except Exception as e:
-                    progress_bar.write(f"Error in download process: {str(e)}")
-                    # Continue with cleanup even if there's an error
-
-                progress_bar.close()
+                    try:
+                        async_engine.run(download_args, args.concurrency, get_tile_path, get_writer_by_type, report,
+                                         args.pool_size)
+                        finished = True
+                    except Exception as e:
+                        progress_bar.write(f"Error in download process: {str(e)}")
+                        # Continue with cleanup even if there's an error
+
+                else:
+                    # Failed tiles wait in a retry queue instead of sleeping in a worker
+                    retries = RetryQueue(args.max_retries, args.retry_delay)
+                    download = network_stage.timed(download_tile)
+
+                    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+                        try:
+                            if adaptive is not None:
+                                progress_bar.set_postfix(concurrency=adaptive.current())
+                                run_bounded(executor, download, download_args, adaptive.current, report,
+                                            adaptive.pauseRemaining, retries)
+                            else:
+                                run_bounded(executor, download, download_args, args.threads * 2, report,
+                                            retries=retries)
+                            finished = True
+                        except Exception as e:
+                            progress_bar.write(f"Error in download process: {str(e)}")
+                            # Continue with cleanup even if there's an error
+            finally:
+                # Also on Ctrl+C, so --resume continues from here
+                failed = journal.close(finished)
+
+            progress_bar.close()
+            image_stats = Utils.imageStage.stats() if Utils.imageStage is not None else None
+            Utils.shutdownPools()
+            Utils.responseObserver = None
+
+            built = 0
+            if args.pyramid and finished and args.min_zoom < args.max_zoom:
+                print(f"Building zoom levels {args.min_zoom} to {args.max_zoom - 1} from zoom {args.max_zoom}...")
+                pyramid_start = time.time()
+                pyramid_bar = tqdm(dynamic_ncols=True, unit='tile')
+
+                def store_built(result):
+                    nonlocal built
+                    for x, y, z, data in result:
+                        writer.addTileData(dummy_lock, get_tile_path(args.output_dir, output_file, x, y, z),
+                                           data, x, y, z, args.output_scale)
+                    built += len(result)
+                    pyramid_bar.update(len(result))
+
+                def flush_writer():
+                    if args.output_type in ('mbtiles', 'repo'):
+                        writer.flush(os.path.join("output", args.output_dir, output_file))
+
+                processes = args.pyramid_processes or os.cpu_count() or 1
+                with ProcessPoolExecutor(max_workers=processes) as pyramid_executor:
+                    build_pyramid(pyramid_executor, processes * 2, args.output_type, args.output_dir, output_file,
+                                  min_lon, min_lat, max_lon, max_lat, args.min_zoom, args.max_zoom, args.geojson,
+                                  store_built, flush_writer, args.tile_format, args.tile_quality)
+                pyramid_bar.close()
+                print(f"Built {built} tiles in {time.time() - pyramid_start:.2f} seconds with {processes} processes")
 
             # Finalize metadata
-            if args.output_type in ('mbtiles', 'repo'):
-                writer = get_writer_by_type(args.output_type)
-                output_file = args.output_file
-                if "{x}" in output_file or "{y}" in output_file or "{z}" in output_file:
-                    if args.output_type == 'mbtiles':
-                        output_file = "tiles.mbtiles"
-                    else:
-                        output_file = "tiles.repo"
+            writer = get_writer_by_type(args.output_type)
+
+            # Fix path to include 'output' directory prefix
+            output_path = os.path.join("output", args.output_dir)
+            full_path = os.path.join(output_path, output_file)
 
-                # Fix path to include 'output' directory prefix
-                output_path = os.path.join("output", args.output_dir)
-                full_path = os.path.join(output_path, output_file)
+            # Asked before closing, which forgets the output's layout
+            shares_blank_tiles = writer.sharesBlankTiles(output_path, full_path)
 
-                # Use dummy_lock instead of None
-                writer.close(dummy_lock, output_path, full_path, args.min_zoom, args.max_zoom)
+            # Use dummy_lock instead of None
+            writer.close(dummy_lock, output_path, full_path, args.min_zoom, args.max_zoom)
 
             elapsed = time.time() - start_time
-            print(f"Download complete! {len(tiles)} tiles downloaded in {elapsed:.2f} seconds")
+            print(f"Download complete! {processed} tiles processed in {elapsed:.2f} seconds")
+            if skipped:
+                print(f"Skipped {skipped} tiles that were already downloaded")
+            if deferred:
+                print(f"Deferred {deferred} tiles while their host was failing")
+            if blank and args.blank_tiles == 'skip':
+                print(f"Skipped {blank} blank tiles")
+            elif blank and shares_blank_tiles:
+                print(f"Stored {blank} blank tiles as references to a shared copy")
+            elif blank and args.output_type != 'repo':
+                print(f"Stored {blank} blank tiles in full, {full_path} cannot share them")
+            elif blank:
+                print(f"Found {blank} blank tiles")
+            if failed:
+                print(f"{failed} failed tiles are recorded in {journal.path('failed.tsv')}, "
+                      f"download them again with: download --retry-failed {args.output_dir}")
+
+            if args.engine == 'thread':
+                stats = Utils.connectionStats()
+                print(f"HTTP connections: {stats['opened']} opened, {stats['reused']} reused for {stats['requests']} requests")
+                stats = network_stage.stats()
+                message = f"Network stage: {stats['workers']} threads, {stats['utilization']:.0%} busy"
+                if image_stats is not None and image_stats['blocked']:
+                    message += f", {network_stage.share(image_stats['blocked']):.0%} waiting for the image stage"
+                print(message)
+            if image_stats is not None and image_stats['tasks']:
+                print(f"Image stage: {image_stats['workers']} processes, {image_stats['utilization']:.0%} busy "
+                      f"processing {image_stats['tasks']} tiles, queue peak {image_stats['peak']} of {image_stats['size']}, "
+                      f"downloads waited {image_stats['blocked']:.1f} seconds for the queue")
 
         except Exception as e:
             print(f"Error during download process: {str(e)}")
@@ -8,6 +8,9 @@ TEMP_DIR = "temp"
 OUTPUT_DIR = "output"
 UI_DIR = "./UI/"
 
+# Seconds browsers may reuse UI scripts, styles and fonts before revalidating them, HTML is always revalidated
+STATIC_MAX_AGE = int(os.environ.get("TILE_DOWNLOADER_STATIC_MAX_AGE", 3600))
+
 # Default parameters
 DEFAULT_TILE_FORMAT = "png"
 DEFAULT_PROFILE = "mercator"
@@ -16,3 +19,57 @@ DEFAULT_OUTPUT_SCALE = 1
 
 # Request timeouts (seconds)
 DOWNLOAD_TIMEOUT = 30
+
+# Stored tiles served by /tiles: megabytes of hot tiles kept in memory, read-only
+# connections kept open per database and seconds clients may reuse a tile
+TILE_CACHE_SIZE = int(os.environ.get("TILE_DOWNLOADER_TILE_CACHE_SIZE", 64))
+TILE_READ_CONNECTIONS = int(os.environ.get("TILE_DOWNLOADER_TILE_READ_CONNECTIONS", 8))
+TILE_MAX_AGE = int(os.environ.get("TILE_DOWNLOADER_TILE_MAX_AGE", 60))
+
+# Download threads of each server-side download job, unless the job asks for another number
+JOB_THREADS = int(os.environ.get("TILE_DOWNLOADER_JOB_THREADS", 16))
+
+# Most download threads a job may ask for
+MAX_JOB_THREADS = int(os.environ.get("TILE_DOWNLOADER_MAX_JOB_THREADS", 64))
+
+# Finished, cancelled or failed jobs are forgotten after this many seconds, or once more than MAX_JOBS are kept
+JOB_TTL = int(os.environ.get("TILE_DOWNLOADER_JOB_TTL", 3600))
+MAX_JOBS = int(os.environ.get("TILE_DOWNLOADER_MAX_JOBS", 100))
+
+# Keep-alive HTTP connections per tile host
+HTTP_POOL_SIZE = int(os.environ.get("TILE_DOWNLOADER_POOL_SIZE", 16))
+
+# Tile hosts whose connection pools are kept at once, the least recently used one is closed beyond that
+HTTP_POOL_HOSTS = int(os.environ.get("TILE_DOWNLOADER_POOL_HOSTS", 10))
+
+# Requests per second allowed to each tile host, 0 disables the limit
+RATE_LIMIT = float(os.environ.get("TILE_DOWNLOADER_RATE_LIMIT", 0))
+RATE_LIMIT_BURST = int(os.environ.get("TILE_DOWNLOADER_RATE_LIMIT_BURST", 1))
+
+# Per-host circuit breaker: share of the last BREAKER_WINDOW requests that must fail
+# to stop requesting a host for BREAKER_OPEN_TIME seconds, 0 disables it
+BREAKER_FAILURE_RATIO = float(os.environ.get("TILE_DOWNLOADER_BREAKER_FAILURE_RATIO", 0.5))
+BREAKER_WINDOW = int(os.environ.get("TILE_DOWNLOADER_BREAKER_WINDOW", 20))
+BREAKER_OPEN_TIME = float(os.environ.get("TILE_DOWNLOADER_BREAKER_OPEN_TIME", 30))
+
+# Processes merging 2x tiles apart from the download threads, 0 merges in the download threads,
+# and the 2x tiles they may have queued before downloads wait for them (0: 4 per process)
+COMPOSITE_PROCESSES = int(os.environ.get("TILE_DOWNLOADER_COMPOSITE_PROCESSES", 0))
+COMPOSITE_QUEUE = int(os.environ.get("TILE_DOWNLOADER_COMPOSITE_QUEUE", 0))
+
+# MBTiles/repo write batching
+SQLITE_BATCH_SIZE = int(os.environ.get("TILE_DOWNLOADER_BATCH_SIZE", 500))
+SQLITE_FLUSH_INTERVAL = float(os.environ.get("TILE_DOWNLOADER_FLUSH_INTERVAL", 1.0))  # seconds
+SQLITE_SYNCHRONOUS = os.environ.get("TILE_DOWNLOADER_SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_PAGE_SIZE = int(os.environ.get("TILE_DOWNLOADER_SQLITE_PAGE_SIZE", 4096))
+
+# Store each distinct image once: new MBTiles files get map/images tables with a tiles view,
+# directory outputs hardlink every tile to a content-addressed blob
+DEDUPE = os.environ.get("TILE_DOWNLOADER_DEDUPE", "0").lower() in ("1", "true", "yes")
+
+# Digests of recently stored tiles remembered per deduplicated output, older ones are looked up in storage again
+DEDUPE_CACHE_SIZE = int(os.environ.get("TILE_DOWNLOADER_DEDUPE_CACHE_SIZE", 100000))
+
+# Fully transparent or single color tiles of server-side downloads: keep them, skip them, or store
+# them as references to one shared copy (hardlinks in directories, the deduplicated MBTiles layout)
+BLANK_TILES = os.environ.get("TILE_DOWNLOADER_BLANK_TILES", "keep").lower()
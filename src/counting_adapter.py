@@ -0,0 +1,64 @@
+import threading
+
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class ConnectionCounter:
+    """
+    Connections opened and requests sent through the adapters sharing it.
+    The counts live outside urllib3's pools, so they survive pools being
+    evicted and sessions being replaced
+    """
+
+    def __init__(self):
+        self.opened = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def countOpened(self):
+        with self.lock:
+            self.opened += 1
+
+    def countRequest(self):
+        with self.lock:
+            self.requests += 1
+
+    def stats(self):
+        # Every request is sent on one connection, either a new one or one kept alive
+        with self.lock:
+            return {
+                "opened": self.opened,
+                "requests": self.requests,
+                "reused": max(0, self.requests - self.opened),
+            }
+
+
+def counting_pool_class(poolClass, counter):
+    """A subclass of a urllib3 connection pool whose connections count every time they connect"""
+
+    class CountingConnection(poolClass.ConnectionCls):
+        def connect(self):
+            super().connect()
+            counter.countOpened()
+
+    return type("Counting" + poolClass.__name__, (poolClass,), {"ConnectionCls": CountingConnection})
+
+
+class CountingAdapter(HTTPAdapter):
+    """HTTPAdapter reporting the connections it opens and the requests it sends to a ConnectionCounter"""
+
+    def __init__(self, counter, **kwargs):
+        self.counter = counter
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": counting_pool_class(HTTPConnectionPool, self.counter),
+            "https": counting_pool_class(HTTPSConnectionPool, self.counter),
+        }
+
+    def send(self, request, **kwargs):
+        self.counter.countRequest()
+        return super().send(request, **kwargs)
@@ -0,0 +1,33 @@
+from collections import OrderedDict
+
+
+class DigestCache:
+    """
+    The most recently seen tile digests of a deduplicated output, each with
+    a small value, bounded by their number. A digest that dropped out is
+    only stored again the slow way, never wrongly, so memory stays constant
+    however many distinct tiles a run writes. Not thread-safe, the writers
+    hold their own lock around it
+    """
+
+    def __init__(self, maxSize):
+        self.maxSize = max(1, int(maxSize))
+        self.entries = OrderedDict()
+
+    def __contains__(self, digest):
+        return self.get(digest) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, digest):
+        value = self.entries.get(digest)
+        if value is not None:
+            self.entries.move_to_end(digest)
+        return value
+
+    def put(self, digest, value=True):
+        self.entries[digest] = value
+        self.entries.move_to_end(digest)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
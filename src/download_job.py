@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from retry_queue import RetryQueue
+from downloader import (get_writer_by_type, count_tiles, geojson_polygon, geojson_bounds, count_polygon_tiles,
+                        calculate_tiles, static_output_file, download_tile, run_bounded)
+from tile_encoding import metadata_format, output_file_for_format, parse_tile_format
+from blank_tiles import BLANK_TILE_MODES
+import config
+
+logger = logging.getLogger('tile-server')
+
+PENDING = "pending"
+RUNNING = "running"
+PAUSED = "paused"
+CANCELLED = "cancelled"
+FINISHED = "finished"
+FAILED = "failed"
+
+
+class DownloadJob:
+    """
+    A whole download run by the server with the CLI's download logic.
+
+    Tile results and state changes are appended to a bounded event log that
+    Server-Sent Events streams read from with their own cursor, so any number
+    of clients can follow a job, reconnect, or leave without affecting it.
+    """
+
+    # Tile events kept for clients that reconnect, older ones are only reflected in the counters
+    maxEvents = 1000
+
+    def __init__(self, params, lock, threads=16, maxRetries=5, timeout=30, retryDelay=1):
+        self.id = uuid.uuid4().hex[0:8]
+        self.lock = lock
+        self.createdAt = time.time()
+
+        self.source = str(params['source'])
+        self.minZoom = int(params['minZoom'])
+        self.maxZoom = int(params['maxZoom'])
+        self.outputType = str(params.get('outputType', 'directory'))
+        self.outputScale = int(params.get('outputScale', 1))
+        self.tileFormat = parse_tile_format(params.get('tileFormat'))
+        self.tileQuality = int(params.get('tileQuality', 80))
+        self.blankTiles = str(params.get('blankTiles', config.BLANK_TILES)).lower()
+        if self.blankTiles not in BLANK_TILE_MODES:
+            raise ValueError(f"Unknown blankTiles {self.blankTiles}, expected one of {', '.join(BLANK_TILE_MODES)}")
+        self.threads = min(max(1, int(params.get('threads', threads))), max(1, config.MAX_JOB_THREADS))
+        self.maxRetries = int(params.get('maxRetries', maxRetries))
+        self.timeout = timeout
+        self.retryDelay = retryDelay
+
+        # Geometry is a GeoJSON Feature, FeatureCollection or bare geometry, bounds a [west, south, east, north] list
+        geometry = params.get('geometry')
+        if geometry is not None and geometry.get('type') not in ('Feature', 'FeatureCollection'):
+            geometry = {"type": "Feature", "geometry": geometry}
+        self.geojson = geometry
+
+        if self.geojson is not None:
+            self.bounds = list(geojson_bounds(self.geojson))
+        else:
+            self.bounds = [float(value) for value in params['bounds']]
+
+        # The {timestamp} placeholder is resolved once, so every tile of the job lands in the same place
+        timestamp = str(int(params.get('timestamp', self.createdAt * 1000)))
+        self.outputDirectory = str(params.get('outputDirectory', '{timestamp}')).replace("{timestamp}", timestamp)
+        self.outputFile = static_output_file(self.outputType,
+                                             str(params.get('outputFile', '{z}/{x}/{y}.png')).replace("{timestamp}", timestamp))
+        self.outputFile = output_file_for_format(self.outputType, self.outputFile, self.tileFormat)
+
+        self.state = PENDING
+        self.error = None
+        self.total = None
+        self.counts = {"downloaded": 0, "exists": 0, "skipped": 0, "blank": 0, "failed": 0, "deferred": 0}
+        self.startedAt = None
+        self.finishedAt = None
+        self.pausedFor = 0.0
+        self.pausedAt = None
+        self.rateSamples = deque(maxlen=10)
+
+        self.events = deque(maxlen=self.maxEvents)
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.cancelled = False
+        self.retries = RetryQueue(self.maxRetries, self.retryDelay)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"job-{self.id}", daemon=True)
+        self.thread.start()
+
+    def pause(self):
+        with self.condition:
+            if self.state == RUNNING:
+                self.resumed.clear()
+                self.pausedAt = time.monotonic()
+                self.setState(PAUSED)
+
+    def resume(self):
+        with self.condition:
+            if self.state == PAUSED:
+                self.pausedFor += time.monotonic() - self.pausedAt
+                self.pausedAt = None
+                self.setState(RUNNING)
+                self.resumed.set()
+
+    def cancel(self):
+        with self.condition:
+            if self.state in (PENDING, RUNNING, PAUSED):
+                if self.pausedAt is not None:
+                    self.pausedFor += time.monotonic() - self.pausedAt
+                    self.pausedAt = None
+                self.cancelled = True
+                self.retries.clear()
+                self.resumed.set()
+
+                # A running job turns cancelled once its downloads stopped and its output is closed
+                if self.state == PENDING:
+                    self.finishedAt = time.monotonic()
+                    self.setState(CANCELLED)
+
+    def isDone(self):
+        return self.state in (CANCELLED, FINISHED, FAILED)
+
+    def pauseDelay(self):
+        """Seconds run_bounded holds back new tiles, as long as the job is paused"""
+        if self.cancelled or self.resumed.is_set():
+            return 0
+        return 0.25
+
+    def setState(self, state):
+        self.state = state
+        self.addEvent("state", {"state": state})
+
+    def addEvent(self, kind, data):
+        with self.condition:
+            self.sequence += 1
+            self.events.append((self.sequence, kind, data))
+            self.condition.notify_all()
+
+    def eventsSince(self, cursor, timeout=None):
+        """Wait up to timeout for events after cursor, returns (events, new cursor)"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > cursor or self.isDone(), timeout)
+            events = [event for event in self.events if event[0] > cursor]
+            return events, self.sequence
+
+    def onResult(self, result):
+        with self.condition:
+            self.counts[result.status] = self.counts.get(result.status, 0) + 1
+
+        x, y, z = result.tile
+        self.addEvent("tile", {"x": x, "y": y, "z": z, "status": result.status, "message": result.message})
+
+    def snapshot(self):
+        """Progress counters, state and recent throughput in tiles per second"""
+        with self.condition:
+            counts = dict(self.counts)
+            done = sum(counts.values())
+
+            now = time.monotonic()
+            if not self.rateSamples or now - self.rateSamples[-1][0] >= 0.5:
+                self.rateSamples.append((now, done))
+            oldest, oldestDone = self.rateSamples[0]
+            rate = (done - oldestDone) / (now - oldest) if now > oldest else 0.0
+
+            elapsed = 0.0
+            if self.startedAt is not None:
+                end = self.finishedAt or now
+                pausedFor = self.pausedFor + (now - self.pausedAt if self.pausedAt is not None else 0)
+                elapsed = max(0.0, end - self.startedAt - pausedFor)
+
+            return {
+                "id": self.id,
+                "state": self.state,
+                "error": self.error,
+                "total": self.total,
+                "done": done,
+                **counts,
+                "rate": round(rate, 1),
+                "elapsed": round(elapsed, 1),
+                "outputType": self.outputType,
+                "outputDirectory": self.outputDirectory,
+                "outputFile": self.outputFile,
+                "tileFormat": self.tileFormat,
+            }
+
+    def run(self):
+        min_lon, min_lat, max_lon, max_lat = self.bounds
+
+        try:
+            with self.condition:
+                if self.cancelled:
+                    return
+                self.startedAt = time.monotonic()
+                self.setState(RUNNING)
+
+            if self.geojson is not None:
+                tiles = calculate_tiles(min_lon, min_lat, max_lon, max_lat, self.minZoom, self.maxZoom, self.geojson)
+                self.total = count_polygon_tiles(geojson_polygon(self.geojson), min_lon, min_lat, max_lon, max_lat,
+                                                 self.minZoom, self.maxZoom)
+            else:
+                tiles = calculate_tiles(min_lon, min_lat, max_lon, max_lat, self.minZoom, self.maxZoom)
+                self.total = count_tiles(min_lon, min_lat, max_lon, max_lat, self.minZoom, self.maxZoom)
+
+            writer = get_writer_by_type(self.outputType)
+            outputPath = os.path.join("output", self.outputDirectory)
+            filePath = os.path.join(outputPath, self.outputFile)
+
+            center = [(min_lon + max_lon) / 2, (min_lat + max_lat) / 2, self.maxZoom]
+            writer.addMetadata(self.lock, outputPath, filePath, self.outputFile, "Map Tiles Downloader via AliFlux",
+                               metadata_format(self.tileFormat),
+                               self.bounds, center, self.minZoom, self.maxZoom, "mercator", 256 * self.outputScale,
+                               self.blankTiles)
+
+            existing = writer.existingTiles(filePath, self.minZoom, self.maxZoom)
+
+            def pending_downloads():
+                for x, y, z in tiles:
+                    if self.cancelled:
+                        return
+                    if existing is not None and (x, y, z) in existing:
+                        with self.condition:
+                            self.counts["skipped"] += 1
+                        continue
+
+                    yield (x, y, z, self.source, self.outputDirectory, self.outputFile, self.outputType,
+                           self.outputScale, False, self.maxRetries, self.timeout, self.retryDelay, existing is None,
+                           self.tileFormat, self.tileQuality, self.blankTiles)
+
+            with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix=f"job-{self.id}") as executor:
+                run_bounded(executor, download_tile, pending_downloads(), self.threads * 2, self.onResult,
+                            self.pauseDelay, self.retries, lambda: self.cancelled)
+
+            writer.close(self.lock, outputPath, filePath, self.minZoom, self.maxZoom)
+
+            with self.condition:
+                self.finishedAt = time.monotonic()
+                self.setState(CANCELLED if self.cancelled else FINISHED)
+
+        except Exception as e:
+            logger.error(f"Download job {self.id} failed: {str(e)}", exc_info=True)
+            with self.condition:
+                self.error = str(e)
+                self.finishedAt = time.monotonic()
+                self.setState(FAILED)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+"""
+Tile enumeration and download scheduling shared by the CLI and the web
+server's download jobs.
+"""
+
+import os
+import time
+import numpy as np
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+from utils import Utils
+import tile_math
+from retry_queue import AttemptResult
+from blank_tiles import is_blank
+from file_writer import FileWriter
+from mbtiles_writer import MbtilesWriter
+from repo_writer import RepoWriter
+
+def get_writer_by_type(output_type):
+    """Return the appropriate writer class based on output type"""
+    if output_type == "mbtiles":
+        return MbtilesWriter
+    elif output_type == "repo":
+        return RepoWriter
+    else:  # default to directory
+        return FileWriter
+
+def count_tiles(min_lon, min_lat, max_lon, max_lat, min_zoom, max_zoom):
+    """Count the tiles within bounds for all zoom levels without enumerating them"""
+    zooms = np.arange(min_zoom, max_zoom + 1)
+    return int(tile_math.tile_counts(min_lon, min_lat, max_lon, max_lat, zooms).sum())
+
+def geojson_polygon(geojson):
+    """Return the shapely polygon of a GeoJSON Feature, or of the first polygon in a FeatureCollection"""
+    import shapely.geometry
+
+    polygon = None
+    if geojson.get('type') == 'FeatureCollection':
+        features = geojson.get('features', [])
+        if not features:
+            raise ValueError("Empty FeatureCollection in GeoJSON")
+        # Use the first feature that's a polygon
+        for feature in features:
+            geom = feature.get('geometry', {})
+            if geom.get('type') in ('Polygon', 'MultiPolygon'):
+                polygon = shapely.geometry.shape(geom)
+                break
+        if polygon is None:
+            raise ValueError("No polygon/multipolygon found in GeoJSON features")
+    else:
+        geom = geojson.get('geometry', {})
+        if geom.get('type') in ('Polygon', 'MultiPolygon'):
+            polygon = shapely.geometry.shape(geom)
+        else:
+            raise ValueError("GeoJSON feature must have Polygon or MultiPolygon geometry")
+
+    return polygon
+
+def cover_polygon(polygon, min_lon, min_lat, max_lon, max_lat, min_zoom, max_zoom):
+    """
+    Quadtree coverage of a polygon. Yields (zoom, boundary, blocks) for each
+    zoom from min_zoom to max_zoom, where boundary holds (xs, ys) arrays of the
+    tiles crossing the polygon's edge and blocks lists (min_x, max_x, min_y,
+    max_y) ranges of tiles lying entirely inside it.
+
+    A tile is tested once: disjoint tiles are pruned with all their
+    descendants, contained tiles contribute all their descendants wholesale,
+    and only boundary tiles are subdivided, so the work follows the length of
+    the polygon's edge rather than the area of its bounding box. Each zoom
+    level is classified in one vectorized shapely call.
+    """
+    import shapely
+
+    shapely.prepare(polygon)
+
+    zooms = np.arange(0, max_zoom + 1)
+    ranges_min_x, ranges_max_x, ranges_min_y, ranges_max_y = tile_math.tile_ranges(min_lon, min_lat, max_lon, max_lat, zooms)
+
+    xs = np.zeros(1, dtype=np.int64)
+    ys = np.zeros(1, dtype=np.int64)
+    contained = []  # (xs, ys, zoom) of tiles found inside the polygon
+
+    for zoom in range(0, max_zoom + 1):
+        min_x, max_x = int(ranges_min_x[zoom]), int(ranges_max_x[zoom])
+        min_y, max_y = int(ranges_min_y[zoom]), int(ranges_max_y[zoom])
+
+        # Children of tiles outside the range are outside the next range too
+        in_range = (xs >= min_x) & (xs <= max_x) & (ys >= min_y) & (ys <= max_y)
+        xs, ys = xs[in_range], ys[in_range]
+
+        boxes = shapely.box(*tile_math.tile_bounds(xs, ys, zoom))
+        intersects = shapely.intersects(polygon, boxes)
+        inside = intersects & shapely.contains(polygon, boxes)
+        on_edge = intersects & ~inside
+
+        if inside.any():
+            contained.append((xs[inside], ys[inside], zoom))
+        xs, ys = xs[on_edge], ys[on_edge]
+
+        if zoom >= min_zoom:
+            blocks = []
+            for contained_xs, contained_ys, z in contained:
+                shift = zoom - z
+                block_min_x = np.maximum(contained_xs << shift, min_x)
+                block_max_x = np.minimum(((contained_xs + 1) << shift) - 1, max_x)
+                block_min_y = np.maximum(contained_ys << shift, min_y)
+                block_max_y = np.minimum(((contained_ys + 1) << shift) - 1, max_y)
+                valid = (block_min_x <= block_max_x) & (block_min_y <= block_max_y)
+                blocks.extend(zip(block_min_x[valid].tolist(), block_max_x[valid].tolist(),
+                                  block_min_y[valid].tolist(), block_max_y[valid].tolist()))
+
+            yield zoom, (xs, ys), blocks
+
+        xs, ys = tile_math.child_tiles(xs, ys)
+
+def count_polygon_tiles(polygon, min_lon, min_lat, max_lon, max_lat, min_zoom, max_zoom):
+    """Count the tiles intersecting a polygon without enumerating the ones inside it"""
+    total = 0
+    for zoom, boundary, blocks in cover_polygon(polygon, min_lon, min_lat, max_lon, max_lat, min_zoom, max_zoom):
+        total += len(boundary[0])
+        total += sum((block[1] - block[0] + 1) * (block[3] - block[2] + 1) for block in blocks)
+    return total
+
+def calculate_tiles(min_lon, min_lat, max_lon, max_lat, min_zoom, max_zoom, geojson=None):
+    """
+    Lazily generate the (x, y, zoom) tiles within bounds for all zoom levels,
+    so jobs of any size can start downloading without materializing the list
+    """
+    if geojson:
+        polygon = geojson_polygon(geojson)
+
+        for zoom, boundary, blocks in cover_polygon(polygon, min_lon, min_lat, max_lon, max_lat, min_zoom, max_zoom):
+            boundary_xs, boundary_ys = boundary
+            for x, y in zip(boundary_xs.tolist(), boundary_ys.tolist()):
+                yield (x, y, zoom)
+            for block in blocks:
+                for xs, ys in tile_math.block_tiles(*block):
+                    for x, y in zip(xs.tolist(), ys.tolist()):
+                        yield (x, y, zoom)
+        return
+
+    # Calculate tile boundaries for every zoom level at once
+    zooms = np.arange(min_zoom, max_zoom + 1)
+    ranges = tile_math.tile_ranges(min_lon, min_lat, max_lon, max_lat, zooms)
+
+    # Without a polygon, include all tiles in the bounding box
+    for zoom, min_x, max_x, min_y, max_y in zip(zooms.tolist(), *(r.tolist() for r in ranges)):
+        for xs, ys in tile_math.block_tiles(min_x, max_x, min_y, max_y):
+            for x, y in zip(xs.tolist(), ys.tolist()):
+                yield (x, y, zoom)
+
+def geojson_bounds(geojson):
+    """Return (min_lon, min_lat, max_lon, max_lat) of the polygon covered by calculate_tiles"""
+    return geojson_polygon(geojson).bounds
+
+def static_output_file(output_type, output_file):
+    """
+    mbtiles and repo outputs are a single file, so a tile path pattern is
+    replaced by a default file name. Returns the file name to use
+    """
+    if output_type in ('mbtiles', 'repo') and ("{x}" in output_file or "{y}" in output_file or "{z}" in output_file):
+        return "tiles.mbtiles" if output_type == 'mbtiles' else "tiles.repo"
+    return output_file
+
+def get_tile_path(output_dir, output_file, x, y, z):
+    """Build the output path of a tile - prepend "output" to match server.py"""
+    file_path = os.path.join("output", output_dir, output_file)
+
+    # Replace template parameters
+    file_path = file_path.replace("{x}", str(x))
+    file_path = file_path.replace("{y}", str(y))
+    file_path = file_path.replace("{z}", str(z))
+    file_path = file_path.replace("{quad}", Utils.tileXYToQuadKey(x, y, z))
+
+    return file_path
+
+def download_tile(args, attempt=1):
+    """
+    Make one download attempt for a single tile. Failed attempts are not
+    retried here, the returned AttemptResult tells the scheduler whether to
+    queue the tile for later. A 2x tile merged by the image stage returns a
+    Future of its AttemptResult instead, so the thread can move on.
+    Blank tiles are reported as "blank", skipped or stored as a reference
+    to a shared copy as blank_tiles says
+    """
+    (x, y, z, url, output_dir, output_file, output_type, output_scale, verbose, max_retries, timeout, retry_delay,
+     check_existing, tile_format, tile_quality, blank_tiles) = args
+
+    # Create a dummy lock for thread safety
+    class DummyLock:
+        def acquire(self): pass
+        def release(self): pass
+
+    dummy_lock = DummyLock()
+
+    result_code = None
+
+    def result(status, message, retry=False, retry_after=None):
+        return AttemptResult(message, retry, retry_after, status == "deferred", (x, y, z), status, result_code, attempt)
+
+    try:
+        file_path = get_tile_path(output_dir, output_file, x, y, z)
+
+        # Check if file already exists, unless the tile list was already filtered against the bulk index
+        writer = get_writer_by_type(output_type)
+        if check_existing and attempt == 1 and writer.exists(file_path, x, y, z):
+            return result("exists", f"Tile {x},{y},{z} already exists")
+
+        def store(code, data, retry_after=None):
+            nonlocal result_code
+            result_code = code
+
+            try:
+                # Check if download was successful AND we have content
+                if result_code == 200 and data and blank_tiles != "keep" and is_blank(data):
+                    if blank_tiles == "reference":
+                        writer.addBlankTile(dummy_lock, file_path, data, x, y, z, output_scale)
+                    return result("blank", f"Blank tile {x},{y},{z}" if verbose else None)
+
+                if result_code == 200 and data:
+                    # Add the tile to the output straight from memory
+                    writer.addTileData(dummy_lock, file_path, data, x, y, z, output_scale)
+
+                    # Don't return verbose message when in quiet mode
+                    if verbose:
+                        return result("downloaded", f"Downloaded tile {x},{y},{z}")
+                    else:
+                        return result("downloaded", None)
+                else:
+                    if result_code == 200:
+                        message = f"Error downloading tile {x},{y},{z}: Empty file downloaded"
+                    else:
+                        # Always return errors regardless of verbosity
+                        message = f"Failed to download tile {x},{y},{z} (code: {result_code}, attempts: {attempt})"
+                    return result("failed", message, Utils.isRetryable(result_code), retry_after)
+
+            except (OSError, IOError) as e:
+                # Handle file system errors
+                return result("failed", f"File error for tile {x},{y},{z}: {str(e)}")
+            except Exception as e:
+                # May run on an image stage writer thread, where nothing else would catch it
+                return result("failed", f"Unexpected error for tile {x},{y},{z}: {str(e)}")
+
+        # Download the tile into memory, a 2x tile merges partial children on its last attempt
+        result_code, data, retry_after = Utils.downloadTileAttempt(
+            url,
+            x, y, z,
+            output_scale,
+            timeout=timeout,
+            final=attempt >= max_retries,
+            then=store,
+            tileFormat=tile_format,
+            quality=tile_quality
+        )
+
+        # The tile host's circuit is open: keep the tile for later instead of burning its attempts
+        if result_code == Utils.CIRCUIT_OPEN:
+            message = f"Deferred tile {x},{y},{z}: tile host is failing"
+            if Utils.circuitBreaker.trips(url) > max_retries:
+                return result("deferred", message + ", giving up for this run")
+            return result("deferred", message, True, retry_after)
+
+        # The image stage merges the children and stores the tile, this thread goes back to the network
+        if isinstance(data, Future):
+            return data
+
+        return store(result_code, data, retry_after)
+
+    except (OSError, IOError) as e:
+        # Handle file system errors
+        return result("failed", f"File error for tile {x},{y},{z}: {str(e)}")
+    except Exception as e:
+        # Catch any other errors to prevent the entire process from crashing
+        return result("failed", f"Unexpected error for tile {x},{y},{z}: {str(e)}")
+
+def run_bounded(executor, fn, items, window, on_result, pause=None, retries=None, stop=None):
+    """
+    Submit fn(item) for each item, keeping at most window futures in flight,
+    so memory stays constant no matter how many items the iterator yields.
+    window may be a callable returning the current limit, and pause a callable
+    returning how many seconds to hold back new submissions.
+
+    With a RetryQueue, fn(item, attempt) returns an AttemptResult and failed
+    items wait in the queue for their next attempt while the workers move on;
+    only the final AttemptResult of each item is reported. Once stop, a
+    callable, returns True nothing new is submitted or retried, and the items
+    still in flight are reported as they finish.
+
+    fn may also return a Future of its result when the item moved on to a
+    later stage, like the image stage. It is awaited without taking up the
+    window, which only bounds the items in fn itself
+    """
+    pending = {}
+    staged = {}
+    items = iter(items)
+    exhausted = False
+
+    def drain(done):
+        for future in done:
+            item, attempt = pending.pop(future) if future in pending else staged.pop(future)
+            result = future.result()
+            if isinstance(result, Future):
+                staged[result] = (item, attempt)
+                continue
+
+            if retries is None or stopped():
+                on_result(result)
+            elif not (result.retry and retries.schedule(item, attempt if result.deferred else attempt + 1,
+                                                        result.retryAfter, result.deferred)):
+                on_result(result)
+
+    def limit():
+        return window() if callable(window) else window
+
+    def stopped():
+        return stop is not None and stop()
+
+    def next_item():
+        nonlocal exhausted
+        if stopped():
+            return None
+        # Due retries go first, so a backlog of failures does not wait for the whole job
+        if retries is not None:
+            due = retries.popDue()
+            if due is not None:
+                return due
+        if not exhausted:
+            for item in items:
+                return item, 1
+            exhausted = True
+        return None
+
+    while True:
+        while len(pending) < limit():
+            scheduled = next_item()
+            if scheduled is None:
+                break
+
+            # Hold back until pause stops asking for more time, still reporting downloads that finish
+            delay = pause() if pause is not None else 0
+            while delay > 0:
+                if pending or staged:
+                    done, _ = wait(list(pending) + list(staged), timeout=delay, return_when=FIRST_COMPLETED)
+                    drain(done)
+                else:
+                    time.sleep(delay)
+                delay = pause()
+
+            item, attempt = scheduled
+            future = executor.submit(fn, item) if retries is None else executor.submit(fn, item, attempt)
+            pending[future] = scheduled
+
+        retry_in = retries.nextDue() if retries is not None else None
+        if not pending and not staged:
+            if retry_in is None or stopped():
+                break
+            # Only retries are left and none is due yet, a stop is noticed within a quarter second
+            time.sleep(retry_in if stop is None else min(retry_in, 0.25))
+            continue
+
+        # Wake up for the next due retry even if no download finishes before it
+        done, _ = wait(list(pending) + list(staged), timeout=retry_in, return_when=FIRST_COMPLETED)
+        drain(done)
@@ -1,11 +1,40 @@
 import os
+import re
 import json
-import shutil
+import uuid
+import errno
+import hashlib
+import logging
+import threading
+from utils import Utils
+from tile_index import TileIndex
+from digest_cache import DigestCache
+from tile_encoding import stored_format
+import config
+
+logger = logging.getLogger('tile-server')
 
 class FileWriter:
 
 	slicer = None
 
+	# Content-addressed mode: each distinct tile is written once below the output's blob directory
+	# and every {z}/{x}/{y} file is a hardlink to it, so identical tiles share one inode and data block
+	dedupe = config.DEDUPE
+	blobDirectory = ".blobs"
+
+	# Per output directory with blobs: the blob generation in use for recently seen digests,
+	# a new generation starts when a blob reaches the filesystem's hardlink limit.
+	# Digests that dropped out find their blob on disk again
+	blobs = {}
+	blobsLock = threading.Lock()
+
+	@staticmethod
+	def configure(dedupe=None):
+
+		if dedupe is not None:
+			FileWriter.dedupe = dedupe
+
 	@staticmethod
 	def ensureDirectory(lock, directory):
 
@@ -26,7 +55,7 @@ class FileWriter:
 		return directory
 
 	@staticmethod
-	def addMetadata(lock, path, file, name, description, format, bounds, center, minZoom, maxZoom, profile="mercator", tileSize=256):
+	def addMetadata(lock, path, file, name, description, format, bounds, center, minZoom, maxZoom, profile="mercator", tileSize=256, blankTiles="keep"):
 
 		FileWriter.ensureDirectory(lock, path)
 
@@ -49,24 +78,223 @@ class FileWriter:
 		with open(path + "/metadata.json", 'w+') as jsonFile:
 			json.dump(dict(data), jsonFile)
 
+		# Blank tiles stored as references are linked to a shared blob, also when dedupe is off
+		if FileWriter.dedupe or blankTiles == "reference":
+			with FileWriter.blobsLock:
+				FileWriter.blobs.setdefault(os.path.abspath(path), DigestCache(config.DEDUPE_CACHE_SIZE))
+
 		return
 
 	@staticmethod
 	def addTile(lock, filePath, sourcePath, x, y, z, outputScale):
 
+		with open(sourcePath, "rb") as readFile:
+			data = readFile.read()
+
+		FileWriter.addTileData(lock, filePath, data, x, y, z, outputScale)
+
+		return
+
+	@staticmethod
+	def addTileData(lock, filePath, data, x, y, z, outputScale):
+
 		fileDirectory = os.path.dirname(filePath)
 		FileWriter.ensureDirectory(lock, fileDirectory)
 
-		shutil.copyfile(sourcePath, filePath)
+		root = FileWriter.blobRoot(filePath) if FileWriter.dedupe else None
+		if root is not None and FileWriter.linkTile(root, filePath, data):
+			return
+
+		with open(filePath, "wb") as tileFile:
+			tileFile.write(data)
 
 		return
 
+	@staticmethod
+	def addBlankTile(lock, filePath, data, x, y, z, outputScale):
+		"""Store a blank tile as a hardlink to the output's one copy of it"""
+
+		fileDirectory = os.path.dirname(filePath)
+		FileWriter.ensureDirectory(lock, fileDirectory)
+
+		root = FileWriter.blobRoot(filePath)
+		if root is not None and FileWriter.linkTile(root, filePath, data):
+			return
+
+		with open(filePath, "wb") as tileFile:
+			tileFile.write(data)
+
+		return
+
+	@staticmethod
+	def sharesBlankTiles(path, file):
+		"""Whether addBlankTile links to a shared blob for this output, false once hardlinks turned out unsupported"""
+
+		return FileWriter.blobRoot(file) is not None
+
+	@staticmethod
+	def blobRoot(filePath):
+		"""The output directory whose blobs filePath is linked to, or None when it is written as a plain file"""
+
+		if not FileWriter.blobs:
+			return None
+
+		path = os.path.abspath(filePath)
+		with FileWriter.blobsLock:
+			for root in FileWriter.blobs:
+				if path.startswith(root + os.sep):
+					return root
+		return None
+
+	@staticmethod
+	def linkTile(root, filePath, data):
+		"""Hardlink filePath to the blob holding data, writing the blob the first time. False when links are not supported"""
+
+		digest = hashlib.md5(data).hexdigest()
+
+		with FileWriter.blobsLock:
+			known = FileWriter.blobs.get(root)
+			if known is None:
+				return False
+			generation = known.get(digest)
+
+		# Blobs written earlier in this run are trusted without another stat, which matters on network filesystems
+		written = generation is not None
+		generation = generation or 0
+
+		while True:
+			blob = os.path.join(root, FileWriter.blobDirectory, digest[0:2], digest[2:] + (f".{generation}" if generation else ""))
+
+			if not written and not os.path.exists(blob):
+				os.makedirs(os.path.dirname(blob), exist_ok=True)
+				temporary = f"{blob}.{uuid.uuid4().hex}.tmp"
+				with open(temporary, "wb") as blobFile:
+					blobFile.write(data)
+				os.replace(temporary, blob)
+
+			# Link under a temporary name and rename over the tile, so an existing tile is replaced atomically
+			temporary = f"{filePath}.{uuid.uuid4().hex}.tmp"
+			try:
+				os.link(blob, temporary)
+			except FileNotFoundError:
+				written = False  # Blob removed behind our back, write it again
+				continue
+			except OSError as e:
+				if e.errno == errno.EMLINK:
+					generation += 1
+					written = False
+					continue
+
+				logger.warning(f"Hardlinks are not supported for {filePath} ({str(e)}), writing plain tile files")
+				with FileWriter.blobsLock:
+					FileWriter.blobs.pop(root, None)
+				return False
+
+			os.replace(temporary, filePath)
+
+			with FileWriter.blobsLock:
+				known.put(digest, generation)
+			return True
+
 	@staticmethod
 	def exists(filePath, x, y, z):
 		return os.path.isfile(filePath)
 
+	@staticmethod
+	def existingTiles(filePath, minZoom, maxZoom):
+		"""
+		Walk the output directory once and index every file matching the
+		{x}/{y}/{z} or {quad} file pattern. Returns None when the pattern
+		does not identify tiles, in which case callers fall back to exists()
+		"""
+
+		placeholders = re.findall(r"\{(\w+)\}", filePath)
+		hasXYZ = all(key in placeholders for key in ("x", "y", "z"))
+		if not hasXYZ and "quad" not in placeholders:
+			return None
+
+		groups = {
+			"x": r"(?P<x>\d+)",
+			"y": r"(?P<y>\d+)",
+			"z": r"(?P<z>\d+)",
+			"quad": r"(?P<quad>[0-3]*)",
+		}
+
+		pattern = ""
+		seen = set()
+		for token in re.split(r"(\{\w+\})", os.path.normpath(filePath)):
+			key = token[1:-1] if token.startswith("{") and token.endswith("}") else None
+			if key in groups and key not in seen:
+				pattern += groups[key]
+				seen.add(key)
+			elif key in groups:
+				pattern += "(?P=" + key + ")"
+			elif key is not None:
+				pattern += r"[^/\\]*"
+			else:
+				pattern += re.escape(token)
+		matcher = re.compile(pattern + "$")
+
+		# Only walk below the part of the path that has no placeholders
+		root = os.path.dirname(os.path.normpath(filePath).split("{", 1)[0]) or "."
+
+		def tiles():
+			for directory, subdirectories, files in os.walk(root):
+				# Blobs are never tiles themselves
+				if FileWriter.blobDirectory in subdirectories:
+					subdirectories.remove(FileWriter.blobDirectory)
+
+				for name in files:
+					match = matcher.match(os.path.join(directory, name))
+					if match is None:
+						continue
+
+					if hasXYZ:
+						tile = (int(match.group("x")), int(match.group("y")), int(match.group("z")))
+					else:
+						tile = Utils.quadKeyToTileXY(match.group("quad"))
+
+					if minZoom <= tile[2] <= maxZoom:
+						yield tile
+
+		return TileIndex.fromTiles(tiles())
+
 
 	@staticmethod
 	def close(lock, path, file, minZoom, maxZoom):
-		# TODO actually implement this rather than just having a comment
-		return
\ No newline at end of file
+
+		# Forget the digests seen, the blobs themselves stay for the next run
+		with FileWriter.blobsLock:
+			FileWriter.blobs.pop(os.path.abspath(path), None)
+
+		# Tiles kept as the provider sent them need not be the PNG addMetadata assumed
+		format = FileWriter.storedFormat(file)
+		metadataPath = path + "/metadata.json"
+		if format is not None and os.path.isfile(metadataPath):
+			with open(metadataPath) as jsonFile:
+				metadata = json.load(jsonFile)
+			if metadata.get("format") != format:
+				metadata["format"] = format
+				with open(metadataPath, 'w') as jsonFile:
+					json.dump(metadata, jsonFile)
+
+		return
+
+	@staticmethod
+	def storedFormat(filePath):
+		"""The format of the first tile found below the fixed part of the filePath pattern, or None"""
+
+		root = os.path.dirname(os.path.normpath(filePath).split("{", 1)[0]) or "."
+		for directory, subdirectories, files in os.walk(root):
+			# Blobs and the download journal are never tiles
+			subdirectories[:] = [name for name in subdirectories if not name.startswith(".")]
+
+			for name in files:
+				if name == "metadata.json" or name.endswith(".tmp"):
+					continue
+				with open(os.path.join(directory, name), "rb") as tileFile:
+					format = stored_format(tileFile.read(16))
+				if format is not None:
+					return format
+
+		return None
\ No newline at end of file
@@ -0,0 +1,152 @@
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def run_timed(fn, args):
+    """Run fn(*args) in a worker process, returning its result and the seconds it took"""
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+class StageStats:
+    """
+    Busy time of the workers of one pipeline stage. Utilization is the share
+    of the workers' time spent working between the first task starting and
+    the last one finishing, so a stage near 100% is the one holding the
+    pipeline back.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(1, int(workers))
+        self.tasks = 0
+        self.busy = 0.0
+        self.first = None
+        self.last = None
+        self.lock = threading.Lock()
+
+    def record(self, seconds, started=None):
+        now = time.monotonic()
+        with self.lock:
+            self.tasks += 1
+            self.busy += seconds
+            if self.first is None:
+                self.first = started if started is not None else now - seconds
+            self.last = now
+
+    def timed(self, fn):
+        """Wrap fn so every call counts as busy time of this stage"""
+        def run(*args):
+            started = time.monotonic()
+            try:
+                return fn(*args)
+            finally:
+                self.record(time.monotonic() - started, started)
+        return run
+
+    def share(self, seconds):
+        """Share of the workers' time between the first and the last task that seconds make up"""
+        with self.lock:
+            if self.first is None or self.last <= self.first:
+                return 0.0
+            return min(1.0, seconds / (self.workers * (self.last - self.first)))
+
+    def utilization(self):
+        return self.share(self.busy)
+
+    def stats(self):
+        return {"workers": self.workers, "tasks": self.tasks, "busy": self.busy,
+                "utilization": self.utilization()}
+
+
+class ImageStage:
+    """
+    Decoding, compositing and encoding in a pool of processes, apart from the
+    download threads.
+
+    A download thread hands its tile's bytes over with submit() and goes back
+    to the network right away. At most queueSize tiles wait in or are worked
+    on by the stage; beyond that submit() blocks, so a pool that cannot keep
+    up slows the downloads down instead of piling up tiles in memory. The
+    time threads spend blocked there is reported as backpressure.
+
+    Results are handed on to writerThreads threads, so storing one tile
+    never holds up the pool's single result thread and the other tiles.
+    A tile keeps its slot until it is stored.
+    """
+
+    def __init__(self, processes, queueSize=None, writerThreads=None):
+        self.processes = max(1, int(processes))
+        self.queueSize = max(1, int(queueSize or self.processes * 4))
+        self.pool = ProcessPoolExecutor(max_workers=self.processes)
+        self.writers = ThreadPoolExecutor(max_workers=max(1, int(writerThreads or self.processes)),
+                                          thread_name_prefix="image-stage-writer")
+        self.slots = threading.BoundedSemaphore(self.queueSize)
+        self.workers = StageStats(self.processes)
+
+        self.queued = 0
+        self.peak = 0
+        self.blocked = 0.0  # Seconds submitters waited for a free slot
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, then=None):
+        """
+        Run fn(*args) in the pool and return a Future of its result. then, if
+        given, is called with the result on a writer thread and the Future
+        resolves to what it returns, e.g. to store a merged tile
+        """
+        waited = time.monotonic()
+        self.slots.acquire()
+        waited = time.monotonic() - waited
+
+        with self.lock:
+            self.blocked += waited
+            self.queued += 1
+            self.peak = max(self.peak, self.queued)
+
+        staged = Future()
+        submitted = time.monotonic()
+
+        def release():
+            with self.lock:
+                self.queued -= 1
+            self.slots.release()
+
+        def store(result):
+            try:
+                staged.set_result(then(result))
+            except BaseException as e:
+                staged.set_exception(e)
+            finally:
+                release()
+
+        def done(future):
+            # Runs on the pool's result thread, which must only hand results on
+            try:
+                result, seconds = future.result()
+                self.workers.record(seconds, submitted)
+                if then is not None:
+                    self.writers.submit(store, result)
+                    return
+                staged.set_result(result)
+            except BaseException as e:
+                staged.set_exception(e)
+            release()
+
+        try:
+            self.pool.submit(run_timed, fn, args).add_done_callback(done)
+        except BaseException:
+            release()
+            raise
+        return staged
+
+    def stats(self):
+        with self.lock:
+            queue = {"queued": self.queued, "peak": self.peak, "size": self.queueSize, "blocked": self.blocked}
+        return {**self.workers.stats(), **queue}
+
+    def shutdown(self):
+        # The pool first, its last results still go to the writers
+        self.pool.shutdown()
+        self.writers.shutdown()
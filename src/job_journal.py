@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import time
+
+# Arguments that define what a download fetches and where it stores it. Everything else,
+# like threads, retries or rate limits, may be changed when the download is resumed
+JOB_PARAMETERS = ("url", "output_dir", "min_zoom", "max_zoom", "bounds", "geojson",
+                  "output_type", "output_file", "output_scale", "pyramid", "tile_format", "tile_quality",
+                  "blank_tiles")
+
+
+class JobJournal:
+    """
+    On-disk record of a CLI download, kept in output/<output dir>/.journal.
+
+    job.json holds the download's parameters. checkpoint.json is rewritten
+    atomically every few seconds with how many tiles were taken from the
+    tile enumeration and which of them are not finished yet (in flight or
+    waiting for a retry), so a resumed download requeues those and skips the
+    rest of the enumerated tiles without probing storage. failed.tsv is a
+    ledger of the tiles that failed for good with their last status code,
+    the tiles --retry-failed downloads again.
+    """
+
+    directoryName = ".journal"
+
+    def __init__(self, outputDir, interval=2.0):
+        self.directory = os.path.join("output", outputDir, self.directoryName)
+        self.interval = interval
+        self.lock = threading.Lock()
+
+        self.parameters = {}
+        self.existingTiles = None
+        self.enumerated = 0
+        self.outstanding = {}  # Tiles handed to the scheduler and not reported yet, in order
+        self.counts = {}
+        self.finished = False
+        self.lastSave = time.monotonic()
+        self.beforeSave = None  # Commits what the writer still buffers, so the checkpoint never runs ahead of it
+
+        self.retrying = False
+        self.resolved = set()  # Ledger tiles downloaded by --retry-failed
+        self.ledger = None
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def create(args, existingTiles):
+        """Start the journal of a new download, replacing the journal of an earlier one in the same output"""
+        journal = JobJournal(args.output_dir)
+        journal.parameters = {name: getattr(args, name) for name in JOB_PARAMETERS}
+        journal.existingTiles = existingTiles
+
+        os.makedirs(journal.directory, exist_ok=True)
+        journal.writeJson("job.json", {"parameters": journal.parameters, "existingTiles": existingTiles,
+                                       "created": time.time()})
+        open(journal.path("failed.tsv"), "w").close()
+        journal.save()
+        return journal
+
+    @staticmethod
+    def load(outputDir):
+        """Open the journal of an earlier download of outputDir"""
+        journal = JobJournal(outputDir)
+        try:
+            with open(journal.path("job.json")) as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            raise ValueError(f"No download journal in {journal.directory}")
+
+        journal.parameters = job["parameters"]
+        journal.existingTiles = job.get("existingTiles")
+
+        try:
+            with open(journal.path("checkpoint.json")) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            checkpoint = {}
+
+        journal.enumerated = checkpoint.get("enumerated", 0)
+        journal.outstanding = {tuple(tile): None for tile in checkpoint.get("outstanding", [])}
+        journal.counts = checkpoint.get("counts", {})
+        journal.finished = checkpoint.get("finished", False)
+        return journal
+
+    def apply(self, args):
+        """Set the download parameters of args to the journaled ones"""
+        for name in JOB_PARAMETERS:
+            setattr(args, name, self.parameters.get(name, getattr(args, name)))
+
+    def requeued(self):
+        """Tiles that were not finished when the download stopped"""
+        return list(self.outstanding)
+
+    def failedTiles(self):
+        """The ledger as {(x, y, z): (status, code, attempts)}, the latest entry of each tile wins"""
+        tiles = {}
+        try:
+            with open(self.path("failed.tsv")) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    x, y, z, status, code, attempts = line.rstrip("\n").split("\t")
+                    tiles[(int(x), int(y), int(z))] = (status, code, attempts)
+        except FileNotFoundError:
+            pass
+        return tiles
+
+    def startRetrying(self):
+        """Track the ledger's tiles instead of the enumeration, leaving the checkpoint as it is"""
+        self.retrying = True
+        self.outstanding = {}
+
+    def issue(self, tile, enumerated=True):
+        with self.lock:
+            self.outstanding[tile] = None
+            if enumerated:
+                self.enumerated += 1
+
+    def skip(self):
+        """An enumerated tile that was already stored"""
+        with self.lock:
+            self.enumerated += 1
+            self.counts["skipped"] = self.counts.get("skipped", 0) + 1
+        self.maybeSave()
+
+    def record(self, result):
+        """Account for the final AttemptResult of a tile, adding it to the ledger when it failed"""
+        with self.lock:
+            self.outstanding.pop(result.tile, None)
+            self.counts[result.status] = self.counts.get(result.status, 0) + 1
+
+            if result.status in ("failed", "deferred"):
+                if self.ledger is None:
+                    self.ledger = open(self.path("failed.tsv"), "a")
+                x, y, z = result.tile
+                code = "" if result.code is None else result.code
+                attempts = "" if result.attempt is None else result.attempt
+                self.ledger.write(f"{x}\t{y}\t{z}\t{result.status}\t{code}\t{attempts}\n")
+                self.ledger.flush()
+            elif self.retrying:
+                self.resolved.add(result.tile)
+
+        self.maybeSave()
+
+    def maybeSave(self):
+        if time.monotonic() - self.lastSave >= self.interval:
+            self.save()
+
+    def save(self, finished=False):
+        if self.retrying:
+            return
+
+        with self.lock:
+            self.lastSave = time.monotonic()
+            self.finished = finished
+            checkpoint = {
+                "enumerated": self.enumerated,
+                "outstanding": [list(tile) for tile in self.outstanding],
+                "counts": self.counts,
+                "finished": finished,
+                "updated": time.time(),
+            }
+
+        if self.beforeSave is not None:
+            self.beforeSave()
+        self.writeJson("checkpoint.json", checkpoint)
+
+    def close(self, finished):
+        """Write the last checkpoint and compact the ledger to one line per failed tile"""
+        self.save(finished)
+
+        with self.lock:
+            if self.ledger is not None:
+                self.ledger.close()
+                self.ledger = None
+
+        failed = {tile: entry for tile, entry in self.failedTiles().items() if tile not in self.resolved}
+        temporary = self.path("failed.tsv.tmp")
+        with open(temporary, "w") as f:
+            for (x, y, z), (status, code, attempts) in failed.items():
+                f.write(f"{x}\t{y}\t{z}\t{status}\t{code}\t{attempts}\n")
+        os.replace(temporary, self.path("failed.tsv"))
+        return len(failed)
+
+    def writeJson(self, name, data):
+        temporary = self.path(name + ".tmp")
+        with open(temporary, "w") as f:
+            json.dump(data, f)
+        os.replace(temporary, self.path(name))
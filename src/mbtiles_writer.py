@@ -1,9 +1,95 @@
 import sqlite3
 import os
+import hashlib
+import threading
 from utils import Utils
+from sqlite_batch_writer import SqliteBatchWriter
+from tile_index import TileIndex
+from digest_cache import DigestCache
+import tile_math
+import config
+from tile_encoding import stored_format
 
 class MbtilesWriter:
 
+	tileInsertSql = "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?);"
+
+	# Deduplicated layout: every distinct image is stored once in images, map points tiles at it
+	# and a tiles view keeps the file readable as plain MBTiles
+	dedupeInsertSql = [
+		"INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?);",
+		"INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?);",
+	]
+
+	# Use the deduplicated layout for new files, existing files keep the layout they were created with.
+	# New files whose blank tiles are stored as references use it too, so those share one image
+	dedupe = config.DEDUPE
+
+	# Per output file: the ids of images recently queued or stored when it is deduplicated, None when it is not.
+	# Older ids drop out, their images are handed to INSERT OR IGNORE again
+	layouts = {}
+
+	# One long-lived batch writer per output file, opened by addMetadata and closed by close
+	stores = {}
+	storesLock = threading.Lock()
+
+	storeOptions = {
+		"batchSize": config.SQLITE_BATCH_SIZE,
+		"flushInterval": config.SQLITE_FLUSH_INTERVAL,
+		"synchronous": config.SQLITE_SYNCHRONOUS,
+		"pageSize": config.SQLITE_PAGE_SIZE,
+	}
+
+	@staticmethod
+	def configure(batchSize=None, flushInterval=None, synchronous=None, pageSize=None, dedupe=None):
+
+		if dedupe is not None:
+			MbtilesWriter.dedupe = dedupe
+		options = {
+			"batchSize": batchSize,
+			"flushInterval": flushInterval,
+			"synchronous": synchronous,
+			"pageSize": pageSize,
+		}
+
+		for key, value in options.items():
+			if value is not None:
+				MbtilesWriter.storeOptions[key] = value
+
+	@staticmethod
+	def getStore(file, insertSql):
+
+		key = os.path.abspath(file)
+
+		with MbtilesWriter.storesLock:
+			store = MbtilesWriter.stores.get(key)
+			if store is None:
+				store = SqliteBatchWriter(file, insertSql, **MbtilesWriter.storeOptions)
+				MbtilesWriter.stores[key] = store
+
+		return store
+
+	@staticmethod
+	def findStore(file):
+		with MbtilesWriter.storesLock:
+			return MbtilesWriter.stores.get(os.path.abspath(file))
+
+	@staticmethod
+	def flush(file):
+		"""Block until every tile queued for file is committed"""
+		store = MbtilesWriter.findStore(file)
+		if store is not None:
+			store.flush()
+
+	@staticmethod
+	def closeStore(file):
+		with MbtilesWriter.storesLock:
+			store = MbtilesWriter.stores.pop(os.path.abspath(file), None)
+			MbtilesWriter.layouts.pop(os.path.abspath(file), None)
+
+		if store is not None:
+			store.close()
+
 	def ensureDirectory(lock, directory):
 
 		lock.acquire()
@@ -24,12 +110,62 @@ class MbtilesWriter:
 
 
 	@staticmethod
-	def addMetadata(lock, path, file, name, description, format, bounds, center, minZoom, maxZoom, profile="mercator", tileSize=256):
+	def addMetadata(lock, path, file, name, description, format, bounds, center, minZoom, maxZoom, profile="mercator", tileSize=256, blankTiles="keep"):
 
 		MbtilesWriter.ensureDirectory(lock, path)
 
-		connection = sqlite3.connect(file, check_same_thread=False)
-		c = connection.cursor()
+		imageIds = MbtilesWriter.imageIds(file, MbtilesWriter.dedupe or blankTiles == "reference")
+		store = MbtilesWriter.getStore(file, MbtilesWriter.dedupeInsertSql if imageIds is not None else MbtilesWriter.tileInsertSql)
+
+		with store.transaction() as c:
+			if imageIds is not None:
+				MbtilesWriter.createDedupeSchema(c)
+			else:
+				MbtilesWriter.createSchema(c)
+			MbtilesWriter.insertMetadata(c, name, description, format, bounds, center, minZoom, maxZoom, profile, tileSize)
+
+	@staticmethod
+	def imageIds(file, dedupe=None):
+		"""
+		The recent image ids of a deduplicated file, or None for the plain layout.
+		The layout of an existing file is read from its schema, new files follow dedupe,
+		MbtilesWriter.dedupe by default
+		"""
+
+		key = os.path.abspath(file)
+		with MbtilesWriter.storesLock:
+			if key in MbtilesWriter.layouts:
+				return MbtilesWriter.layouts[key]
+
+		if dedupe is None:
+			dedupe = MbtilesWriter.dedupe
+		if os.path.exists(file):
+			connection = sqlite3.connect(file, check_same_thread=False)
+			try:
+				tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE name IN ('map', 'tiles')")]
+			finally:
+				connection.close()
+
+			if tables:
+				dedupe = "map" in tables
+
+		with MbtilesWriter.storesLock:
+			return MbtilesWriter.layouts.setdefault(key, DigestCache(config.DEDUPE_CACHE_SIZE) if dedupe else None)
+
+	@staticmethod
+	def sharesBlankTiles(path, file):
+		"""Whether addBlankTile stores references to one image, only in the deduplicated layout"""
+
+		return MbtilesWriter.imageIds(file) is not None
+
+	@staticmethod
+	def coordinateTable(file):
+		"""Table to look up which tiles exist without touching tile data"""
+		return "map" if MbtilesWriter.imageIds(file) is not None else "tiles"
+
+	@staticmethod
+	def createSchema(c):
+
 		c.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text);")
 		c.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);")
 
@@ -43,7 +179,21 @@ class MbtilesWriter:
 		except:
 			pass
 
-		connection.commit()
+	@staticmethod
+	def createDedupeSchema(c):
+
+		c.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text);")
+		c.execute("CREATE TABLE IF NOT EXISTS map (zoom_level integer, tile_column integer, tile_row integer, tile_id text);")
+		c.execute("CREATE TABLE IF NOT EXISTS images (tile_data blob, tile_id text);")
+		c.execute("CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);")
+		c.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id);")
+		c.execute("CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);")
+		c.execute("""CREATE VIEW IF NOT EXISTS tiles AS
+			SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data
+			FROM map JOIN images ON images.tile_id = map.tile_id;""")
+
+	@staticmethod
+	def insertMetadata(c, name, description, format, bounds, center, minZoom, maxZoom, profile, tileSize):
 
 		try:
 			c.executemany("INSERT INTO metadata (name, value) VALUES (?, ?);", [
@@ -61,8 +211,6 @@ class MbtilesWriter:
 				("type", "overlay"),
 				("attribution", "Map Tiles Downloader via AliFlux"),
 			])
-
-			connection.commit()
 		except:
 			pass
 
@@ -71,42 +219,60 @@ class MbtilesWriter:
 	@staticmethod
 	def addTile(lock, filePath, sourcePath, x, y, z, outputScale):
 
-		fileDirectory = os.path.dirname(filePath)
-		MbtilesWriter.ensureDirectory(lock, fileDirectory)
-
-		invertedY = (2 ** z) - y - 1
-
 		tileData = []
 		with open(sourcePath, "rb") as readFile:
 			tileData = readFile.read()
 
-		lock.acquire()
-		try:
+		MbtilesWriter.addTileData(lock, filePath, tileData, x, y, z, outputScale)
 
-			connection = sqlite3.connect(filePath, check_same_thread=False)
-			c = connection.cursor()
-			c.execute("INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?);", [
-				z, x, invertedY, tileData
-			])
+		return
 
-			connection.commit()
+	@staticmethod
+	def addTileData(lock, filePath, tileData, x, y, z, outputScale):
 
-		finally:
-			lock.release()
+		fileDirectory = os.path.dirname(filePath)
+		MbtilesWriter.ensureDirectory(lock, fileDirectory)
+
+		invertedY = (2 ** z) - y - 1
+
+		imageIds = MbtilesWriter.imageIds(filePath)
+		if imageIds is None:
+			store = MbtilesWriter.getStore(filePath, MbtilesWriter.tileInsertSql)
+			store.add((x, y, z), (z, x, invertedY, tileData))
+			return
 
+		# Hash the image once, its bytes are only handed to the writer the first time they are seen
+		tileId = hashlib.md5(tileData).hexdigest()
+		with MbtilesWriter.storesLock:
+			image = None if tileId in imageIds else (tileId, tileData)
+			imageIds.put(tileId)
+
+		store = MbtilesWriter.getStore(filePath, MbtilesWriter.dedupeInsertSql)
+		store.add((x, y, z), (image, (z, x, invertedY, tileId)))
 
 		return
 
+	@staticmethod
+	def addBlankTile(lock, filePath, tileData, x, y, z, outputScale):
+		"""Store a blank tile. In the deduplicated layout all copies of it share one image row"""
+
+		MbtilesWriter.addTileData(lock, filePath, tileData, x, y, z, outputScale)
+
 	@staticmethod
 	def exists(filePath, x, y, z):
 		invertedY = (2 ** z) - y - 1
 
+		store = MbtilesWriter.findStore(filePath)
+		if store is not None and store.isPending((x, y, z)):
+			return True
+
 		if(os.path.exists(filePath)):
 
 			connection = sqlite3.connect(filePath, check_same_thread=False)
 			c = connection.cursor()
 
-			c.execute("SELECT COUNT(*) FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ? LIMIT 1", (z, x, invertedY))
+			table = MbtilesWriter.coordinateTable(filePath)
+			c.execute(f"SELECT COUNT(*) FROM {table} WHERE zoom_level = ? AND tile_column = ? AND tile_row = ? LIMIT 1", (z, x, invertedY))
 
 			result = c.fetchone()
 
@@ -115,21 +281,67 @@ class MbtilesWriter:
 
 		return False
 
+	@staticmethod
+	def existingTiles(filePath, minZoom, maxZoom):
+		"""Load every stored tile between minZoom and maxZoom into a TileIndex with one scan per zoom"""
+
+		store = MbtilesWriter.findStore(filePath)
+		if store is not None:
+			store.flush()
+
+		if not os.path.exists(filePath):
+			return TileIndex()
+
+		table = MbtilesWriter.coordinateTable(filePath)
+		connection = sqlite3.connect(filePath, check_same_thread=False)
+		try:
+			c = connection.cursor()
+
+			def tiles():
+				for z in range(minZoom, maxZoom + 1):
+					c.execute(f"SELECT tile_column, tile_row FROM {table} WHERE zoom_level = ?", [z])
+					for x, invertedY in c:
+						yield (x, (2 ** z) - invertedY - 1, z)
+
+			return TileIndex.fromTiles(tiles())
+		finally:
+			connection.close()
+
 
 	@staticmethod
 	def close(lock, path, file, minZoom, maxZoom):
 
+		table = MbtilesWriter.coordinateTable(file)
+
+		# Commit everything still queued and release the long-lived connection
+		MbtilesWriter.closeStore(file)
+
 		connection = sqlite3.connect(file, check_same_thread=False)
 		c = connection.cursor()
 
-		c.execute("SELECT min(tile_row), max(tile_row), min(tile_column), max(tile_column) from tiles WHERE zoom_level = ?", [maxZoom])
+		# Tiles kept as the provider sent them need not be the PNG addMetadata assumed
+		c.execute("SELECT tile_data FROM tiles WHERE tile_data IS NOT NULL LIMIT 1")
+		row = c.fetchone()
+		format = stored_format(row[0]) if row is not None else None
+		if format is not None:
+			c.execute("UPDATE metadata SET value = ? WHERE name = 'format'", [format])
+			connection.commit()
+
+		c.execute(f"SELECT min(tile_row), max(tile_row), min(tile_column), max(tile_column) from {table} WHERE zoom_level = ?", [maxZoom])
 
 		minY, maxY, minX, maxX = c.fetchone()
+
+		if minY is None:
+			# No tiles at maxZoom, keep the bounds written by addMetadata
+			connection.close()
+			return
+
 		minY = (2 ** maxZoom) - minY - 1
 		maxY = (2 ** maxZoom) - maxY - 1
 
-		minLat, minLon = Utils.num2deg(minX, minY, maxZoom)
-		maxLat, maxLon = Utils.num2deg(maxX+1, maxY+1, maxZoom)
+		lats, lons = tile_math.num2deg([minX, maxX+1], [minY, maxY+1], maxZoom)
+		minLat, maxLat = lats.tolist()
+		minLon, maxLon = lons.tolist()
 
 		bounds = [minLon, minLat, maxLon, maxLat]
 		boundsString = ','.join(map(str, bounds))
@@ -142,3 +354,4 @@ class MbtilesWriter:
 
 		connection.commit()
 
+		connection.close()
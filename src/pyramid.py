@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import io
+import os
+import logging
+
+from PIL import Image
+
+from utils import Utils
+from tile_encoding import encode_image
+from tile_reader import SqliteTileStore
+from downloader import calculate_tiles, get_tile_path, run_bounded
+
+logger = logging.getLogger('tile-downloader')
+
+# Zoom levels built by one task: a subtree root reads 4 ** BAND_DEPTH tiles below it and builds
+# the levels in between, so a task never holds more than a few hundred tiles in memory
+BAND_DEPTH = 4
+
+# Encoding of built tiles whose stored tiles are kept as the provider sent them, by the PIL format of those
+ORIGINAL_ENCODINGS = {"JPEG": "jpeg", "WEBP": "webp"}
+
+# Output stores opened by this worker process, keyed by (output type, output dir, output file)
+_readers = {}
+
+
+def open_reader(output_type, output_dir, output_file):
+    """Return read(x, y, z) -> tile bytes or None for a stored output, cached per process"""
+    key = (output_type, output_dir, output_file)
+    reader = _readers.get(key)
+    if reader is not None:
+        return reader
+
+    if output_type in ('mbtiles', 'repo'):
+        store = SqliteTileStore(os.path.join("output", output_dir, output_file), poolSize=1)
+
+        def reader(x, y, z):
+            tile = store.read(x, y, z)
+            return tile.data if tile is not None else None
+    else:
+        def reader(x, y, z):
+            try:
+                with open(get_tile_path(output_dir, output_file, x, y, z), "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+    _readers[key] = reader
+    return reader
+
+
+def decode_tile(data):
+    if not data:
+        return None
+    try:
+        return Image.open(io.BytesIO(data))
+    except Exception as e:
+        logger.warning(f"Skipping unreadable child tile: {str(e)}")
+        return None
+
+
+def merge_children(images):
+    """
+    Merge up to four child images, in getChildTiles order, into their parent at the
+    children's size. Missing children stay transparent. Returns an image or None
+    """
+    if not any(images):
+        return None
+
+    transparent = any(image is None or "A" in image.getbands() or "transparency" in image.info for image in images)
+    canvas = Utils.mergeQuadTile(images, "RGBA" if transparent else "RGB")
+
+    # An exact 2:1 box filter, much faster than a generic resize
+    return canvas.reduce(2)
+
+
+def build_subtree(args):
+    """
+    Build the tiles of one subtree bottom-up: read the stored tiles depth levels
+    below (x, y, z) and merge them level by level up to (x, y, z). Returns the
+    built tiles as (x, y, z, data), encoded in tile_format, for the parent process
+    to write. Built tiles are handed up as images, so only the stored tiles are
+    ever decoded. With tile_format original, built tiles are encoded like the
+    stored tiles they come from: JPEG, WebP, or else PNG
+    """
+    x, y, z, depth, output_type, output_dir, output_file, tile_format, tile_quality = args
+    read = open_reader(output_type, output_dir, output_file)
+    built = []
+
+    def build(x, y, z, level):
+        """Returns the tile's image and the encoding of the stored tiles below it"""
+        if level == depth:
+            image = decode_tile(read(x, y, z))
+            return image, ORIGINAL_ENCODINGS.get(image.format, "original") if image is not None else None
+
+        children = [build(childX, childY, childZ, level + 1) for childX, childY, childZ in Utils.getChildTiles(x, y, z)]
+        image = merge_children([child for child, encoding in children])
+        encoding = next((encoding for child, encoding in children if encoding is not None), None)
+        if image is not None:
+            fmt = encoding if tile_format in (None, "original") else tile_format
+            built.append((x, y, z, encode_image(image, fmt, tile_quality)))
+        return image, encoding
+
+    build(x, y, z, 0)
+    return built
+
+
+def pyramid_bands(min_zoom, max_zoom, depth=BAND_DEPTH):
+    """(top zoom, depth) of each band of levels to build below max_zoom, highest band first"""
+    bands = []
+    bottom = max_zoom - 1
+    while bottom >= min_zoom:
+        top = max(min_zoom, bottom - depth + 1)
+        bands.append((top, bottom - top + 1))
+        bottom = top - 1
+    return bands
+
+
+def build_pyramid(executor, window, output_type, output_dir, output_file, min_lon, min_lat, max_lon, max_lat,
+                  min_zoom, max_zoom, geojson, on_tiles, before_band=None, tile_format=None, tile_quality=80):
+    """
+    Derive zooms min_zoom to max_zoom - 1 from the stored max_zoom tiles of an area.
+
+    Levels are built in bands of BAND_DEPTH zooms, each band from the one below
+    it. Within a band every subtree is an independent task for the executor,
+    a process pool, with at most window tasks in flight, and on_tiles receives
+    each task's built tiles to store them. before_band is called before a band
+    reads the store, to commit what the writer still buffers. Built tiles are
+    encoded in tile_format, PNG for original tiles
+    """
+    for top, depth in pyramid_bands(min_zoom, max_zoom):
+        if before_band is not None:
+            before_band()
+
+        roots = ((x, y, z, depth, output_type, output_dir, output_file, tile_format, tile_quality)
+                 for x, y, z in calculate_tiles(min_lon, min_lat, max_lon, max_lat, top, top, geojson))
+        run_bounded(executor, build_subtree, roots, window, on_tiles)
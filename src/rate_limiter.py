@@ -0,0 +1,59 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate tokens per second, holding at most burst
+    tokens. Callers reserve a token and get back how long to wait before
+    using it, so both threads and coroutines can share one bucket.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take one token and return the seconds to wait before it may be used"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Tokens may go negative: later callers queue up behind earlier ones
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """One token bucket per tile host, shared by every worker"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def reserve(self, url):
+        """Seconds to wait before requesting url, for callers that cannot block"""
+        return self.bucket(url).reserve()
+
+    def wait(self, url):
+        """Block until a request to url's host is allowed"""
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
@@ -6,13 +6,22 @@ from mbtiles_writer import MbtilesWriter
 
 class RepoWriter(MbtilesWriter):
 
+	tileInsertSql = "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, tile_cropped_data, pixel_left, pixel_top, pixel_right, pixel_bottom, has_alpha) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
+
 	@staticmethod
-	def addMetadata(lock, path, file, name, description, format, bounds, center, minZoom, maxZoom, profile="mercator", tileSize=256):
+	def addMetadata(lock, path, file, name, description, format, bounds, center, minZoom, maxZoom, profile="mercator", tileSize=256, blankTiles="keep"):
 
 		RepoWriter.ensureDirectory(lock, path)
 
-		connection = sqlite3.connect(file, check_same_thread=False)
-		c = connection.cursor()
+		store = RepoWriter.getStore(file, RepoWriter.tileInsertSql)
+
+		with store.transaction() as c:
+			RepoWriter.createSchema(c)
+			RepoWriter.insertMetadata(c, name, description, format, bounds, center, minZoom, maxZoom, profile, tileSize)
+
+	@staticmethod
+	def createSchema(c):
+
 		c.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text);")
 		c.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob, tile_cropped_data blob, pixel_left real, pixel_top real, pixel_right real, pixel_bottom real, has_alpha INTEGER);")
 
@@ -26,57 +35,37 @@ class RepoWriter(MbtilesWriter):
 		except:
 			pass
 
-		connection.commit()
+	@staticmethod
+	def addTile(lock, filePath, sourcePath, x, y, z, outputScale):
 
-		c = connection.cursor()
+		tileData = []
+		with open(sourcePath, "rb") as readFile:
+			tileData = readFile.read()
 
+		RepoWriter.addTileData(lock, filePath, tileData, x, y, z, outputScale)
 
-		try:
-			c.executemany("INSERT INTO metadata (name, value) VALUES (?, ?);", [
-				("name", name),
-				("description", description),
-				("format", format),
-				("bounds", ','.join(map(str, bounds))),
-				("center", ','.join(map(str, center))),
-				("minzoom", minZoom),
-				("maxzoom", maxZoom),
-				("profile", profile),
-				("tilesize", str(tileSize)),
-				("scheme", "tms"),
-				("generator", "Map Tiles Downloader via AliFlux"),
-				("type", "overlay"),
-				("attribution", "Map Tiles Downloader via AliFlux"),
-			])
-
-			connection.commit()
-		except:
-			pass
+		return
 
 	@staticmethod
-	def addTile(lock, filePath, sourcePath, x, y, z, outputScale):
+	def addTileData(lock, filePath, tileData, x, y, z, outputScale):
 
 		fileDirectory = os.path.dirname(filePath)
 		RepoWriter.ensureDirectory(lock, fileDirectory)
 
 		invertedY = (2 ** z) - y - 1
 
-		tileData = []
-		with open(sourcePath, "rb") as readFile:
-			tileData = readFile.read()
-
-		lock.acquire()
-		try:
+		store = RepoWriter.getStore(filePath, RepoWriter.tileInsertSql)
+		store.add((x, y, z), (z, x, invertedY, None, tileData, 0, 0, 256 * outputScale, 256 * outputScale, 0))
 
-			connection = sqlite3.connect(filePath, check_same_thread=False)
-			c = connection.cursor()
-			c.execute("INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data, tile_cropped_data, pixel_left, pixel_top, pixel_right, pixel_bottom, has_alpha) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", [
-				z, x, invertedY, None, tileData, 0, 0, 256 * outputScale, 256 * outputScale, 0
-			])
+		return
 
-			connection.commit()
+	@staticmethod
+	def sharesBlankTiles(path, file):
 
-		finally:
-			lock.release()
+		return False
 
+	@staticmethod
+	def addBlankTile(lock, filePath, tileData, x, y, z, outputScale):
 
-		return
\ No newline at end of file
+		# Repo files have no shared image table, blank tiles are stored like any other
+		RepoWriter.addTileData(lock, filePath, tileData, x, y, z, outputScale)
@@ -0,0 +1,83 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from collections import namedtuple
+
+# What a single download attempt tells the scheduler: the message to report,
+# whether the tile is worth another attempt, the server's Retry-After, whether
+# the tile was deferred without being tried, which costs no attempt, and for
+# progress reporting the (x, y, z) tile, its status (downloaded, exists,
+# failed or deferred), the last HTTP status code and the attempt number
+AttemptResult = namedtuple("AttemptResult", ["message", "retry", "retryAfter", "deferred", "tile", "status", "code", "attempt"],
+                           defaults=[False, None, None, None, None])
+
+
+class RetryQueue:
+    """
+    Time ordered heap of failed items waiting for their next attempt.
+
+    Instead of sleeping in a worker, a failed item is pushed with the time of
+    its next attempt: exponential backoff from baseDelay with +/-50% jitter,
+    or the server's Retry-After when that is longer. The scheduler pops items
+    once they are due and keeps the workers busy with other items meanwhile.
+    """
+
+    def __init__(self, maxAttempts, baseDelay=1, maxDelay=300, jitter=0.5):
+        self.maxAttempts = max(1, int(maxAttempts))
+        self.baseDelay = max(0.0, float(baseDelay))
+        self.maxDelay = maxDelay
+        self.jitter = jitter
+        self.heap = []
+        self.counter = itertools.count()  # Keeps equal due times in FIFO order and never compares items
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def backoff(self, attempt, retryAfter=None):
+        """Seconds to wait before the given attempt number (the first retry is attempt 2)"""
+        delay = min(self.maxDelay, self.baseDelay * (2 ** (attempt - 2)))
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        if retryAfter is not None:
+            delay = max(delay, retryAfter)
+        return delay
+
+    def schedule(self, item, attempt, retryAfter=None, deferred=False):
+        """
+        Queue item for attempt number attempt, returns False once it has no attempts left.
+        A deferred item is due after retryAfter, spread out by the jitter so they do not return at once
+        """
+        if attempt > self.maxAttempts:
+            return False
+
+        if deferred:
+            delay = (retryAfter or self.baseDelay) * random.uniform(1, 1 + self.jitter)
+        else:
+            delay = self.backoff(attempt, retryAfter)
+
+        due = time.monotonic() + delay
+        with self.lock:
+            heapq.heappush(self.heap, (due, next(self.counter), item, attempt))
+        return True
+
+    def popDue(self):
+        """Return the (item, attempt) whose time has come, or None"""
+        with self.lock:
+            if self.heap and self.heap[0][0] <= time.monotonic():
+                due, order, item, attempt = heapq.heappop(self.heap)
+                return item, attempt
+        return None
+
+    def nextDue(self):
+        """Seconds until the next item is due, or None when the queue is empty"""
+        with self.lock:
+            if not self.heap:
+                return None
+            return max(0.0, self.heap[0][0] - time.monotonic())
+
+    def clear(self):
+        """Drop every queued item, for jobs that are cancelled"""
+        with self.lock:
+            self.heap.clear()
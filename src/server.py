@@ -2,15 +2,17 @@
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
+from concurrent.futures import ThreadPoolExecutor
 import threading
+import time
 
-from urllib.parse import urlparse
-import cgi
+from urllib.parse import urlparse, parse_qs
+from email.parser import BytesParser
+import email.policy
 import uuid
 import json
 import os
 import base64
-import mimetypes
 import sys
 import logging
 
@@ -18,6 +20,12 @@ from file_writer import FileWriter
 from mbtiles_writer import MbtilesWriter
 from repo_writer import RepoWriter
 from utils import Utils
+from download_job import DownloadJob
+from asset_cache import AssetCache
+from tile_reader import TileReader
+from downloader import get_tile_path, static_output_file
+from tile_encoding import metadata_format, output_file_for_format, parse_tile_format
+import config
 
 # Configure logging
 logging.basicConfig(
@@ -28,6 +36,42 @@ logger = logging.getLogger('tile-server')
 
 lock = threading.Lock()
 
+# Tiles already stored when a download started, keyed by (output type, output path pattern)
+existingIndexes = {}
+
+# Web UI files, compressed once and revalidated against the disk on every request
+assets = AssetCache(config.UI_DIR, config.STATIC_MAX_AGE)
+
+# Stored outputs served back as XYZ tiles by /tiles/{output}/{z}/{x}/{y}
+tileReader = TileReader(config.OUTPUT_DIR, config.TILE_CACHE_SIZE * 1024 * 1024, config.TILE_READ_CONNECTIONS)
+
+# Download jobs run by the server, keyed by job id
+jobs = {}
+jobsLock = threading.Lock()
+
+
+def prune_jobs():
+    """Forget jobs that are done for longer than JOB_TTL, and the oldest done ones beyond MAX_JOBS"""
+    now = time.monotonic()
+    with jobsLock:
+        done = sorted((job for job in jobs.values() if job.isDone()), key=lambda job: job.finishedAt or 0)
+        excess = len(jobs) - config.MAX_JOBS
+        for job in done:
+            if excess > 0 or now - (job.finishedAt or now) > config.JOB_TTL:
+                del jobs[job.id]
+                excess -= 1
+
+# Downloads the tiles of /download-tiles batches in parallel, one thread per pooled connection
+batchExecutor = None
+batchExecutorLock = threading.Lock()
+
+def getBatchExecutor():
+    global batchExecutor
+    with batchExecutorLock:
+        if batchExecutor is None:
+            batchExecutor = ThreadPoolExecutor(max_workers=config.HTTP_POOL_SIZE, thread_name_prefix="batch-tile")
+        return batchExecutor
+
 # Configure download parameters - can be moved to a config file later
 DOWNLOAD_MAX_RETRIES = 5
 DOWNLOAD_TIMEOUT = 60  # seconds
@@ -40,6 +84,12 @@ class serverHandler(BaseHTTPRequestHandler):
     # Add a timeout to prevent hanging connections
     timeout = 120  # 2 minutes timeout
 
+    # Persistent connections for responses that send a Content-Length, the others close the connection
+    protocol_version = "HTTP/1.1"
+
+    # Headers and body are separate writes, without TCP_NODELAY a kept-alive connection stalls on delayed ACKs
+    disable_nagle_algorithm = True
+
     def log_error(self, format, *args):
         """Override to use the logger instead of stderr"""
         logger.error(format % args)
@@ -59,14 +109,17 @@ class serverHandler(BaseHTTPRequestHandler):
         elif(type == "directory"):
             return FileWriter
 
-    def send_json_response(self, result):
+    def send_json_response(self, result, status=200, keepAlive=True):
         """Safely send a JSON response, handling potential broken pipe errors"""
         try:
-            self.send_response(200)
+            body = json.dumps(result).encode('utf-8')
+            self.send_response(status)
             self.send_header("Content-Type", "application/json")
-            self.send_header("Connection", "close")  # Close connection after response
+            self.send_header("Content-Length", str(len(body)))
+            if not keepAlive or self.close_connection:
+                self.send_header("Connection", "close")  # Close connection after response
             self.end_headers()
-            self.wfile.write(json.dumps(result).encode('utf-8'))
+            self.wfile.write(body)
         except BrokenPipeError:
             # Client disconnected, log it and suppress the error
             logger.warning("Client disconnected while sending response")
@@ -78,6 +131,208 @@ class serverHandler(BaseHTTPRequestHandler):
             logger.error(f"Error sending response: {str(e)}")
             return
 
+    def read_body(self):
+        """
+        Read the request body into a dict of parameters. JSON is the fast path,
+        multipart and urlencoded forms are still accepted from older clients
+        """
+        content_len = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(content_len) if content_len > 0 else b''
+        if not body:
+            return {}
+
+        contentType = self.headers.get('Content-Type', '')
+        mediaType = contentType.split(';', 1)[0].strip().lower()
+
+        if mediaType == 'multipart/form-data':
+            return self.parse_multipart(contentType, body)
+        if mediaType == 'application/x-www-form-urlencoded':
+            return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+
+        params = json.loads(body)
+        if not isinstance(params, dict):
+            raise ValueError("Request body must be a JSON object")
+        return params
+
+    def float_list(self, value):
+        """Numbers sent as a JSON list or as a comma separated form field"""
+        if isinstance(value, str):
+            value = value.split(",")
+        return [float(item) for item in value]
+
+    def parse_multipart(self, contentType, body):
+        """Form fields of a multipart/form-data body, as strings"""
+        if 'boundary=' not in contentType:
+            raise ValueError("Multipart request without a boundary")
+
+        message = BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + contentType.encode('latin-1') + b"\r\n\r\n" + body
+        )
+
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name is not None:
+                params[name] = part.get_payload(decode=True).decode('utf-8')
+        return params
+
+    def find_job(self, jobId):
+        with jobsLock:
+            job = jobs.get(jobId)
+        if job is None:
+            self.send_json_response({"code": 404, "message": f"No download job {jobId}"}, status=404)
+        return job
+
+    def handle_job_post(self, path, params):
+        """POST /jobs starts a download job from a JSON definition, POST /jobs/<id>/<action> controls it"""
+        parts = path.strip('/').split('/')
+
+        if len(parts) == 1:
+            job = DownloadJob(params, lock, threads=config.JOB_THREADS, maxRetries=DOWNLOAD_MAX_RETRIES,
+                              timeout=DOWNLOAD_TIMEOUT, retryDelay=DOWNLOAD_RETRY_DELAY)
+            prune_jobs()
+            with jobsLock:
+                jobs[job.id] = job
+            job.start()
+            logger.info(f"Started download job {job.id} into {job.outputDirectory}/{job.outputFile}")
+
+            self.send_json_response({"code": 200, "message": 'Job started', **job.snapshot()})
+            return
+
+        job = self.find_job(parts[1])
+        if job is None:
+            return
+
+        action = parts[2] if len(parts) > 2 else None
+        if action == 'pause':
+            job.pause()
+        elif action == 'resume':
+            job.resume()
+        elif action == 'cancel':
+            job.cancel()
+        else:
+            raise ValueError(f"Unknown job action: {action}")
+
+        self.send_json_response({"code": 200, **job.snapshot()})
+
+    def stream_job_events(self, job):
+        """
+        Server-Sent Events of a job: "tile" and "state" events from its log,
+        and a "progress" snapshot at least twice a second, until the job is done
+        """
+        cursor = int(self.headers.get('Last-Event-ID') or 0)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        while True:
+            events, cursor = job.eventsSince(cursor, timeout=0.5)
+
+            chunks = []
+            for sequence, kind, data in events:
+                chunks.append(f"id: {sequence}\nevent: {kind}\ndata: {json.dumps(data)}\n\n")
+            chunks.append(f"event: progress\ndata: {json.dumps(job.snapshot())}\n\n")
+
+            self.wfile.write("".join(chunks).encode('utf-8'))
+            self.wfile.flush()
+
+            if job.isDone():
+                return
+
+    def download_batch(self, params):
+        """
+        Download a list of tiles in one request. Returns one status code per tile, in
+        order (304 for tiles already stored, 400 for malformed tiles, 503 for tiles
+        deferred while their host's circuit is open, with the seconds to wait listed
+        in deferred), and a small base64 PNG thumbnail for every
+        thumbnailEvery-th tile when asked to, instead of every full tile
+        """
+        source = str(params['source'])
+        outputType = str(params.get('outputType', 'directory'))
+        outputScale = int(params.get('outputScale', 1))
+        timestamp = str(params.get('timestamp', ''))
+        thumbnailEvery = int(params.get('thumbnailEvery', 0))
+        thumbnailSize = int(params.get('thumbnailSize', 64))
+        tileFormat = parse_tile_format(params.get('tileFormat'))
+        tileQuality = int(params.get('tileQuality', 80))
+
+        outputDirectory = str(params['outputDirectory']).replace("{timestamp}", timestamp)
+        outputFile = static_output_file(outputType, str(params['outputFile']).replace("{timestamp}", timestamp))
+        outputFile = output_file_for_format(outputType, outputFile, tileFormat)
+
+        writer = self.writerByType(outputType)
+        existing = existingIndexes.get((outputType, os.path.join("output", outputDirectory, outputFile)))
+
+        def downloadOne(index, tile):
+            # A bad tile gets its own code, the rest of the batch goes on
+            try:
+                if isinstance(tile, dict):
+                    x, y, z = int(tile['x']), int(tile['y']), int(tile['z'])
+                else:
+                    x, y, z = (int(value) for value in tile)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Malformed tile {tile!r} in batch: {str(e)}")
+                return 400, None, None
+
+            try:
+                return storeOne(index, x, y, z)
+            except Exception as e:
+                logger.error(f"Error for batch tile x={x}, y={y}, z={z}: {str(e)}")
+                return 500, None, None
+
+        def storeOne(index, x, y, z):
+            filePath = get_tile_path(outputDirectory, outputFile, x, y, z)
+
+            if existing is not None:
+                tileExists = (x, y, z) in existing
+            else:
+                tileExists = writer.exists(filePath, x, y, z)
+            if tileExists:
+                return 304, None, None
+
+            code, data = Utils.downloadTileData(
+                source,
+                x, y, z,
+                outputScale,
+                max_retries=DOWNLOAD_MAX_RETRIES,
+                timeout=DOWNLOAD_TIMEOUT,
+                retry_delay=DOWNLOAD_RETRY_DELAY,
+                tileFormat=tileFormat,
+                quality=tileQuality
+            )
+            if code == Utils.CIRCUIT_OPEN:
+                return 503, None, Utils.deferredRetryIn(source, x, y, z)
+            if code != 200 or not data:
+                logger.warning(f"Download failed for tile: x={x}, y={y}, z={z}")
+                return (code if code != 200 else 204), None, None
+
+            writer.addTileData(lock, filePath, data, x, y, z, outputScale)
+
+            thumbnail = None
+            if thumbnailEvery > 0 and index % thumbnailEvery == 0:
+                thumbnail = Utils.makeThumbnail(data, thumbnailSize)
+            return 200, thumbnail, None
+
+        tiles = params['tiles']
+        results = list(getBatchExecutor().map(downloadOne, range(len(tiles)), tiles))
+
+        response = {
+            "code": 200,
+            "codes": [code for code, thumbnail, retryAfter in results],
+            "thumbnails": {
+                str(index): base64.b64encode(thumbnail).decode("utf-8")
+                for index, (code, thumbnail, retryAfter) in enumerate(results) if thumbnail is not None
+            },
+            "deferred": {
+                str(index): round(retryAfter, 1)
+                for index, (code, thumbnail, retryAfter) in enumerate(results) if retryAfter is not None
+            },
+        }
+        self.send_json_response(response)
+
     def do_POST(self):
         try:
             # First check if the client is still connected
@@ -85,109 +340,113 @@ class serverHandler(BaseHTTPRequestHandler):
                 logger.warning("Client already disconnected before processing request")
                 return
 
-            ctype, pdict = cgi.parse_header(self.headers.get('Content-Type'))
-            pdict['boundary'] = bytes(pdict['boundary'], "utf-8")
+            params = self.read_body()
 
-            content_len = int(self.headers.get('Content-length'))
-            pdict['CONTENT-LENGTH'] = content_len
+            parts = urlparse(self.path)
+            if parts.path == '/jobs' or parts.path.startswith('/jobs/'):
+                self.handle_job_post(parts.path, params)
+                return
 
-            postvars = cgi.parse_multipart(self.rfile, pdict)
+            if parts.path == '/download-tiles':
+                self.download_batch(params)
+                return
 
-            parts = urlparse(self.path)
             if parts.path == '/download-tile':
-                # Process the download tile request
-                # ...existing code...
-
-                # Use a try-finally block to ensure resource cleanup
-                tempFilePath = None
-                try:
-                    x = int(postvars['x'][0])
-                    y = int(postvars['y'][0])
-                    z = int(postvars['z'][0])
-                    quad = str(postvars['quad'][0])
-                    timestamp = int(postvars['timestamp'][0])
-                    outputDirectory = str(postvars['outputDirectory'][0])
-                    outputFile = str(postvars['outputFile'][0])
-                    outputType = str(postvars['outputType'][0])
-                    outputScale = int(postvars['outputScale'][0])
-                    source = str(postvars['source'][0])
-
-                    replaceMap = {
-                        "x": str(x),
-                        "y": str(y),
-                        "z": str(z),
-                        "quad": quad,
-                        "timestamp": str(timestamp),
-                    }
-
-                    for key, value in replaceMap.items():
-                        newKey = str("{" + str(key) + "}")
-                        outputDirectory = outputDirectory.replace(newKey, value)
-                        outputFile = outputFile.replace(newKey, value)
-
-                    result = {}
-
-                    filePath = os.path.join("output", outputDirectory, outputFile)
-
-                    if self.writerByType(outputType).exists(filePath, x, y, z):
-                        result["code"] = 200
-                        result["message"] = 'Tile already exists'
-                        logger.info(f"Tile exists: {filePath}")
+
+                x = int(params['x'])
+                y = int(params['y'])
+                z = int(params['z'])
+                quad = str(params.get('quad') or Utils.tileXYToQuadKey(x, y, z))
+                timestamp = int(params['timestamp'])
+                outputDirectory = str(params['outputDirectory'])
+                outputFile = str(params['outputFile'])
+                outputType = str(params['outputType'])
+                outputScale = int(params['outputScale'])
+                source = str(params['source'])
+                tileFormat = parse_tile_format(params.get('tileFormat'))
+                tileQuality = int(params.get('tileQuality', 80))
+
+                replaceMap = {
+                    "x": str(x),
+                    "y": str(y),
+                    "z": str(z),
+                    "quad": quad,
+                    "timestamp": str(timestamp),
+                }
+
+                # mbtiles and repo tiles all go to one file, like the CLI does
+                outputFile = static_output_file(outputType, outputFile)
+                outputFile = output_file_for_format(outputType, outputFile, tileFormat)
+
+                timestampKey = "{timestamp}"
+                indexKey = (outputType, os.path.join("output", outputDirectory, outputFile).replace(timestampKey, str(timestamp)))
+
+                for key, value in replaceMap.items():
+                    newKey = str("{" + str(key) + "}")
+                    outputDirectory = outputDirectory.replace(newKey, value)
+                    outputFile = outputFile.replace(newKey, value)
+
+                result = {}
+
+                filePath = os.path.join("output", outputDirectory, outputFile)
+
+                existing = existingIndexes.get(indexKey)
+                if existing is not None:
+                    tileExists = (x, y, z) in existing
+                else:
+                    tileExists = self.writerByType(outputType).exists(filePath, x, y, z)
+
+                if tileExists:
+                    result["code"] = 200
+                    result["message"] = 'Tile already exists'
+                    logger.info(f"Tile exists: {filePath}")
+                else:
+                    # Download straight into memory, the tile never touches temp/
+                    result["code"], data = Utils.downloadTileData(
+                        source,
+                        x, y, z,
+                        outputScale,
+                        max_retries=DOWNLOAD_MAX_RETRIES,
+                        timeout=DOWNLOAD_TIMEOUT,
+                        retry_delay=DOWNLOAD_RETRY_DELAY,
+                        tileFormat=tileFormat,
+                        quality=tileQuality
+                    )
+
+                    source_str = source.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(z))
+                    logger.info(f"Download result for {source_str}: {result['code']}")
+
+                    if result["code"] == Utils.CIRCUIT_OPEN:
+                        # Not lost, the client is told when the tile's host may be tried again
+                        result["code"] = 503
+                        result["deferred"] = True
+                        result["retryAfter"] = round(Utils.deferredRetryIn(source, x, y, z), 1)
+                        result["message"] = 'Tile host is failing, tile deferred'
+                        logger.warning(f"Deferred tile: x={x}, y={y}, z={z}")
+                    elif result["code"] == 200 and data:
+                        self.writerByType(outputType).addTileData(lock, filePath, data, x, y, z, outputScale)
+
+                        result["image"] = base64.b64encode(data).decode("utf-8")
+
+                        result["message"] = 'Tile Downloaded'
+                        logger.info(f"Saved tile: {filePath}")
                     else:
-                        tempFile = self.randomString() + ".png"
-                        tempFilePath = os.path.join("temp", tempFile)
-
-                        # Ensure temp directory exists
-                        os.makedirs(os.path.dirname(tempFilePath), exist_ok=True)
-
-                        # Use the improved download function with retry and timeout parameters
-                        result["code"] = Utils.downloadFileScaled(
-                            source,
-                            tempFilePath,
-                            x, y, z,
-                            outputScale,
-                            max_retries=DOWNLOAD_MAX_RETRIES,
-                            timeout=DOWNLOAD_TIMEOUT,
-                            retry_delay=DOWNLOAD_RETRY_DELAY
-                        )
-
-                        source_str = source.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(z))
-                        logger.info(f"Download result for {source_str}: {result['code']}")
-
-                        if os.path.isfile(tempFilePath):
-                            self.writerByType(outputType).addTile(lock, filePath, tempFilePath, x, y, z, outputScale)
-
-                            with open(tempFilePath, "rb") as image_file:
-                                result["image"] = base64.b64encode(image_file.read()).decode("utf-8")
-
-                            result["message"] = 'Tile Downloaded'
-                            logger.info(f"Saved tile: {filePath}")
-                        else:
-                            result["message"] = 'Download failed'
-                            logger.warning(f"Download failed for tile: x={x}, y={y}, z={z}")
-
-                    self.send_json_response(result)
-
-                finally:
-                    # Clean up temp file if it exists
-                    if tempFilePath and os.path.exists(tempFilePath):
-                        try:
-                            os.remove(tempFilePath)
-                        except Exception as e:
-                            logger.error(f"Error removing temp file: {str(e)}")
+                        result["message"] = 'Download failed'
+                        logger.warning(f"Download failed for tile: x={x}, y={y}, z={z}")
+
+                self.send_json_response(result)
 
             elif parts.path == '/start-download':
-                outputType = str(postvars['outputType'][0])
-                outputScale = int(postvars['outputScale'][0])
-                outputDirectory = str(postvars['outputDirectory'][0])
-                outputFile = str(postvars['outputFile'][0])
-                minZoom = int(postvars['minZoom'][0])
-                maxZoom = int(postvars['maxZoom'][0])
-                timestamp = int(postvars['timestamp'][0])
-                bounds = str(postvars['bounds'][0])
-                boundsArray = map(float, bounds.split(","))
-                center = str(postvars['center'][0])
-                centerArray = map(float, center.split(","))
+                outputType = str(params['outputType'])
+                outputScale = int(params['outputScale'])
+                outputDirectory = str(params['outputDirectory'])
+                outputFile = str(params['outputFile'])
+                minZoom = int(params['minZoom'])
+                maxZoom = int(params['maxZoom'])
+                timestamp = int(params['timestamp'])
+                boundsArray = self.float_list(params['bounds'])
+                centerArray = self.float_list(params['center'])
+                tileFormat = parse_tile_format(params.get('tileFormat'))
 
                 replaceMap = {
                     "timestamp": str(timestamp),
@@ -198,9 +457,16 @@ class serverHandler(BaseHTTPRequestHandler):
                     outputDirectory = outputDirectory.replace(newKey, value)
                     outputFile = outputFile.replace(newKey, value)
 
+                outputFile = static_output_file(outputType, outputFile)
+                outputFile = output_file_for_format(outputType, outputFile, tileFormat)
                 filePath = os.path.join("output", outputDirectory, outputFile)
 
-                self.writerByType(outputType).addMetadata(lock, os.path.join("output", outputDirectory), filePath, outputFile, "Map Tiles Downloader via AliFlux", "png", boundsArray, centerArray, minZoom, maxZoom, "mercator", 256 * outputScale)
+                self.writerByType(outputType).addMetadata(lock, os.path.join("output", outputDirectory), filePath, outputFile, "Map Tiles Downloader via AliFlux", metadata_format(tileFormat), boundsArray, centerArray, minZoom, maxZoom, "mercator", 256 * outputScale)
+
+                existing = self.writerByType(outputType).existingTiles(filePath, minZoom, maxZoom)
+                if existing is not None:
+                    existingIndexes[(outputType, filePath)] = existing
+                    logger.info(f"Found {len(existing)} tiles already stored in {filePath}")
 
                 result = {}
                 result["code"] = 200
@@ -210,17 +476,16 @@ class serverHandler(BaseHTTPRequestHandler):
                 return
 
             elif parts.path == '/end-download':
-                outputType = str(postvars['outputType'][0])
-                outputScale = int(postvars['outputScale'][0])
-                outputDirectory = str(postvars['outputDirectory'][0])
-                outputFile = str(postvars['outputFile'][0])
-                minZoom = int(postvars['minZoom'][0])
-                maxZoom = int(postvars['maxZoom'][0])
-                timestamp = int(postvars['timestamp'][0])
-                bounds = str(postvars['bounds'][0])
-                boundsArray = map(float, bounds.split(","))
-                center = str(postvars['center'][0])
-                centerArray = map(float, center.split(","))
+                outputType = str(params['outputType'])
+                outputScale = int(params['outputScale'])
+                outputDirectory = str(params['outputDirectory'])
+                outputFile = str(params['outputFile'])
+                minZoom = int(params['minZoom'])
+                maxZoom = int(params['maxZoom'])
+                timestamp = int(params['timestamp'])
+                boundsArray = self.float_list(params['bounds'])
+                centerArray = self.float_list(params['center'])
+                tileFormat = parse_tile_format(params.get('tileFormat'))
 
                 replaceMap = {
                     "timestamp": str(timestamp),
@@ -231,9 +496,12 @@ class serverHandler(BaseHTTPRequestHandler):
                     outputDirectory = outputDirectory.replace(newKey, value)
                     outputFile = outputFile.replace(newKey, value)
 
+                outputFile = static_output_file(outputType, outputFile)
+                outputFile = output_file_for_format(outputType, outputFile, tileFormat)
                 filePath = os.path.join("output", outputDirectory, outputFile)
 
                 self.writerByType(outputType).close(lock, os.path.join("output", outputDirectory), filePath, minZoom, maxZoom)
+                existingIndexes.pop((outputType, filePath), None)
 
                 result = {}
                 result["code"] = 200
@@ -242,23 +510,90 @@ class serverHandler(BaseHTTPRequestHandler):
                 self.send_json_response(result)
                 return
 
+            else:
+                self.send_json_response({"code": 404, "message": f"Unknown endpoint {parts.path}"}, status=404)
+
         except BrokenPipeError:
             logger.warning("Client disconnected during request processing")
             return
         except ConnectionResetError:
             logger.warning("Connection reset by client during request processing")
             return
+        except (ValueError, KeyError) as e:
+            # Malformed body or missing field, the client has to fix its request
+            logger.warning(f"Bad request to {self.path}: {str(e)}")
+            self.send_json_response({"error": f"Bad request: {str(e)}"}, status=400, keepAlive=False)
         except Exception as e:
             logger.error(f"Error in do_POST: {str(e)}", exc_info=True)
-            try:
-                self.send_response(500)
-                self.send_header("Content-Type", "application/json")
-                self.send_header("Connection", "close")
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": str(e)}).encode('utf-8'))
-            except:
-                logger.error("Failed to send error response", exc_info=True)
-                return
+            self.send_json_response({"error": str(e)}, status=500, keepAlive=False)
+
+    def send_asset(self, asset):
+        """Send a cached UI file in the best encoding the client accepts, or 304 when its copy is current"""
+        encoding = assets.encoding(asset, self.headers.get('Accept-Encoding'))
+        etag = asset.etags[encoding]
+
+        if assets.notModified(asset, self.headers.get('If-None-Match')):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", asset.cacheControl)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+
+        body = asset.bodies[encoding]
+        self.send_response(200)
+        self.send_header("Content-Type", asset.contentType)
+        if encoding != "identity":
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", asset.cacheControl)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stored_tile(self, path):
+        """GET /tiles/{output}/{z}/{x}/{y}: a tile of a finished or running download, 404 when it is not stored"""
+        parts = path.split('/')
+        if len(parts) < 5:
+            self.send_json_response({"code": 404, "message": "Expected /tiles/{output}/{z}/{x}/{y}"}, status=404)
+            return
+
+        output = '/'.join(parts[1:-3])
+        try:
+            z, x = int(parts[-3]), int(parts[-2])
+            y = int(parts[-1].split('.')[0])
+        except ValueError:
+            self.send_json_response({"code": 400, "message": "Tile coordinates must be integers"}, status=400)
+            return
+
+        tile = None
+        if 0 <= z <= 30 and 0 <= x < 2 ** z and 0 <= y < 2 ** z:
+            tile = tileReader.tile(output, x, y, z)
+
+        if tile is None:
+            self.send_response(404)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        ifNoneMatch = [tag.strip().removeprefix("W/") for tag in self.headers.get('If-None-Match', "").split(",")]
+        if tile.etag in ifNoneMatch or "*" in ifNoneMatch:
+            self.send_response(304)
+            self.send_header("ETag", tile.etag)
+            self.send_header("Cache-Control", f"public, max-age={config.TILE_MAX_AGE}")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", tile.contentType)
+        self.send_header("ETag", tile.etag)
+        self.send_header("Cache-Control", f"public, max-age={config.TILE_MAX_AGE}")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Content-Length", str(len(tile.data)))
+        self.end_headers()
+        self.wfile.write(tile.data)
 
     def do_GET(self):
         try:
@@ -270,27 +605,54 @@ class serverHandler(BaseHTTPRequestHandler):
                 # Get token from environment variable or use default
                 mapbox_token = os.environ.get("MAPBOX_ACCESS_TOKEN", DEFAULT_MAPBOX_TOKEN)
 
-                self.send_response(200)
-                self.send_header("Content-Type", "application/json")
-                self.end_headers()
-
                 # Return token as JSON
-                token_response = {"token": mapbox_token}
-                self.wfile.write(json.dumps(token_response).encode('utf-8'))
+                self.send_json_response({"token": mapbox_token})
+                return
+
+            # Download jobs: a list, one job's progress, or its Server-Sent Events stream
+            if path == "jobs" or path.startswith("jobs/"):
+                jobParts = path.split('/')
+                if len(jobParts) == 1:
+                    prune_jobs()
+                    with jobsLock:
+                        snapshots = [job.snapshot() for job in jobs.values()]
+                    self.send_json_response({"code": 200, "jobs": snapshots})
+                    return
+
+                job = self.find_job(jobParts[1])
+                if job is None:
+                    return
+
+                if len(jobParts) > 2 and jobParts[2] == "events":
+                    self.stream_job_events(job)
+                else:
+                    self.send_json_response({"code": 200, **job.snapshot()})
+                return
+
+            if path.startswith("tiles/"):
+                self.send_stored_tile(path)
+                return
+
+            if path == "tile-cache-stats":
+                self.send_json_response(tileReader.cache.stats())
+                return
+
+            # Connections opened vs. reused by the tile fetching pool
+            if path == "connection-stats":
+                self.send_json_response(Utils.connectionStats())
                 return
 
             if path == "":
                 path = "index.htm"
 
-            file = os.path.join("./UI/", path)
-            mime = mimetypes.MimeTypes().guess_type(file)[0]
-
-            self.send_response(200)
-            self.send_header("Content-Type", mime)
-            self.end_headers()
+            asset = assets.get(path)
+            if asset is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
 
-            with open(file, "rb") as f:
-                self.wfile.write(f.read())
+            self.send_asset(asset)
         except BrokenPipeError:
             logger.warning("Client disconnected unexpectedly")
             return
@@ -298,6 +660,7 @@ class serverHandler(BaseHTTPRequestHandler):
             logger.error(f"Error in do_GET: {str(e)}", exc_info=True)
             try:
                 self.send_response(404)
+                self.send_header("Content-Length", "0")
                 self.end_headers()
             except:
                 logger.error("Failed to send 404 response", exc_info=True)
@@ -315,6 +678,11 @@ class serverThreadedHandler(ThreadingMixIn, HTTPServer):
 
 def run():
     print('Starting Server...')
+    Utils.configureSession(config.HTTP_POOL_SIZE, config.HTTP_POOL_HOSTS)
+    Utils.configureImageStage(config.COMPOSITE_PROCESSES, config.COMPOSITE_QUEUE or None)
+    Utils.configureRateLimit(config.RATE_LIMIT, config.RATE_LIMIT_BURST)
+    Utils.configureCircuitBreaker(config.BREAKER_FAILURE_RATIO, config.BREAKER_WINDOW, config.BREAKER_OPEN_TIME)
+    assets.preload()
     server_address = ('', 8080)
     httpd = serverThreadedHandler(server_address, serverHandler)
     print('Running Server...')
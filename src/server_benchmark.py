@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark of the web server's /download-tile endpoint.
+
+Starts a local tile source and the tile server in this process, then
+measures requests per second for multipart bodies on a new connection per
+request (how the server was used before it kept connections open), for
+multipart on persistent connections, and for JSON on persistent connections.
+
+    python server_benchmark.py --requests 2000 --clients 8
+"""
+
+import argparse
+import http.client
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+def tile_bytes():
+    buffer = io.BytesIO()
+    Image.new("RGB", (256, 256), (10, 120, 200)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class TileSourceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    tile = tile_bytes()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.tile)))
+        self.end_headers()
+        self.wfile.write(self.tile)
+
+
+def start(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.server_address[1]
+
+
+def tile_fields(source, x, y):
+    return {
+        "x": x, "y": y, "z": 18, "quad": "",
+        "timestamp": 0,
+        "outputDirectory": "benchmark",
+        "outputFile": "{z}/{x}/{y}.png",
+        "outputType": "directory",
+        "outputScale": 1,
+        "source": source,
+    }
+
+
+def multipart_body(fields):
+    boundary = uuid.uuid4().hex
+    lines = []
+    for name, value in fields.items():
+        lines.append(f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n")
+    lines.append(f"--{boundary}--\r\n")
+    return "".join(lines).encode("utf-8"), f"multipart/form-data; boundary={boundary}"
+
+
+def run_client(port, source, mode, row, tiles, results):
+    connection = None
+    for x in tiles:
+        fields = tile_fields(source, x, row)
+        if mode == "json":
+            body, contentType = json.dumps(fields).encode("utf-8"), "application/json"
+        else:
+            body, contentType = multipart_body(fields)
+
+        headers = {"Content-Type": contentType}
+        if mode == "multipart-close":
+            headers["Connection"] = "close"
+
+        if connection is None:
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+        connection.request("POST", "/download-tile", body, headers)
+        response = connection.getresponse()
+        results.append(json.loads(response.read())["code"])
+
+        if response.will_close:
+            connection.close()
+            connection = None
+
+    if connection is not None:
+        connection.close()
+
+
+def benchmark(port, source, mode, row, requests, clients):
+    results = []
+    threads = [
+        threading.Thread(target=run_client, args=(port, source, mode, row, range(client, requests, clients), results))
+        for client in range(clients)
+    ]
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    failed = sum(1 for code in results if code != 200)
+    return requests / elapsed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the /download-tile endpoint')
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per mode (default: 1000)')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent client connections (default: 8)')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    # Tiles are written relative to the working directory, keep them out of the real output
+    workdir = tempfile.mkdtemp(prefix="tile-server-benchmark-")
+    os.chdir(workdir)
+
+    import server
+    from utils import Utils
+
+    Utils.configureSession(args.clients)
+    sourcePort = start(ThreadingHTTPServer(("127.0.0.1", 0), TileSourceHandler))
+    serverPort = start(server.serverThreadedHandler(("127.0.0.1", 0), server.serverHandler))
+    source = f"http://127.0.0.1:{sourcePort}/{{z}}/{{x}}/{{y}}.png"
+
+    print(f"{args.requests} requests per mode, {args.clients} clients, tiles written to {workdir}")
+    for row, mode in enumerate(["multipart-close", "multipart", "json"]):
+        rate, failed = benchmark(serverPort, source, mode, row, args.requests, args.clients)
+        print(f"{mode:>16}: {rate:8.1f} requests/s" + (f" ({failed} failed)" if failed else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import sqlite3
+import threading
+import queue
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger("tile-downloader")
+
+# Queue markers used to talk to the flush thread
+_FLUSH = object()
+_CLOSE = object()
+
+
+class SqliteBatchWriter:
+    """
+    Long-lived writer for a single SQLite tile database (MBTiles or repo).
+
+    Owns one connection for the lifetime of the job. Worker threads hand rows
+    over through a queue and a background thread inserts them with
+    executemany, one transaction per batch. A batch is committed when it
+    reaches batchSize rows or when flushInterval seconds have passed since
+    its first row, whichever comes first.
+
+    insertSql may also be a list of statements, in which case each queued row
+    is a tuple holding one parameter row per statement, or None to skip that
+    statement for the tile. The statements run in order within the batch.
+    """
+
+    def __init__(self, file, insertSql, batchSize=500, flushInterval=1.0,
+                 synchronous="NORMAL", pageSize=4096, journalMode="WAL"):
+        self.file = file
+        self.insertSql = insertSql
+        self.batchSize = max(1, int(batchSize))
+        self.flushInterval = max(0.0, float(flushInterval))
+
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.connectionLock = threading.Lock()
+
+        c = self.connection.cursor()
+        # page_size only takes effect before the database file is first written
+        c.execute(f"PRAGMA page_size = {int(pageSize)};")
+        c.execute(f"PRAGMA journal_mode = {journalMode};")
+        c.execute(f"PRAGMA synchronous = {synchronous};")
+
+        self.queue = queue.Queue(maxsize=self.batchSize * 4)
+        self.pending = set()
+        self.pendingLock = threading.Lock()
+        self.error = None
+        self.tilesWritten = 0
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._run, name=f"sqlite-writer:{file}", daemon=True)
+        self.thread.start()
+
+    @contextmanager
+    def transaction(self):
+        """Run statements on the writer's connection, committing at the end"""
+        with self.connectionLock:
+            c = self.connection.cursor()
+            try:
+                yield c
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                raise
+
+    def add(self, key, row):
+        """Queue a row for insertion. key identifies the tile as (x, y, z)"""
+        if self.closed:
+            raise RuntimeError(f"Writer for {self.file} is closed")
+        if self.error is not None:
+            raise self.error
+
+        with self.pendingLock:
+            self.pending.add(key)
+        self.queue.put((key, row))
+
+    def isPending(self, key):
+        """True if the tile was queued but not committed yet"""
+        with self.pendingLock:
+            return key in self.pending
+
+    def flush(self):
+        """Block until everything queued so far has been committed"""
+        done = threading.Event()
+        self.queue.put((_FLUSH, done))
+        done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Commit pending rows, stop the flush thread and close the connection"""
+        if self.closed:
+            return
+        self.closed = True
+
+        done = threading.Event()
+        self.queue.put((_CLOSE, done))
+        done.wait()
+        self.thread.join()
+
+        with self.connectionLock:
+            self.connection.close()
+
+        if self.error is not None:
+            raise self.error
+
+    def _write(self, batch):
+        if not batch:
+            return
+
+        try:
+            with self.transaction() as c:
+                if isinstance(self.insertSql, str):
+                    c.executemany(self.insertSql, [row for key, row in batch])
+                else:
+                    for i, sql in enumerate(self.insertSql):
+                        c.executemany(sql, [row[i] for key, row in batch if row[i] is not None])
+            self.tilesWritten += len(batch)
+        except Exception as e:
+            logger.error(f"Failed to write {len(batch)} tiles to {self.file}: {str(e)}")
+            self.error = e
+
+        with self.pendingLock:
+            for key, row in batch:
+                self.pending.discard(key)
+
+    def _run(self):
+        batch = []
+        deadline = None
+
+        while True:
+            timeout = None
+            if batch:
+                timeout = max(0.0, deadline - time.monotonic())
+
+            try:
+                key, value = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                # Time window elapsed, commit whatever we have
+                self._write(batch)
+                batch = []
+                continue
+
+            if key is _FLUSH or key is _CLOSE:
+                self._write(batch)
+                batch = []
+                value.set()
+                if key is _CLOSE:
+                    return
+                continue
+
+            if not batch:
+                deadline = time.monotonic() + self.flushInterval
+            batch.append((key, value))
+
+            if len(batch) >= self.batchSize:
+                self._write(batch)
+                batch = []
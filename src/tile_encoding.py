@@ -0,0 +1,108 @@
+import io
+import logging
+import os
+
+from PIL import Image
+
+from tile_reader import tile_content_type
+
+logger = logging.getLogger('tile-downloader')
+
+# Encodings tiles can be stored in: as received from the server (2x tiles are merged to PNG),
+# re-encoded PNG, PNG quantized to a 256 color palette, JPEG or WebP
+TILE_FORMATS = ("original", "png", "png8", "jpeg", "webp")
+
+# Value of the MBTiles/metadata.json format field and file extension of each encoding
+FORMAT_NAMES = {"original": "png", "png": "png", "png8": "png", "jpeg": "jpg", "webp": "webp"}
+
+# Format field of tiles stored as the provider sent them, by their media type
+STORED_FORMATS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp", "application/x-protobuf": "pbf"}
+
+# Media type a tile already has when converting it again would only lose quality
+LOSSY_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+# Status of a tile that cannot be converted because it is not an image
+UNSUPPORTED_MEDIA_TYPE = 415
+
+
+def metadata_format(tile_format):
+    return FORMAT_NAMES.get(tile_format or "original", "png")
+
+
+def stored_format(data):
+    """The MBTiles/metadata.json format field matching stored tile bytes, None when they are not recognized"""
+    return STORED_FORMATS.get(tile_content_type(data)) if data else None
+
+
+def output_file_for_format(output_type, output_file, tile_format):
+    """The tile path pattern of a directory output with the file extension of tile_format"""
+    if output_type in ("mbtiles", "repo") or not tile_format or tile_format == "original":
+        return output_file
+
+    root, extension = os.path.splitext(output_file)
+    wanted = "." + FORMAT_NAMES[tile_format]
+    if extension.lower() == wanted or (wanted == ".jpg" and extension.lower() == ".jpeg"):
+        return output_file
+    return root + wanted
+
+
+def encode_image(image, tile_format="png", quality=80):
+    """Encode a PIL image in one of TILE_FORMATS, original meaning PNG"""
+    buffer = io.BytesIO()
+    transparent = "A" in image.getbands() or "transparency" in image.info
+
+    if tile_format == "jpeg":
+        # JPEG has no alpha channel, transparent areas turn black
+        if transparent:
+            background = Image.new("RGB", image.size)
+            image = image.convert("RGBA")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        image.convert("RGB").save(buffer, "JPEG", quality=quality, optimize=True)
+
+    elif tile_format == "webp":
+        image = image.convert("RGBA" if transparent else "RGB")
+        image.save(buffer, "WEBP", quality=quality, method=4)
+
+    elif tile_format == "png8":
+        # Octree quantization is the one that keeps alpha
+        if transparent:
+            image = image.convert("RGBA").quantize(256, method=Image.Quantize.FASTOCTREE)
+        elif image.mode != "P":
+            image = image.convert("RGB").quantize(256)
+        image.save(buffer, "PNG", optimize=True)
+
+    elif tile_format == "png":
+        image.save(buffer, "PNG", optimize=True)
+
+    else:
+        image.save(buffer, "PNG")
+
+    return buffer.getvalue()
+
+
+def parse_tile_format(tile_format):
+    tile_format = str(tile_format or "original").lower()
+    if tile_format not in TILE_FORMATS:
+        raise ValueError(f"Unknown tile format {tile_format}, expected one of {', '.join(TILE_FORMATS)}")
+    return tile_format
+
+
+def transcode_tile(data, tile_format, quality=80):
+    """
+    Convert downloaded tile bytes to tile_format, returns (code, data). A
+    JPEG or WebP tile already in the wanted format is kept as it is, and
+    bytes that are not an image fail with UNSUPPORTED_MEDIA_TYPE
+    """
+    if not tile_format or tile_format == "original" or not data:
+        return 200, data
+
+    if LOSSY_TYPES.get(tile_format) == tile_content_type(data):
+        return 200, data
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return 200, encode_image(image, tile_format, quality)
+    except Exception as e:
+        logger.error(f"Could not convert tile to {tile_format}: {str(e)}")
+        return UNSUPPORTED_MEDIA_TYPE, None
@@ -0,0 +1,47 @@
+from array import array
+from bisect import bisect_left
+
+
+class TileIndex:
+    """
+    Compact, read-only set of tiles already present in an output store.
+
+    Tiles are grouped by zoom level; each zoom keeps a sorted array of 64-bit
+    keys (x << 32 | y), so membership is a binary search and the whole index
+    costs 8 bytes per stored tile.
+    """
+
+    def __init__(self):
+        self.zooms = {}
+
+    @staticmethod
+    def fromTiles(tiles):
+        """Build an index from an iterable of (x, y, z) tuples"""
+        pending = {}
+        for x, y, z in tiles:
+            keys = pending.get(z)
+            if keys is None:
+                keys = pending[z] = array("Q")
+            keys.append((x << 32) | y)
+
+        index = TileIndex()
+        for z, keys in pending.items():
+            index.zooms[z] = array("Q", sorted(set(keys)))
+
+        return index
+
+    def __contains__(self, tile):
+        x, y, z = tile
+        keys = self.zooms.get(z)
+        if not keys:
+            return False
+
+        key = (x << 32) | y
+        i = bisect_left(keys, key)
+        return i < len(keys) and keys[i] == key
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.zooms.values())
+
+    def countAtZoom(self, z):
+        return len(self.zooms.get(z, ()))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+Vectorized Web Mercator tile geometry.
+
+Every function accepts scalars or NumPy arrays and works on whole zoom levels
+or tile blocks at once, instead of one Python math call per tile.
+"""
+
+import numpy as np
+
+# Largest number of tiles materialized at once when enumerating a block
+CHUNK_SIZE = 65536
+
+
+def lon_to_x(lon, zoom):
+    n = np.exp2(zoom)
+    return np.trunc((np.asarray(lon, dtype=np.float64) + 180) / 360 * n).astype(np.int64)
+
+
+def lat_to_y(lat, zoom):
+    n = np.exp2(zoom)
+    lat_rad = np.radians(np.asarray(lat, dtype=np.float64))
+    return np.trunc((1 - np.log(np.tan(lat_rad) + 1 / np.cos(lat_rad)) / np.pi) / 2 * n).astype(np.int64)
+
+
+def x_to_lon(x, zoom):
+    return np.asarray(x, dtype=np.float64) / np.exp2(zoom) * 360 - 180
+
+
+def y_to_lat(y, zoom):
+    n = np.pi - 2 * np.pi * np.asarray(y, dtype=np.float64) / np.exp2(zoom)
+    return np.degrees(np.arctan(np.sinh(n)))
+
+
+def num2deg(xtile, ytile, zoom):
+    """Vectorized Utils.num2deg, returns (lat, lon) arrays of the tiles' north-west corners"""
+    return y_to_lat(ytile, zoom), x_to_lon(xtile, zoom)
+
+
+def tile_ranges(min_lon, min_lat, max_lon, max_lat, zooms):
+    """Return (min_x, max_x, min_y, max_y) arrays of the tiles covering the bounds at each zoom"""
+    zooms = np.asarray(zooms, dtype=np.int64)
+    min_x = lon_to_x(min_lon, zooms)
+    max_x = lon_to_x(max_lon, zooms)
+    min_y = lat_to_y(max_lat, zooms)  # Note: y is inverted
+    max_y = lat_to_y(min_lat, zooms)
+    return min_x, max_x, min_y, max_y
+
+
+def tile_counts(min_lon, min_lat, max_lon, max_lat, zooms):
+    """Number of tiles covering the bounds at each zoom"""
+    min_x, max_x, min_y, max_y = tile_ranges(min_lon, min_lat, max_lon, max_lat, zooms)
+    return np.maximum(0, max_x - min_x + 1) * np.maximum(0, max_y - min_y + 1)
+
+
+def tile_bounds(x, y, zoom):
+    """Return (west, south, east, north) arrays of the tiles' corners in lon/lat"""
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    return x_to_lon(x, zoom), y_to_lat(y + 1, zoom), x_to_lon(x + 1, zoom), y_to_lat(y, zoom)
+
+
+def block_tiles(min_x, max_x, min_y, max_y):
+    """
+    Yield (xs, ys) arrays covering a block of tiles row by row (y, then x),
+    at most CHUNK_SIZE tiles at a time
+    """
+    width = max_x - min_x + 1
+    if width <= 0 or max_y < min_y:
+        return
+
+    columns = np.arange(min_x, max_x + 1, dtype=np.int64)
+    rows_per_chunk = max(1, CHUNK_SIZE // width)
+
+    for row in range(min_y, max_y + 1, rows_per_chunk):
+        rows = np.arange(row, min(row + rows_per_chunk, max_y + 1), dtype=np.int64)
+        yield np.tile(columns, len(rows)), np.repeat(rows, width)
+
+
+def child_tiles(x, y):
+    """Return (xs, ys) of the four children of each tile, in Utils.getChildTiles order"""
+    x = np.asarray(x, dtype=np.int64) * 2
+    y = np.asarray(y, dtype=np.int64) * 2
+    return (np.stack([x, x + 1, x + 1, x], axis=-1).ravel(),
+            np.stack([y, y, y + 1, y + 1], axis=-1).ravel())
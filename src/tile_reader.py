@@ -0,0 +1,245 @@
+import hashlib
+import logging
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger('tile-server')
+
+# A stored tile ready to be served, the ETag is derived from its bytes
+Tile = namedtuple("Tile", ["data", "contentType", "etag"])
+
+# File extensions tried, in order, for tiles of a {z}/{x}/{y} directory output
+TILE_EXTENSIONS = ("png", "jpg", "jpeg", "webp", "pbf")
+
+
+def tile_content_type(data):
+    """Guess the media type of tile bytes from their signature"""
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data[0:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith(b"\x1f\x8b"):
+        return "application/x-protobuf"
+    return "application/octet-stream"
+
+
+def make_tile(data):
+    return Tile(data, tile_content_type(data), '"' + hashlib.blake2b(data, digest_size=8).hexdigest() + '"')
+
+
+class SqliteTileStore:
+    """
+    Read side of an MBTiles or repo database. Rows are stored in the TMS
+    scheme, so y is flipped before the lookup. Connections are opened read
+    only, kept in a pool and shared by the request threads, which read
+    concurrently with a download still writing to the database thanks to WAL.
+    """
+
+    def __init__(self, file, poolSize=8):
+        self.file = file
+        self.uri = pathlib.Path(os.path.abspath(file)).as_uri() + "?mode=ro"
+        self.poolSize = poolSize
+        self.pool = queue.LifoQueue()
+
+        connection = self.connect()
+        try:
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(tiles)")]
+        finally:
+            self.release(connection)
+
+        # Repo databases keep the tile in tile_cropped_data and leave tile_data empty
+        data = "COALESCE(tile_data, tile_cropped_data)" if "tile_cropped_data" in columns else "tile_data"
+        self.selectSql = f"SELECT {data} FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?"
+
+    def connect(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            connection = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+            connection.execute("PRAGMA query_only = 1;")
+            return connection
+
+    def release(self, connection):
+        if self.pool.qsize() < self.poolSize:
+            self.pool.put(connection)
+        else:
+            connection.close()
+
+    def version(self):
+        """Changes whenever the database or its write-ahead log is written"""
+        version = []
+        for file in (self.file, self.file + "-wal"):
+            try:
+                stat = os.stat(file)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                version.append(None)
+        return tuple(version)
+
+    def read(self, x, y, z):
+        connection = self.connect()
+        try:
+            row = connection.execute(self.selectSql, (z, x, (2 ** z) - y - 1)).fetchone()
+        finally:
+            self.release(connection)
+
+        if row is None or row[0] is None:
+            return None
+        return make_tile(bytes(row[0]))
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class DirectoryTileStore:
+    """Read side of a FileWriter output laid out as {z}/{x}/{y}.{extension}"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, x, y, z):
+        base = os.path.join(self.directory, str(z), str(x), str(y))
+        for extension in TILE_EXTENSIONS:
+            file = base + "." + extension
+            if os.path.isfile(file):
+                return file
+        return None
+
+    def read(self, x, y, z):
+        file = self.path(x, y, z)
+        if file is None:
+            return None
+
+        with open(file, "rb") as f:
+            return make_tile(f.read())
+
+    def close(self):
+        pass
+
+
+class TileCache:
+    """Least recently used tiles, bounded by the total size of their data"""
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            tile = self.entries.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile):
+        if len(tile.data) > self.maxBytes:
+            return
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.data)
+
+            self.entries[key] = tile
+            self.size += len(tile.data)
+
+            while self.size > self.maxBytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.data)
+
+    def stats(self):
+        with self.lock:
+            return {"tiles": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+class TileReader:
+    """
+    Serves tiles of the outputs below root to the /tiles endpoint.
+
+    An output is a path relative to root: an MBTiles or repo file, a
+    directory holding one, or a {z}/{x}/{y} directory of tile files. Stores
+    are opened once and kept. Hot tiles are served from a shared LRU cache.
+    A cached tile of a database is dropped as soon as the database is
+    written, and one of a directory once its file changes.
+    """
+
+    def __init__(self, root, cacheBytes=64 * 1024 * 1024, poolSize=8):
+        self.root = os.path.realpath(root)
+        self.poolSize = poolSize
+        self.cache = TileCache(cacheBytes)
+        self.stores = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, output):
+        """The database file or tile directory of an output, or None when there is none"""
+        path = os.path.realpath(os.path.join(self.root, output))
+        if os.path.commonpath([self.root, path]) != self.root:
+            return None
+
+        if os.path.isfile(path):
+            return path if path.endswith((".mbtiles", ".repo")) else None
+
+        if os.path.isdir(path):
+            databases = sorted(name for name in os.listdir(path) if name.endswith((".mbtiles", ".repo")))
+            if databases:
+                return os.path.join(path, databases[0])
+            return path
+
+        return None
+
+    def store(self, output):
+        path = self.resolve(output)
+        if path is None:
+            return None
+
+        with self.lock:
+            store = self.stores.get(path)
+            if store is None:
+                store = SqliteTileStore(path, self.poolSize) if os.path.isfile(path) else DirectoryTileStore(path)
+                self.stores[path] = store
+            return store
+
+    def tile(self, output, x, y, z):
+        """Return the Tile at x, y, z of an output, or None when the output or tile does not exist"""
+        store = self.store(output)
+        if store is None:
+            return None
+
+        if isinstance(store, DirectoryTileStore):
+            file = store.path(x, y, z)
+            if file is None:
+                return None
+            stat = os.stat(file)
+            key = (file, stat.st_mtime_ns, stat.st_size)
+        else:
+            key = (store.file, store.version(), x, y, z)
+
+        tile = self.cache.get(key)
+        if tile is None:
+            tile = store.read(x, y, z)
+            if tile is not None:
+                self.cache.put(key, tile)
+        return tile
+
+    def close(self):
+        with self.lock:
+            for store in self.stores.values():
+                store.close()
+            self.stores.clear()
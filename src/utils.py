@@ -2,13 +2,24 @@
 
 import requests
 import uuid
+import io
 import os
 import math
 import time
 import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 
 from PIL import Image
 
+from rate_limiter import RateLimiter
+from counting_adapter import ConnectionCounter, CountingAdapter
+from circuit_breaker import CircuitBreaker
+from image_stage import ImageStage
+from tile_encoding import encode_image, transcode_tile
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -18,6 +29,154 @@ logger = logging.getLogger("tile-downloader")
 
 class Utils:
 
+    # Shared keep-alive session, one connection pool per tile host for up to poolHosts hosts
+    session = None
+    sessionLock = threading.Lock()
+    poolSize = 10
+    poolHosts = 10
+
+    # Connections opened and requests sent by every session of this process
+    connectionCounter = ConnectionCounter()
+
+    # Fetches the four children of 2x tiles concurrently, one worker per pooled connection
+    childExecutor = None
+    childExecutorLock = threading.Lock()
+
+    # Optional process pool stage decoding, merging and encoding 2x tiles apart from the download threads
+    imageStage = None
+
+    # Optional per-host token bucket consulted before every HTTP attempt
+    rateLimiter = None
+
+    # Optional per-host circuit breaker failing requests fast while a host is down
+    circuitBreaker = None
+
+    # Optional callable(url, status, latency, retryAfter) told about every HTTP attempt
+    responseObserver = None
+
+    # Code of an attempt rejected by an open circuit, the tile was deferred rather than tried
+    CIRCUIT_OPEN = -1
+
+    @staticmethod
+    def createSession():
+        session = requests.Session()
+        adapter = CountingAdapter(Utils.connectionCounter, pool_connections=Utils.poolHosts,
+                                  pool_maxsize=Utils.poolSize, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["Connection"] = "keep-alive"
+        return session
+
+    @staticmethod
+    def configureSession(poolSize=None, poolHosts=None):
+        """(Re)create the shared HTTP session with poolSize keep-alive connections per host, for up to poolHosts hosts"""
+        if poolSize is not None:
+            Utils.poolSize = max(1, int(poolSize))
+        if poolHosts is not None:
+            Utils.poolHosts = max(1, int(poolHosts))
+
+        with Utils.sessionLock:
+            previous = Utils.session
+            Utils.session = Utils.createSession()
+
+        if previous is not None:
+            previous.close()
+
+        return Utils.session
+
+    @staticmethod
+    def getSession():
+        session = Utils.session
+        if session is None:
+            with Utils.sessionLock:
+                if Utils.session is None:
+                    Utils.session = Utils.createSession()
+                session = Utils.session
+        return session
+
+    @staticmethod
+    def connectionStats():
+        """Connections opened vs. requests sent by the shared sessions of this process"""
+        return Utils.connectionCounter.stats()
+
+    @staticmethod
+    def getChildExecutor():
+        executor = Utils.childExecutor
+        if executor is None:
+            with Utils.childExecutorLock:
+                if Utils.childExecutor is None:
+                    Utils.childExecutor = ThreadPoolExecutor(
+                        max_workers=Utils.poolSize, thread_name_prefix="child-fetch"
+                    )
+                executor = Utils.childExecutor
+        return executor
+
+    @staticmethod
+    def configureImageStage(processes, queueSize=None):
+        """Run 2x decode/merge/encode in a pool of processes, or in the calling thread when processes is 0"""
+        Utils.shutdownPools()
+        if processes and processes > 0:
+            Utils.imageStage = ImageStage(processes, queueSize)
+
+    @staticmethod
+    def shutdownPools():
+        if Utils.imageStage is not None:
+            Utils.imageStage.shutdown()
+            Utils.imageStage = None
+
+        with Utils.childExecutorLock:
+            if Utils.childExecutor is not None:
+                Utils.childExecutor.shutdown()
+                Utils.childExecutor = None
+
+    @staticmethod
+    def configureRateLimit(rate, burst=1):
+        """Limit requests to rate per second per tile host, or remove the limit when rate is 0"""
+        if rate and rate > 0:
+            Utils.rateLimiter = RateLimiter(rate, burst)
+        else:
+            Utils.rateLimiter = None
+
+    @staticmethod
+    def configureCircuitBreaker(failureRatio, window=20, openTime=30, maxOpenTime=300, probes=1):
+        """Open a host's circuit once failureRatio of its recent requests failed, or disable breaking when 0"""
+        if failureRatio and failureRatio > 0:
+            Utils.circuitBreaker = CircuitBreaker(failureRatio, window, openTime, maxOpenTime, probes)
+        else:
+            Utils.circuitBreaker = None
+
+    @staticmethod
+    def deferredRetryIn(url, x, y, z):
+        """Seconds until the host of a tile deferred with CIRCUIT_OPEN may be tried again"""
+        if Utils.circuitBreaker is None:
+            return 0.0
+        return Utils.circuitBreaker.retryIn(Utils.qualifyURL(url, x, y, z))
+
+    @staticmethod
+    def parseRetryAfter(value):
+        """Seconds to wait from a Retry-After header, given as seconds or as an HTTP date"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def observeResponse(url, status, started, retryAfter=None):
+        # Throttling still means the host is up, only errors and silence count against its circuit
+        breaker = Utils.circuitBreaker
+        if breaker is not None:
+            breaker.record(url, status is not None and status < 500)
+
+        observer = Utils.responseObserver
+        if observer is not None:
+            observer(url, status, time.monotonic() - started, retryAfter)
+
     @staticmethod
     def set_log_level(level):
         """Set the logger level - useful for controlling verbosity"""
@@ -81,21 +240,22 @@ class Utils:
         return url
 
     @staticmethod
-    def mergeQuadTile(quadTiles):
+    def mergeQuadTile(quadTiles, mode="RGB"):
 
         width = 0
         height = 0
 
+        # Any child gives the size, the others may be missing
         for tile in quadTiles:
             if tile is not None:
-                width = quadTiles[0].size[0] * 2
-                height = quadTiles[1].size[1] * 2
+                width = tile.size[0] * 2
+                height = tile.size[1] * 2
                 break
 
         if width == 0 or height == 0:
             return None
 
-        canvas = Image.new("RGB", (width, height))
+        canvas = Image.new(mode, (width, height))
 
         if quadTiles[0] is not None:
             canvas.paste(quadTiles[0], box=(0, 0))
@@ -115,106 +275,188 @@ class Utils:
         return canvas
 
     @staticmethod
-    def downloadFile(
-        url, destination, x, y, z, max_retries=3, timeout=30, retry_delay=1, quiet=False
-    ):
+    def isRetryable(code):
+        """Whether a failed attempt with this code may succeed later: timeouts, empty bodies, throttling and 5xx"""
+        return code in (0, 204, 408, 429) or code >= 500
+
+    @staticmethod
+    def fetchTileAttempt(url, x, y, z, timeout=30, quiet=False):
         """
-        Download a file with retry functionality
+        Make a single download attempt for a tile, returns (code, data, retryAfter).
+        code is the HTTP status, 204 for an empty body, 0 for timeouts and connection errors,
+        or CIRCUIT_OPEN with the seconds until the host may be tried again
         """
         url = Utils.qualifyURL(url, x, y, z)
-        attempts = 0
+        retryAfter = None
 
-        # Ensure the temp directory exists
         try:
-            os.makedirs(os.path.dirname(destination), exist_ok=True)
-        except OSError as e:
-            logger.error(f"Failed to create directory for {destination}: {str(e)}")
-            return 500
+            if not quiet:
+                logger.info(f"Downloading tile from {url}")
 
-        while attempts < max_retries:
+            # Respect the host's rate limit on every attempt, including retries
+            if Utils.rateLimiter is not None:
+                Utils.rateLimiter.wait(url)
+
+            # Fail fast while the host's circuit is open
+            if Utils.circuitBreaker is not None:
+                allowed, retryIn = Utils.circuitBreaker.allow(url)
+                if not allowed:
+                    return Utils.CIRCUIT_OPEN, None, retryIn
+
+            # Make request with timeout
+            started = time.monotonic()
             try:
-                if not quiet:
-                    logger.info(
-                        f"Downloading tile from {url} (attempt {attempts+1}/{max_retries})"
-                    )
+                response = Utils.getSession().get(url, timeout=timeout)
+            except Exception:
+                # Any request that got no answer counts as a failure, which also frees a half-open probe
+                Utils.observeResponse(url, None, started)
+                raise
+
+            retryAfter = Utils.parseRetryAfter(response.headers.get("Retry-After"))
+            Utils.observeResponse(url, response.status_code, started, retryAfter)
+            response.raise_for_status()  # Raise exception for 4XX/5XX responses
+
+            # Verify we got actual content
+            if len(response.content) == 0:
+                logger.warning(f"Received empty response for tile at x={x}, y={y}, z={z}")
+                return 204, None, retryAfter  # No content
+
+            return response.status_code, response.content, retryAfter
+
+        except requests.exceptions.Timeout:
+            logger.warning(f"Timeout while downloading tile at x={x}, y={y}, z={z}")
 
-                # Make request with timeout
-                response = requests.get(url, timeout=timeout)
-                response.raise_for_status()  # Raise exception for 4XX/5XX responses
-
-                # Verify we got actual content
-                if len(response.content) == 0:
-                    logger.warning(f"Received empty response for tile at x={x}, y={y}, z={z}")
-                    attempts += 1
-                    if attempts < max_retries:
-                        sleep_time = retry_delay * (2 ** (attempts - 1))
-                        time.sleep(sleep_time)
-                        continue
-                    else:
-                        return 204  # No content
-
-                # Save the file
-                try:
-                    with open(destination, "wb") as f:
-                        f.write(response.content)
-
-                    # Verify file was written
-                    if not os.path.exists(destination) or os.path.getsize(destination) == 0:
-                        logger.warning(f"File not written correctly: {destination}")
-                        attempts += 1
-                        if attempts < max_retries:
-                            sleep_time = retry_delay * (2 ** (attempts - 1))
-                            time.sleep(sleep_time)
-                            continue
-                        else:
-                            return 500
-                except IOError as e:
-                    logger.error(f"Failed to write file {destination}: {str(e)}")
-                    attempts += 1
-                    if attempts < max_retries:
-                        sleep_time = retry_delay * (2 ** (attempts - 1))
-                        time.sleep(sleep_time)
-                        continue
-                    else:
-                        return 500
-
-                return response.status_code
-
-            except requests.exceptions.Timeout:
-                logger.warning(f"Timeout while downloading tile at x={x}, y={y}, z={z}")
-
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 404:
-                    # Tile doesn't exist, don't retry
-                    logger.warning(f"Tile not found (404): x={x}, y={y}, z={z}")
-                    if attempts >= max_retries:
-                        return 404  # Return 404 after all retries fail
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 404:
+                logger.warning(f"Tile not found (404): x={x}, y={y}, z={z}")
+            else:
                 logger.warning(
                     f"HTTP error {e.response.status_code} for tile at x={x}, y={y}, z={z}"
                 )
+            return e.response.status_code, None, retryAfter
 
-            except requests.exceptions.RequestException as e:
-                logger.warning(f"Error downloading tile: {str(e)}")
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Error downloading tile: {str(e)}")
 
-            except Exception as e:
-                logger.error(f"Unexpected error while downloading tile: {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error while downloading tile: {str(e)}")
+
+        return 0, None, retryAfter
+
+    @staticmethod
+    def fetchTile(url, x, y, z, max_retries=3, timeout=30, retry_delay=1, quiet=False):
+        """
+        Download a tile into memory with retry functionality, returns (code, data).
+        code is CIRCUIT_OPEN when the tile was deferred because its host's circuit is open
+        """
+        attempts = 0
+
+        while attempts < max_retries:
+            code, data, retryAfter = Utils.fetchTileAttempt(url, x, y, z, timeout, quiet)
+            if code == 200 and data:
+                return code, data
+
+            # Deferred, the caller decides when to come back
+            if code == Utils.CIRCUIT_OPEN:
+                logger.warning(f"Tile host circuit is open, deferring tile x={x}, y={y}, z={z}")
+                return Utils.CIRCUIT_OPEN, None
+
+            # A missing tile will stay missing
+            if not Utils.isRetryable(code):
+                return code, None
 
             # Increment attempts and apply exponential backoff
             attempts += 1
             if attempts < max_retries:
                 sleep_time = retry_delay * (2 ** (attempts - 1))  # Exponential backoff
+                if retryAfter is not None:
+                    sleep_time = max(sleep_time, retryAfter)  # The server knows better when to come back
                 logger.info(f"Retrying in {sleep_time} seconds...")
                 time.sleep(sleep_time)
+            elif code == 204:
+                return 204, None  # No content
 
         logger.error(
             f"Failed to download tile after {max_retries} attempts: x={x}, y={y}, z={z}"
         )
-        return 500  # Return error code after all retries fail
+        return 500, None  # Return error code after all retries fail
 
     @staticmethod
-    def downloadFileScaled(
+    def writeTileFile(destination, data):
+        """Write tile bytes to destination, returns an HTTP-like result code"""
+        try:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, "wb") as f:
+                f.write(data)
+            return 200
+        except (IOError, OSError) as e:
+            logger.error(f"Failed to write file {destination}: {str(e)}")
+            return 500
+
+    @staticmethod
+    def downloadFile(
+        url, destination, x, y, z, max_retries=3, timeout=30, retry_delay=1, quiet=False
+    ):
+        """
+        Download a file with retry functionality. File based fallback of fetchTile
+        """
+        code, data = Utils.fetchTile(url, x, y, z, max_retries, timeout, retry_delay, quiet)
+        if data is None:
+            return code
+
+        written = Utils.writeTileFile(destination, data)
+        return code if written == 200 else written
+
+    @staticmethod
+    def encodeImage(image, format="PNG"):
+        buffer = io.BytesIO()
+        image.save(buffer, format)
+        return buffer.getvalue()
+
+    @staticmethod
+    def makeThumbnail(data, size=64):
+        """Downscale tile bytes to a size x size PNG preview, or None when they are not an image"""
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.thumbnail((size, size))
+            return Utils.encodeImage(image, "PNG")
+        except Exception as e:
+            logger.warning(f"Could not create a tile thumbnail: {str(e)}")
+            return None
+
+    @staticmethod
+    def mergeChildTiles(childData, tileFormat=None, quality=80):
+        """Decode up to four child tiles from memory and merge them into one tile, PNG unless tileFormat says otherwise, returns (code, data)"""
+        childImages = []
+        for data in childData:
+            if not data:
+                childImages.append(None)  # Add None placeholder for missing tile
+                continue
+            try:
+                childImages.append(Image.open(io.BytesIO(data)))
+            except Exception as e:
+                logger.error(f"Error opening child tile: {str(e)}")
+                childImages.append(None)  # Add None placeholder for missing tile
+
+        # Try to create a merged tile even if some tiles are missing
+        if not any(childImages):  # At least one valid image
+            logger.error("All child tiles failed to download")
+            return 500, None
+
+        try:
+            canvas = Utils.mergeQuadTile(childImages)
+            if canvas:
+                return 200, encode_image(canvas, tileFormat, quality)
+            else:
+                logger.error("Failed to merge quad tiles")
+                return 500, None
+        except Exception as e:
+            logger.error(f"Error merging or encoding quad tile: {str(e)}")
+            return 500, None
+
+    @staticmethod
+    def downloadTileData(
         url,
-        destination,
         x,
         y,
         z,
@@ -222,88 +464,138 @@ class Utils:
         max_retries=3,
         timeout=30,
         retry_delay=1,
+        tileFormat=None,
+        quality=80,
     ):
         """
-        Download a file with specific scale and retry functionality
+        Download a tile at a specific scale into memory, converted to tileFormat, returns (code, data)
         """
-        # Ensure the destination directory exists
-        try:
-            os.makedirs(os.path.dirname(destination), exist_ok=True)
-        except OSError as e:
-            logger.error(f"Failed to create directory for {destination}: {str(e)}")
-            return 500
-
         if outputScale == 1:
-            # Use the retry logic for scale 1
-            return Utils.downloadFile(
-                url, destination, x, y, z, max_retries, timeout, retry_delay
-            )
+            code, data = Utils.fetchTile(url, x, y, z, max_retries, timeout, retry_delay)
+            if code != 200 or not tileFormat or tileFormat == "original":
+                return code, data
+            return Utils.runImageWork(transcode_tile, data, tileFormat, quality)
 
         elif outputScale == 2:
-            # For scale 2, we need to download 4 child tiles with retry logic
-            childTiles = Utils.getChildTiles(x, y, z)
-            childImages = []
-            temp_files = []
-
-            for childX, childY, childZ in childTiles:
-                tempFile = Utils.randomString() + ".png"
-                tempFilePath = os.path.join("temp", tempFile)
-                temp_files.append(tempFilePath)
-
-                # Make sure temp directory exists
-                os.makedirs(os.path.dirname(tempFilePath), exist_ok=True)
-
-                # Use downloadFile with retry logic for each child tile
-                code = Utils.downloadFile(
-                    url,
-                    tempFilePath,
-                    childX,
-                    childY,
-                    childZ,
-                    max_retries,
-                    timeout,
-                    retry_delay,
+            # For scale 2, we need to download 4 child tiles with retry logic, all at once
+            futures = [
+                Utils.getChildExecutor().submit(
+                    Utils.fetchTile, url, childX, childY, childZ, max_retries, timeout, retry_delay
                 )
+                for childX, childY, childZ in Utils.getChildTiles(x, y, z)
+            ]
 
-                if code == 200 and os.path.exists(tempFilePath) and os.path.getsize(tempFilePath) > 0:
-                    try:
-                        image = Image.open(tempFilePath)
-                        childImages.append(image)
-                    except Exception as e:
-                        logger.error(f"Error opening image {tempFilePath}: {str(e)}")
-                        childImages.append(None)  # Add None placeholder for missing tile
-                else:
-                    childImages.append(None)  # Add None placeholder for missing tile
-
-            # Clean up temp files
-            for temp_file in temp_files:
-                try:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                except OSError:
-                    pass  # Ignore errors removing temp files
-
-            # Try to create a merged tile even if some tiles are missing
-            if any(childImages):  # At least one valid image
-                try:
-                    canvas = Utils.mergeQuadTile(childImages)
-                    if canvas:
-                        canvas.save(destination, "PNG")
-                        return 200
-                    else:
-                        logger.error("Failed to merge quad tiles")
-                        return 500
-                except Exception as e:
-                    logger.error(f"Error merging or saving quad tile: {str(e)}")
-                    return 500
-            else:
-                logger.error("All child tiles failed to download")
-                return 500
+            childData = []
+            childCodes = []
+            for future in futures:
+                code, data = future.result()
+                childData.append(data if code == 200 else None)
+                childCodes.append(code)
+
+            # A tile outside the server's coverage, nothing to merge or retry
+            if all(code == 404 for code in childCodes):
+                return 404, None
+
+            # A child deferred by an open circuit defers the whole tile
+            if Utils.CIRCUIT_OPEN in childCodes:
+                return Utils.CIRCUIT_OPEN, None
+
+            return Utils.runImageWork(Utils.mergeChildTiles, childData, tileFormat, quality)
 
         else:
             # For other scales (not supported)
             logger.error(f"Unsupported output scale: {outputScale}")
-            return 400  # Bad request
+            return 400, None  # Bad request
+
+    @staticmethod
+    def runImageWork(fn, *args, then=None):
+        """
+        Run decode/transform/encode work fn(*args) returning (code, data). With an image stage
+        and a then callback it runs in the stage and a Future of then(code, data) is returned,
+        otherwise its (code, data) once done
+        """
+        if Utils.imageStage is None:
+            return fn(*args)
+        if then is None:
+            return Utils.imageStage.submit(fn, *args).result()
+        return Utils.imageStage.submit(fn, *args, then=lambda result: then(*result))
+
+    @staticmethod
+    def downloadTileAttempt(url, x, y, z, outputScale=1, timeout=30, final=True, then=None, tileFormat=None, quality=80):
+        """
+        Make a single download attempt for a tile at a specific scale, returns (code, data, retryAfter).
+        A 2x tile missing some children is retried as a whole, unless this is the final attempt,
+        which merges whatever children arrived. Tiles are converted to tileFormat. With an image
+        stage and a then callback, merging and converting happen in the stage and data is a
+        Future of then(code, data) instead
+        """
+        if outputScale == 1:
+            code, data, retryAfter = Utils.fetchTileAttempt(url, x, y, z, timeout)
+            if code != 200 or not tileFormat or tileFormat == "original":
+                return code, data, retryAfter
+
+            staged = Utils.runImageWork(transcode_tile, data, tileFormat, quality, then=then)
+            if then is not None and Utils.imageStage is not None:
+                return 200, staged, None
+            code, data = staged
+            return code, data, None
+
+        elif outputScale == 2:
+            futures = [
+                Utils.getChildExecutor().submit(Utils.fetchTileAttempt, url, childX, childY, childZ, timeout)
+                for childX, childY, childZ in Utils.getChildTiles(x, y, z)
+            ]
+            results = [future.result() for future in futures]
+
+            failed = [(code, retryAfter) for code, data, retryAfter in results if code != 200]
+
+            # A child skipped by an open circuit defers the whole tile, even on the final attempt
+            deferred = [retryAfter for code, retryAfter in failed if code == Utils.CIRCUIT_OPEN]
+            if deferred:
+                return Utils.CIRCUIT_OPEN, None, max(deferred)
+
+            if len(failed) == len(results) and all(code == 404 for code, retryAfter in failed):
+                return 404, None, None
+
+            retryable = [failure for failure in failed if Utils.isRetryable(failure[0])]
+            if not final and retryable:
+                code, retryAfter = max(retryable, key=lambda failure: failure[1] or 0)
+                return code, None, retryAfter
+
+            childData = [data if code == 200 else None for code, data, retryAfter in results]
+            staged = Utils.runImageWork(Utils.mergeChildTiles, childData, tileFormat, quality, then=then)
+            if then is not None and Utils.imageStage is not None:
+                return 200, staged, None
+            code, data = staged
+            return code, data, None
+
+        else:
+            logger.error(f"Unsupported output scale: {outputScale}")
+            return 400, None, None  # Bad request
+
+    @staticmethod
+    def downloadFileScaled(
+        url,
+        destination,
+        x,
+        y,
+        z,
+        outputScale=1,
+        max_retries=3,
+        timeout=30,
+        retry_delay=1,
+    ):
+        """
+        Download a file with specific scale and retry functionality. File based fallback of downloadTileData
+        """
+        code, data = Utils.downloadTileData(
+            url, x, y, z, outputScale, max_retries, timeout, retry_delay
+        )
+        if data is None:
+            return code
+
+        written = Utils.writeTileFile(destination, data)
+        return code if written == 200 else written
 
     @staticmethod
     def scaleImage(filePath, scale):
@@ -330,3 +622,23 @@ class Utils:
                 digit += 2
             quadKey += str(digit)
         return quadKey
+
+    @staticmethod
+    def quadKeyToTileXY(quadKey):
+        """Convert a Bing Maps quadkey back to tile coordinates (x, y, z)"""
+        x = 0
+        y = 0
+        z = len(quadKey)
+        for i in range(z, 0, -1):
+            mask = 1 << (i - 1)
+            digit = quadKey[z - i]
+            if digit == "1":
+                x |= mask
+            elif digit == "2":
+                y |= mask
+            elif digit == "3":
+                x |= mask
+                y |= mask
+            elif digit != "0":
+                raise ValueError(f"Invalid quadkey digit: {digit}")
+        return (x, y, z)